@@ -18,254 +18,1731 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import atexit
+import bisect
+import collections
+import csv
+import datetime
+import difflib
+import hmac
+import io
+import itertools
+import json
 import os
+import queue
+import re
+import select
 import string
+import threading
+import time
 import traceback
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape
 
-from flask import Flask, request
+from flask import (Blueprint, Flask, current_app, g, has_app_context,
+                   has_request_context, request)
 import psycopg2
-from twilio.rest import TwilioRestClient
+import psycopg2.extensions
+import psycopg2.extras
+
+from metrics import Metrics
+from schema import EVENT_CODES, event_partition
+import sms
+from snapshot import Snapshot
+
+# Under gunicorn's gevent workers, psycopg2 has to be told to yield to other
+# greenlets while it waits on the database; otherwise one slow query blocks
+# every request in the worker and a connection pool buys us nothing.
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+except ImportError:
+    pass
 
 ## CONSTANTS ##
-TWILIO_ACCOUNT_SID = ""
-TWILIO_AUTH_TOKEN = ""
-OUR_NUMBER = "+10005551234"
-SUPERUSER = "+10005551234"
+def env_setting(name, default):
+    """
+    Return the value of environment variable /name/, converted to the type of
+    /default/, or /default/ if it isn't set. Settings that differ from one
+    deployment to the next are read this way, so they can be set with
+    'heroku config:set NAME=VALUE' instead of by editing this file.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+TWILIO_ACCOUNT_SID = env_setting("TWILIO_ACCOUNT_SID", "")
+TWILIO_AUTH_TOKEN = env_setting("TWILIO_AUTH_TOKEN", "")
+# Trips can have their own numbers and superusers (see Trips); these are used
+# for the one that doesn't.
+OUR_NUMBER = env_setting("OUR_NUMBER", "+10005551234")
+SUPERUSER = env_setting("SUPERUSER", "+10005551234")
 
 # if true, we will log messages but not actually send them
-DEBUG = False
+DEBUG = env_setting("BUSBOT_DEBUG", False)
+
+# Where the Twilio REST API lives. Point this at a local fake_twilio.py to try
+# out sending without paying for it.
+TWILIO_API_BASE = env_setting("TWILIO_API_BASE", "https://api.twilio.com")
+
+# Outgoing texts are queued and sent by this many background threads per
+# worker process, so request handlers never wait on Twilio.
+SMS_SEND_CONCURRENCY = 4
+# Messages per second each worker process sends. Twilio only sends one message
+# a second from a regular phone number and queues anything faster on their
+# end; by keeping the backlog in our own queue instead, urgent messages can
+# still jump ahead of a long broadcast.
+SMS_SEND_RATE = 1.0
+# A message that fails for what might be a temporary reason (a network error,
+# or Twilio being overloaded) is retried, waiting SMS_RETRY_BACKOFF seconds
+# the first time and twice as long after each further failure.
+SMS_MAX_ATTEMPTS = 4
+SMS_RETRY_BACKOFF = 2
+# How many sent and failed messages to remember the status of.
+SMS_RECENT_SIZE = 500
+# Texts are made as cheap to send as they safely can be (see sms.optimize()):
+# characters with a GSM equivalent are swapped for it in every text, and those
+# of BusBot's own texts that would take more than SMS_SEGMENT_BUDGET segments
+# have the long phrases in SHORT_FORMS replaced by the short ones, in order,
+# until they fit, as long as that saves a segment. (Texts people write, like
+# WALLs, are never reworded.)
+# SMS_SEGMENT_COST is what Twilio charges per segment, in dollars, which is
+# used to work out what a broadcast will cost.
+SMS_SEGMENT_BUDGET = 1
+SMS_SEGMENT_COST = 0.0075
+# LIST and NOTRIDING pack as many names as fit into each text, and send a
+# counter at most this many texts; the last one says how many more there are.
+LIST_MAX_TEXTS = 3
+# A PING doesn't text anyone that another PING on the trip texted (or is still
+# texting) within this many seconds, so counters PINGing again only reach the
+# people the last one didn't.
+PING_REPEAT_AFTER = 300
+
+# Notifications to bus counters that aren't urgent (like someone texting WAIT)
+# are collected for this many seconds and then sent together, one text per
+# counter (see CounterDigest). 0 sends each one right away.
+COUNTER_DIGEST_WINDOW = env_setting("COUNTER_DIGEST_WINDOW", 30)
+
+# Status changes are logged to the database in the background (see EventLog)
+# every this many seconds, or as soon as this many are waiting. At most
+# EVENT_BUFFER_MAX are kept waiting if the database is unreachable.
+EVENT_FLUSH_INTERVAL = 5
+EVENT_BATCH_SIZE = 500
+EVENT_BUFFER_MAX = 100000
+
+# Twilio sends a message again if we're slow to respond to it. We remember the
+# messages we've handled for this many seconds so we don't handle them twice,
+# keeping the most recent DEDUPE_CACHE_SIZE of them in memory.
+DEDUPE_TTL = 3600
+DEDUPE_CACHE_SIZE = 1000
+
+# Maximum number of database connections each worker process may hold open.
+# Heroku's hobby-dev Postgres allows 20 connections and the Procfile starts 4
+# workers, so 5 apiece is as many as we can have.
+DB_POOL_SIZE = env_setting("DB_POOL_SIZE", 5)
+# Seconds to wait for the database to accept a connection before giving up.
+DB_CONNECT_TIMEOUT = 10
+# A pooled connection that has sat idle for this many seconds is checked with
+# a trivial query before being handed out again, in case the server dropped it.
+DB_HEALTHCHECK_AFTER = 30
+# While the database is unreachable, BusBot keeps checking people in and out
+# using a copy of the rosters in this SQLite file, and tries the database
+# again every DB_RETRY_INTERVAL seconds (see DatabaseFailover). An empty path
+# turns this off. Anything else is answered with OFFLINE_REPLY.
+SNAPSHOT_PATH = env_setting("BUSBOT_SNAPSHOT", "busbot-snapshot.sqlite3")
+# How often (in seconds) changes to the rosters are saved to the snapshot.
+SNAPSHOT_FLUSH_INTERVAL = 2
+DB_RETRY_INTERVAL = 5
+OFFLINE_REPLY = ("Sorry, BusBot can't reach its database right now, so it can "
+                 "only check people in and out. Please try again in a few "
+                 "minutes.")
+
+# When more messages come in at once than there are database connections,
+# bus counters' commands are handled first, then status changes, then
+# everything else (see CommandScheduler). At most this many messages of each
+# of those kinds wait their turn; any more are answered with BUSY_REPLY.
+COMMAND_QUEUE_LIMITS = (200, 500, 25)
+BUSY_REPLY = ("Sorry, BusBot is very busy right now. Please try again in a "
+              "minute.")
+
+# Anyone may send this many commands that get a reply in a row, and then one
+# more every 1/SENDER_RATE seconds (see SenderLimits); commands past that are
+# ignored. Each worker keeps track of the SENDER_LIMITS_SIZE numbers it has
+# heard from most recently.
+SENDER_BURST = 10
+SENDER_RATE = 10 / 60
+SENDER_LIMITS_SIZE = 10000
+
+# Door scanners and bus counters' apps can send BusBot many status changes at
+# once (see receive_checkins()). They must send this token to do so; if it's
+# empty, they can't. At most CHECKIN_BATCH_MAX changes can be sent at a time.
+CHECKIN_API_TOKEN = env_setting("CHECKIN_API_TOKEN", "")
+CHECKIN_BATCH_MAX = 1000
+
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections shared by all the requests (i.e.,
+    greenlets) in a worker process.
+
+    checkout() blocks until a connection is free rather than failing, so a
+    burst of requests queues up for at most /size/ connections. Connections
+    that have gone bad are thrown away and replaced with fresh ones, and any
+    transaction left open by a failed request is rolled back when the
+    connection is checked back in, so it can't poison the next request.
+    """
+    def __init__(self, size, **connect_args):
+        self.connect_args = connect_args
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, time it was checked in)
+
+    def checkout(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, idle_since = self._idle.pop()
+                if self._is_healthy(conn, idle_since):
+                    return conn
+                self._discard(conn)
+            return psycopg2.connect(**self.connect_args)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn):
+        try:
+            if not conn.closed:
+                if (conn.get_transaction_status()
+                        != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    conn.rollback()
+                with self._lock:
+                    self._idle.append((conn, time.time()))
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.time() - idle_since < DB_HEALTHCHECK_AFTER:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class RequestStats:
+    """
+    What it took to handle one incoming message: which command it was, how
+    long the request and its dispatch-table handler took, and how many
+    queries and outgoing texts (and SMS segments) it caused. See
+    record_request().
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.trip_id = None
+        self.command = 'UNPARSED'
+        self.outcome = 'ok'
+        self.handler_time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sms_count = 0
+        self.sms_segments = 0
+
+def current_stats():
+    "Return the RequestStats for the current request, if there is one."
+    return g.get('stats') if has_app_context() else None
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    "Cursor that adds the queries it runs to the current request's stats."
+    def execute(self, query, vars=None):
+        start = time.time()
+        try:
+            return super().execute(query, vars)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.sql_count += 1
+                stats.sql_time += time.time() - start
+
+
+### Setting up ###
+# Importing this module doesn't connect to anything: the database connection
+# pool and the Twilio client are created the first time they're needed, so a
+# worker starts quickly and still starts if the database is down for a
+# moment. (See /healthz and /readyz below.)
+db_pool = None
+sms_client = None
+resources_lock = threading.Lock()
+
+def database_name(url):
+    "Return where the database at /url/ is, without the password."
+    url = urlparse(url)
+    return "%s:%s%s" % (url.hostname, url.port, url.path)
+
+snapshot = Snapshot(SNAPSHOT_PATH,
+                    database_name(os.environ.get("DATABASE_URL", "")),
+                    SNAPSHOT_FLUSH_INTERVAL)
+atexit.register(snapshot.flush)
+
+busbot = Blueprint('busbot', __name__)
+
+def create_app():
+    "Return a new Flask app that serves BusBot."
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(busbot)
+    flask_app.teardown_appcontext(return_db)
+    return flask_app
+
+def get_db_pool():
+    global db_pool
+    with resources_lock:
+        if db_pool is None:
+            url = urlparse(os.environ["DATABASE_URL"])
+            db_pool = ConnectionPool(
+                DB_POOL_SIZE,
+                cursor_factory=InstrumentedCursor,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                database=url.path[1:],
+                user=url.username,
+                password=url.password,
+                host=url.hostname,
+                port=url.port
+            )
+    return db_pool
+
+def get_sms_client():
+    global sms_client
+    with resources_lock:
+        if sms_client is None:
+            # The twilio package takes a good part of our startup time to
+            # import, so it isn't imported until we first send a text.
+            from twilio.rest import TwilioRestClient
+            sms_client = TwilioRestClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN,
+                                          base=TWILIO_API_BASE)
+    return sms_client
+
+
+### Database access ###
+def get_db():
+    """
+    Return the database connection for the current request, checking one out
+    of the pool the first time it's needed. The connection is returned to the
+    pool when the request finishes (see return_db()).
+    """
+    if 'db_conn' not in g:
+        if database.degraded:
+            raise DatabaseUnavailable("The database is unreachable.")
+        try:
+            g.db_conn = get_db_pool().checkout()
+        except psycopg2.OperationalError:
+            database.lost()
+            raise
+    return g.db_conn
+
+def return_db(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_db_pool().checkin(conn)
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    "Raised by get_db() while we're in degraded mode (see DatabaseFailover)."
+
+class DatabaseFailover:
+    """
+    Keeps BusBot checking people in while the database is unreachable.
+
+    When a request can't connect to the database (or loses its connection),
+    the worker goes into degraded mode. get_db() then fails at once, rather
+    than making every request wait DB_CONNECT_TIMEOUT. Rosters come from
+    memory or else from the snapshot (see snapshot.py). Status changes are
+    made in the roster and added to the snapshot's journal (see mark_users()).
+    Commands that need anything else from the database are answered with
+    OFFLINE_REPLY.
+
+    A watcher thread tries the database every /retry_interval/ seconds while
+    we're degraded. Once it answers, the thread replays the journal into it
+    (see replay_journal()) and leaves degraded mode. It also replays anything
+    left in the journal by another worker, or by a worker that was stopped
+    before it could replay.
+    """
+    def __init__(self, retry_interval):
+        self.retry_interval = retry_interval
+        self.degraded = False
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def start(self, flask_app):
+        "Start the watcher thread, if it isn't running yet."
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch,
+                                                 args=(flask_app,), daemon=True)
+                self._watcher.start()
+
+    def lost(self):
+        "Go into degraded mode, since the database has stopped answering."
+        with self._lock:
+            if self.degraded:
+                return
+            self.degraded = True
+        print("Lost the database; keeping status changes in the snapshot "
+              "until it's back.")
+        metrics.set('busbot_database_degraded', 1)
+
+    def _watch(self, flask_app):
+        while True:
+            time.sleep(self.retry_interval)
+            self.reconnect(flask_app)
+
+    def reconnect(self, flask_app):
+        """
+        If we're degraded or there's anything in the journal, try the
+        database, replaying the journal into it and leaving degraded mode if
+        it answers.
+        """
+        conn = None
+        try:
+            if not self.degraded and not snapshot.journaled():
+                return
+            conn = get_db_pool().checkout()
+            with flask_app.app_context():
+                replay_journal(conn)
+        except Exception:
+            if not self.degraded:
+                print("Couldn't replay the journal, will try again:")
+                print(traceback.format_exc())
+            return
+        finally:
+            if conn is not None:
+                get_db_pool().checkin(conn)
+        if self.degraded:
+            self.degraded = False
+            print("The database is back.")
+            metrics.set('busbot_database_degraded', 0)
 
-# Set up database
-url = urlparse(os.environ["DATABASE_URL"])
-db_conn = psycopg2.connect(
-    database=url.path[1:],
-    user=url.username,
-    password=url.password,
-    host=url.hostname,
-    port=url.port
-)
+database = DatabaseFailover(DB_RETRY_INTERVAL)
 
-# Set up other objects
-sms_client = TwilioRestClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-app = Flask(__name__)
+def lost_database(error):
+    """
+    Return True if /error/, raised while handling a request, means we've lost
+    the database (rather than that a query failed), going into degraded mode
+    if so.
+    """
+    if isinstance(error, DatabaseUnavailable):
+        return True
+    conn = g.get('db_conn')
+    if (isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            and (conn is None or conn.closed)):
+        database.lost()
+        return True
+    return False
+
+
+### The roster ###
+class Roster:
+    """
+    An in-memory copy of the users of trip /trip_id/, keyed by phone number,
+    so that looking up the sender of a message or finding out who's missing
+    doesn't take a trip to the database.
+
+    Besides the user dictionaries themselves (in the format returned by
+    get_user()), the roster keeps the set of phones with each status and the
+    set of bus counters, so that counts are O(1) and listing the people with
+    some status is proportional to how many of them there are. It also counts
+    how many people share each first name, which is what get_displayname()
+    needs to know, and indexes users by their lowercased first and full names
+    for parse_user_selector().
+
+    It also keeps the listings LIST and NOTRIDING answer with ready to send:
+    the display names (see get_displayname()) of the people in each, in
+    alphabetical order. These are updated as each person changes, rather than
+    built again every time a bus counter asks.
+
+    Changes made by this worker are written through to the database first and
+    then applied here; changes made by anyone else reach us through the
+    listener thread (see listen_for_roster_changes()). The worker that makes
+    a change also saves it to the snapshot, which the roster is loaded from
+    instead if the database is unreachable (see DatabaseFailover); other
+    workers only save what BusBot didn't change itself, like people added by
+    import_roster.py.
+    """
+    STATUSES = ('IN', 'OUT', 'WAIT', 'ABSENT', 'UNSET')
+    # The statuses of the people in each listing.
+    LISTINGS = {'missing': ('UNSET', 'OUT', 'WAIT'), 'absent': ('ABSENT',)}
+
+    def __init__(self, trip_id):
+        self.trip_id = trip_id
+        self.loaded = False
+        self._users = {}
+        self._by_status = {status: set() for status in self.STATUSES}
+        self._counters = set()
+        self._firstnames = collections.Counter()
+        self._by_firstname = collections.defaultdict(set)
+        self._by_fullname = collections.defaultdict(set)
+        # Each listing is a sorted list of (sort key, phone, entry) tuples.
+        self._listings = {listing: [] for listing in self.LISTINGS}
+        self._listed = {}  # phone -> (listing, its tuple there)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def load(self, conn):
+        """
+        (Re)load the entire roster from the database. The whole roster only
+        goes into the snapshot if it isn't there yet; otherwise, as in
+        refresh_user(), only who's been added, removed, or renamed is saved.
+        """
+        cursor = conn.cursor()
+        cursor.execute("""SELECT uid, firstname, lastname, phone, curstatus,
+                                 iscounter
+                          FROM users WHERE trip_id = %s""", (self.trip_id,))
+        rows = cursor.fetchall()
+        with self._lock:
+            before = [self._row(user_info)
+                      for user_info in self._users.values()]
+        if not before:
+            before = snapshot.roster(self.trip_id)
+        self._set_rows(rows)
+        self.loaded = True
+        if before:
+            self._save_changed_users(before, rows)
+        else:
+            snapshot.save_roster(self.trip_id, rows)
 
+    def load_snapshot(self):
+        """
+        Load the roster from the snapshot, if it has it. The roster still
+        counts as not loaded, so it's reloaded once the database is back.
+        """
+        rows = snapshot.roster(self.trip_id)
+        if rows:
+            self._set_rows(rows)
+
+    def _set_rows(self, rows):
+        with self._lock:
+            self._users.clear()
+            self._counters.clear()
+            self._firstnames.clear()
+            self._by_firstname.clear()
+            self._by_fullname.clear()
+            for phone_set in self._by_status.values():
+                phone_set.clear()
+            for row in rows:
+                self._put(row, relist=False)
+            self._rebuild_listings()
+
+    def refresh_user(self, conn, phone):
+        "Reread a single user from the database, in case they changed."
+        cursor = conn.cursor()
+        cursor.execute("""SELECT uid, firstname, lastname, phone, curstatus,
+                                 iscounter
+                          FROM users WHERE trip_id = %s AND phone = %s""",
+                       (self.trip_id, phone))
+        row = cursor.fetchone()
+        with self._lock:
+            old = self._users.get(phone)
+            saved = [self._row(old)] if old is not None else []
+            self._remove(phone)
+            if row is not None:
+                self._put(row)
+        self._save_changed_users(saved, [row] if row is not None else [])
+
+    def _save_changed_users(self, old_rows, rows):
+        """
+        Save to the snapshot the users in /rows/ who are new or renamed since
+        /old_rows/ (both in the format of Snapshot.save_roster()), and that
+        the ones only in /old_rows/ are gone. Status changes and PROMOTEs
+        aren't saved here, since the worker that made them did that, and
+        saving the whole row again might overwrite a newer status.
+        """
+        old = dict((row[3], tuple(row[:4])) for row in old_rows)
+        new = dict((row[3], row) for row in rows)
+        for phone in set(old) | set(new):
+            row = new.get(phone)
+            if row is None or tuple(row[:4]) != old.get(phone):
+                snapshot.save_user(self.trip_id, phone, row)
+
+    def get(self, phone):
+        "Return a copy of the user dictionary for /phone/, or None."
+        with self._lock:
+            user_info = self._users.get(phone)
+            return dict(user_info) if user_info is not None else None
+
+    def with_status(self, *statuses):
+        "Return copies of all the user dictionaries with one of /statuses/."
+        with self._lock:
+            return [dict(self._users[phone])
+                    for status in statuses
+                    for phone in self._by_status[status]]
+
+    def count(self, *statuses):
+        "Return how many users have one of /statuses/."
+        with self._lock:
+            return sum(len(self._by_status[status]) for status in statuses)
+
+    def count_firstname(self, firstname):
+        "Return how many users have the first name /firstname/."
+        with self._lock:
+            return self._firstnames[firstname]
+
+    def find_by_firstname(self, firstname):
+        "Return copies of everyone with first name /firstname/, ignoring case."
+        with self._lock:
+            return [dict(self._users[phone])
+                    for phone in self._by_firstname.get(firstname.lower(), ())]
+
+    def find_by_fullname(self, fullname):
+        """
+        Return copies of everyone whose first and last names together are
+        /fullname/, ignoring case and extra spaces.
+        """
+        with self._lock:
+            return [dict(self._users[phone])
+                    for phone in self._by_fullname.get(
+                        self._fullname_key(fullname), ())]
+
+    def find_by_fullname_prefix(self, prefix):
+        "Return copies of everyone whose full name starts with /prefix/."
+        prefix = self._fullname_key(prefix)
+        with self._lock:
+            return [dict(user_info) for user_info in self._users.values()
+                    if self._fullname_key(
+                        user_info['firstname'], user_info['lastname']
+                    ).startswith(prefix)]
+
+    def listing(self, listing):
+        """
+        Return the entries of /listing/ ('missing' or 'absent'), in order:
+        the display names of the people in it, with their status after them
+        for 'missing' ("Ann - WAIT").
+        """
+        with self._lock:
+            return [entry for _, _, entry in self._listings[listing]]
 
-### Generic helper functions ###
-def send_msg(to_phone, body):
-    "Send message /body/ to phone number /phone/."
-    print("==> %s :: %s" % (to_phone, body))
-    if not DEBUG:
-        sms_client.messages.create(
-            to=to_phone, from_=OUR_NUMBER, body=body)
-
-def send_all(body):
-    "Send /body/ to ALL users on the list. Use with caution."
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT phone FROM users")
-    for user_phone in cursor.fetchall():
-        send_msg(user_phone[0], body)
-
-def notify_counters(body):
-    "Send /body/ to all bus counters."
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT phone FROM users WHERE iscounter = True")
-    for counter_phone in cursor.fetchall():
-        send_msg(counter_phone[0], body)
-
-def get_user(msg_phone):
-    """
-    Return a dictionary with information about the user with given phone.
-    """
-    cursor = db_conn.cursor()
-    cursor.execute("""SELECT firstname, lastname, curstatus, iscounter
-                      FROM users WHERE phone = %s""",
-                   (msg_phone,))
-    user_info = cursor.fetchone()
-    if user_info is None:
+    def names(self):
+        """
+        Return a dictionary mapping every lowercased first name and full name
+        on the roster to the full name it belongs to.
+        """
+        with self._lock:
+            names = {}
+            for user_info in self._users.values():
+                fullname = "%s %s" % (user_info['firstname'],
+                                      user_info['lastname'])
+                names[user_info['firstname'].lower()] = fullname
+                names[fullname.lower()] = fullname
+            return names
+
+    def phones(self):
+        with self._lock:
+            return list(self._users)
+
+    def counter_phones(self):
+        with self._lock:
+            return list(self._counters)
+
+    def set_status(self, phone, status):
+        with self._lock:
+            user_info = self._users.get(phone)
+            if user_info is not None:
+                self._by_status[user_info['curstatus']].discard(phone)
+                user_info['curstatus'] = status
+                self._by_status[status].add(phone)
+                self._unlist(phone)
+                self._list(phone)
+        snapshot.set_status(self.trip_id, phone, status)
+
+    def set_all_statuses(self, status):
+        with self._lock:
+            for user_info in self._users.values():
+                user_info['curstatus'] = status
+            for phone_set in self._by_status.values():
+                phone_set.clear()
+            self._by_status[status].update(self._users)
+            self._rebuild_listings()
+        snapshot.set_all_statuses(self.trip_id, status)
+
+    def set_counter(self, phone, iscounter):
+        with self._lock:
+            user_info = self._users.get(phone)
+            if user_info is not None:
+                user_info['iscounter'] = iscounter
+                if iscounter:
+                    self._counters.add(phone)
+                else:
+                    self._counters.discard(phone)
+        snapshot.set_counter(self.trip_id, phone, iscounter)
+
+    @staticmethod
+    def _row(user_info):
+        "Return /user_info/ as a row in the format of Snapshot.save_roster()."
+        return tuple(user_info[i] for i in ('uid', 'firstname', 'lastname',
+                                            'phone', 'curstatus', 'iscounter'))
+
+    def _put(self, row, relist=True):
+        """
+        Add the user in /row/. Unless /relist/ is False, in which case the
+        caller must rebuild the listings afterwards, add them to the right
+        listing too.
+        """
+        uid, firstname, lastname, phone, curstatus, iscounter = row
+        self._users[phone] = {'uid': uid, 'firstname': firstname,
+                              'lastname': lastname, 'phone': phone,
+                              'curstatus': curstatus, 'iscounter': iscounter,
+                              'trip_id': self.trip_id}
+        self._by_status[curstatus].add(phone)
+        self._firstnames[firstname] += 1
+        self._by_firstname[firstname.lower()].add(phone)
+        self._by_fullname[self._fullname_key(firstname, lastname)].add(phone)
+        if iscounter:
+            self._counters.add(phone)
+        if relist:
+            self._relist_firstname(firstname)
+
+    def _remove(self, phone):
+        self._unlist(phone)
+        user_info = self._users.pop(phone, None)
+        if user_info is not None:
+            self._by_status[user_info['curstatus']].discard(phone)
+            self._counters.discard(phone)
+            self._firstnames[user_info['firstname']] -= 1
+            if not self._firstnames[user_info['firstname']]:
+                del self._firstnames[user_info['firstname']]
+            for index, key in (
+                    (self._by_firstname, user_info['firstname'].lower()),
+                    (self._by_fullname, self._fullname_key(
+                        user_info['firstname'], user_info['lastname']))):
+                index[key].discard(phone)
+                if not index[key]:
+                    del index[key]
+            self._relist_firstname(user_info['firstname'])
+
+    def _list(self, phone):
+        "Add /phone/ to the listing for their status, if there is one."
+        listed = self._listing_item(phone)
+        if listed is not None:
+            listing, item = listed
+            bisect.insort(self._listings[listing], item)
+            self._listed[phone] = listed
+
+    def _unlist(self, phone):
+        "Take /phone/ out of the listing they're in, if any."
+        listed = self._listed.pop(phone, None)
+        if listed is not None:
+            listing, item = listed
+            entries = self._listings[listing]
+            del entries[bisect.bisect_left(entries, item)]
+
+    def _relist_firstname(self, firstname):
+        """
+        List everyone with /firstname/ again, since whether they're shown
+        with their last names depends on how many of them there are.
+        """
+        for phone in self._by_firstname.get(firstname.lower(), ()):
+            if self._users[phone]['firstname'] == firstname:
+                self._unlist(phone)
+                self._list(phone)
+
+    def _rebuild_listings(self):
+        for entries in self._listings.values():
+            entries.clear()
+        self._listed.clear()
+        for phone in self._users:
+            listed = self._listing_item(phone)
+            if listed is not None:
+                self._listings[listed[0]].append(listed[1])
+                self._listed[phone] = listed
+        for entries in self._listings.values():
+            entries.sort()
+
+    def _listing_item(self, phone):
+        """
+        Return the listing /phone/ belongs in and the tuple for them there,
+        or None if they aren't in any.
+        """
+        user_info = self._users[phone]
+        for listing, statuses in self.LISTINGS.items():
+            if user_info['curstatus'] in statuses:
+                if self._firstnames[user_info['firstname']] > 1:
+                    displayname = "%s %s" % (user_info['firstname'],
+                                             user_info['lastname'])
+                else:
+                    displayname = user_info['firstname']
+                if listing == 'missing':
+                    entry = "%s - %s" % (displayname, user_info['curstatus'])
+                else:
+                    entry = displayname
+                return listing, (displayname.lower(), phone, entry)
         return None
-    else:
-        firstname, lastname, curstatus, iscounter = user_info
-        return {'firstname': firstname, 'lastname': lastname,
-                'phone': msg_phone, 'curstatus': curstatus,
-                'iscounter': iscounter}
 
-def get_displayname(firstname, lastname):
+    @staticmethod
+    def _fullname_key(*names):
+        return ' '.join(' '.join(names).lower().split())
+
+class Trips:
+    """
+    The trips BusBot is counting (see schema.py), from the trips table, and
+    the Roster of each trip this worker has needed so far. Rosters are loaded
+    the first time they're needed, so a worker only keeps the trips it
+    actually gets messages for in memory.
+
+    A trip is a dictionary with the keys 'trip_id', 'name', 'phone' (the
+    Twilio number its messages are sent to and from), and 'superuser'. The
+    default trip has no number of its own and uses OUR_NUMBER instead;
+    messages to a number no trip has are for the default trip. Trips without
+    a superuser of their own use SUPERUSER.
+    """
+    def __init__(self):
+        self.loaded = False
+        self._trips = {}
+        self._by_number = {}
+        self._default = None
+        self._rosters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._trips)
+
+    def load(self, conn):
+        "(Re)load the list of trips from the database."
+        cursor = conn.cursor()
+        cursor.execute("SELECT trip_id, name, phone, superuser FROM trips")
+        rows = cursor.fetchall()
+        self._set_rows(rows)
+        self.loaded = True
+        snapshot.save_trips(rows)
+
+    def load_snapshot(self):
+        """
+        Load the trips from the snapshot, returning False if it has none.
+        As with Roster.load_snapshot(), they still count as not loaded.
+        """
+        rows = snapshot.trips()
+        if rows:
+            self._set_rows(rows)
+        return bool(rows)
+
+    def _set_rows(self, rows):
+        with self._lock:
+            self._trips = {trip_id: {'trip_id': trip_id, 'name': name,
+                                     'phone': phone, 'superuser': superuser}
+                           for trip_id, name, phone, superuser in rows}
+            self._by_number = {trip['phone']: trip
+                               for trip in self._trips.values()
+                               if trip['phone'] is not None}
+            self._default = None
+            for trip in self._trips.values():
+                if trip['phone'] is None:
+                    self._default = trip
+            for trip_id in list(self._rosters):
+                if trip_id not in self._trips:
+                    del self._rosters[trip_id]
+
+    def get(self, trip_id):
+        "Return a copy of the trip /trip_id/, or None."
+        with self._lock:
+            trip = self._trips.get(trip_id)
+            return dict(trip) if trip is not None else None
+
+    def named(self, name):
+        "Return a copy of the trip called /name/, or None."
+        with self._lock:
+            for trip in self._trips.values():
+                if trip['name'] == name:
+                    return dict(trip)
+            return None
+
+    def for_number(self, number):
+        "Return a copy of the trip that messages to /number/ are for, or None."
+        with self._lock:
+            trip = self._by_number.get(number, self._default)
+            return dict(trip) if trip is not None else None
+
+    def roster(self, trip_id):
+        "Return the Roster for /trip_id/, which may not be loaded yet."
+        with self._lock:
+            if trip_id not in self._rosters:
+                self._rosters[trip_id] = Roster(trip_id)
+            return self._rosters[trip_id]
+
+    def rosters(self):
+        with self._lock:
+            return list(self._rosters.values())
+
+    def forget_everything(self):
+        "Mark the trips and all the rosters as needing to be reloaded."
+        self.loaded = False
+        for roster in self.rosters():
+            roster.loaded = False
+
+trips = Trips()
+roster_listener = None
+roster_listener_lock = threading.Lock()
+
+# If more than this many users of a trip change in one go (e.g., on RESET),
+# the roster listener reloads the whole roster rather than rereading them one
+# by one.
+ROSTER_RELOAD_THRESHOLD = 20
+# How often (in seconds) the listener makes sure its connection is still up
+# when there's nothing else going on.
+ROSTER_LISTEN_TIMEOUT = 60
+
+def get_trips():
+    """
+    Return the Trips, loading them from the database if this worker hasn't
+    yet (or has lost track of changes and needs to start over), and making
+    sure the listener thread that keeps them up to date and the
+    DatabaseFailover watcher are running. If the database is unreachable,
+    the trips we already have do, or else the ones in the snapshot.
+    """
+    global roster_listener
+    with roster_listener_lock:
+        if roster_listener is None:
+            roster_listener = threading.Thread(target=listen_for_roster_changes,
+                                               daemon=True)
+            roster_listener.start()
+    if has_app_context():
+        database.start(current_app._get_current_object())
+    if not trips.loaded:
+        try:
+            trips.load(get_db())
+        except psycopg2.OperationalError as e:
+            if not (lost_database(e)
+                    and (len(trips) or trips.load_snapshot())):
+                raise
+    return trips
+
+def get_trip(trip_id):
+    return get_trips().get(trip_id)
+
+def get_roster(trip_id):
+    "Return the roster of trip /trip_id/, loading it if necessary."
+    roster = get_trips().roster(trip_id)
+    if not roster.loaded:
+        try:
+            roster.load(get_db())
+        except psycopg2.OperationalError as e:
+            if not lost_database(e):
+                raise
+            if not len(roster):
+                roster.load_snapshot()
+            if not len(roster):
+                raise
+    return roster
+
+def listen_for_roster_changes():
+    """
+    Body of the thread that keeps this worker's trips and rosters in sync
+    with changes made by other workers (or by hand in psql).
+
+    Triggers on the trips and users tables send a 'roster_changed'
+    notification whenever a row changes (see schema.py); we LISTEN on our own
+    connection and reread the trips or users the notifications are about as
+    they come in, or reload a trip's whole roster if there are a lot of them
+    or one says '*'. Rosters this worker hasn't loaded are left alone. If the
+    connection drops, we might miss notifications, so everything is marked
+    as not loaded (so requests reload it) until we're listening again.
+    """
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**get_db_pool().connect_args)
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute("LISTEN roster_changed")
+            # Anything loaded before now might have missed changes.
+            trips.forget_everything()
+            trips.load(conn)
+            while True:
+                if select.select([conn], [], [], ROSTER_LISTEN_TIMEOUT) == ([], [], []):
+                    conn.cursor().execute("SELECT 1")
+                    continue
+                conn.poll()
+                payloads = set(notify.payload for notify in conn.notifies)
+                del conn.notifies[:]
+                if 'trips' in payloads:
+                    payloads.remove('trips')
+                    trips.load(conn)
+                changed = collections.defaultdict(set)
+                for payload in payloads:
+                    trip_id, _, phone = payload.partition(' ')
+                    if trip_id.isdigit() and phone:
+                        changed[int(trip_id)].add(phone)
+                    else:
+                        # Don't know what changed, so reload everything.
+                        for roster in trips.rosters():
+                            changed[roster.trip_id].add('*')
+                for trip_id, phones in changed.items():
+                    roster = trips.roster(trip_id)
+                    if not roster.loaded:
+                        continue
+                    if '*' in phones or len(phones) > ROSTER_RELOAD_THRESHOLD:
+                        roster.load(conn)
+                    else:
+                        for phone in phones:
+                            roster.refresh_user(conn, phone)
+        except Exception:
+            print("Lost track of roster changes, will reconnect:")
+            print(traceback.format_exc())
+            trips.forget_everything()
+            time.sleep(5)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
+
+
+### The status event log ###
+class EventLog:
+    """
+    Appends status changes (and pings) to the status_events table, so there's
+    a record of who checked in when (see status_report.py).
+
+    Events are queued in memory and written in batches by a background thread
+    every /interval/ seconds, or sooner once /batch_size/ of them are
+    waiting, so logging them doesn't slow down check-ins. If writing fails,
+    the events are kept and tried again next time (up to EVENT_BUFFER_MAX of
+    them); events still waiting when a worker is killed are lost.
+    """
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._events = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._partitions = set()  # months we know have a partition
+
+    def record(self, user_info, event, old_status=None, actor=None):
+        """
+        Log that /event/ (a status, or 'PINGED') happened to the user
+        /user_info/, whose status was /old_status/, at the hands of the user
+        /actor/ (None if nobody in particular did it).
+        """
+        row = (time.time(), user_info['trip_id'], user_info['uid'],
+               actor['uid'] if actor is not None else None,
+               EVENT_CODES[event], EVENT_CODES.get(old_status))
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_forever,
+                                                daemon=True)
+                self._writer.start()
+            self._events.append(row)
+            if len(self._events) >= self.batch_size:
+                self._wakeup.set()
+
+    def _write_forever(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        "Write all the waiting events now."
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        conn = None
+        try:
+            conn = get_db_pool().checkout()
+            cursor = conn.cursor()
+            rows = []
+            for timestamp, trip_id, uid, actor, event, old_status in events:
+                at = datetime.datetime.fromtimestamp(timestamp,
+                                                     datetime.timezone.utc)
+                month = at.date().replace(day=1)
+                if month not in self._partitions:
+                    for statement in event_partition(month):
+                        cursor.execute(statement)
+                    self._partitions.add(month)
+                rows.append((at, trip_id, uid, actor, event, old_status))
+            psycopg2.extras.execute_values(
+                cursor, """INSERT INTO status_events
+                               (at, trip_id, uid, actor, event, old_status)
+                           VALUES %s""", rows)
+            conn.commit()
+        except Exception:
+            print("Couldn't log %i status events, will try again:" % len(events))
+            print(traceback.format_exc())
+            self._partitions.clear()
+            with self._lock:
+                self._events[:0] = events
+                if len(self._events) > EVENT_BUFFER_MAX:
+                    print("Dropping %i status events."
+                          % (len(self._events) - EVENT_BUFFER_MAX))
+                    del self._events[:-EVENT_BUFFER_MAX]
+        finally:
+            if conn is not None:
+                get_db_pool().checkin(conn)
+
+event_log = EventLog(EVENT_FLUSH_INTERVAL, EVENT_BATCH_SIZE)
+atexit.register(event_log.flush)
+
+
+### Sending texts ###
+class OutboundMessage:
+    """
+    A text queued to be sent by the Outbox. /status/ is 'queued' until the
+    message has either been accepted by Twilio ('sent', and /sid/ is set to
+    Twilio's ID for it) or given up on ('failed', and /error/ says why).
+
+    If /still_wanted/ is given, it's called with the message just before each
+    attempt to send it, and if it returns False the message is 'skipped'
+    instead. /on_done/, if given, is called with the message once it's been
+    sent, failed, or skipped (from one of the Outbox's threads).
+    """
+    def __init__(self, from_phone, to_phone, body, bulk, still_wanted=None,
+                 on_done=None):
+        self.from_phone = from_phone
+        self.to_phone = to_phone
+        self.body = body
+        self.bulk = bulk
+        self.still_wanted = still_wanted
+        self.on_done = on_done
+        self.status = 'queued'
+        self.attempts = 0
+        self.sid = None
+        self.error = None
+
+class Outbox:
+    """
+    Queue of outgoing texts, drained by a pool of sender threads.
+
+    Each phone number is always handled by the same sender, so one person's
+    messages arrive in the order they were sent. Bulk messages (broadcasts
+    and pings) wait behind everything else in a sender's queue, and all the
+    senders together are held to /rate/ messages per second from each of our
+    numbers.
+
+    Messages that fail for a reason that might be temporary are retried with
+    exponential backoff (see SMS_MAX_ATTEMPTS). Messages that have been sent,
+    failed, or skipped are kept in /recent/, and /counts/ tallies how many
+    messages ended up in each state.
+    """
+    def __init__(self, concurrency, rate):
+        self.rate = rate
+        self.recent = collections.deque(maxlen=SMS_RECENT_SIZE)
+        self.counts = collections.Counter()
+        self._queues = [queue.PriorityQueue() for _ in range(concurrency)]
+        self._senders = []
+        self._lock = threading.Lock()
+        self._next_slot = collections.defaultdict(float)  # by from_phone
+        self._sequence = itertools.count()
+
+    def put(self, message):
+        with self._lock:
+            if not self._senders:
+                for sender_queue in self._queues:
+                    sender = threading.Thread(target=self._send_forever,
+                                              args=(sender_queue,),
+                                              daemon=True)
+                    sender.start()
+                    self._senders.append(sender)
+        sender_queue = self._queues[hash(message.to_phone) % len(self._queues)]
+        sender_queue.put((message.bulk, next(self._sequence), message))
+
+    def _send_forever(self, sender_queue):
+        while True:
+            _, _, message = sender_queue.get()
+            if not self._still_wanted(message):
+                message.status = 'skipped'
+                self._finish(message)
+                continue
+            self._wait_for_turn(message.from_phone)
+            self._deliver(message, sender_queue)
+
+    def _still_wanted(self, message):
+        if message.still_wanted is None:
+            return True
+        try:
+            return message.still_wanted(message)
+        except Exception:
+            print("Couldn't tell if the message to %s is still wanted, "
+                  "sending it anyway:" % message.to_phone)
+            print(traceback.format_exc())
+            return True
+
+    def _wait_for_turn(self, from_phone):
+        with self._lock:
+            now = time.time()
+            next_slot = self._next_slot[from_phone]
+            wait = next_slot - now
+            self._next_slot[from_phone] = max(now, next_slot) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _deliver(self, message, sender_queue):
+        from twilio import TwilioRestException
+        message.attempts += 1
+        try:
+            sent = get_sms_client().messages.create(
+                to=message.to_phone, from_=message.from_phone,
+                body=message.body)
+        except Exception as e:
+            if (message.attempts < SMS_MAX_ATTEMPTS and
+                    (not isinstance(e, TwilioRestException)
+                     or e.status == 429 or e.status >= 500)):
+                delay = SMS_RETRY_BACKOFF * 2 ** (message.attempts - 1)
+                print("Sending to %s failed (%s), retrying in %i s."
+                      % (message.to_phone, e, delay))
+                self.counts['retried'] += 1
+                retry = threading.Timer(
+                    delay, sender_queue.put,
+                    [(message.bulk, next(self._sequence), message)])
+                retry.daemon = True
+                retry.start()
+                return
+            print("Giving up on message to %s:" % message.to_phone)
+            print(traceback.format_exc())
+            message.status = 'failed'
+            message.error = str(e)
+        else:
+            message.status = 'sent'
+            message.sid = sent.sid
+        self._finish(message)
+
+    def _finish(self, message):
+        self.counts[message.status] += 1
+        self.recent.append(message)
+        if message.on_done is not None:
+            try:
+                message.on_done(message)
+            except Exception:
+                print("Error after sending to %s:" % message.to_phone)
+                print(traceback.format_exc())
+
+outbox = Outbox(SMS_SEND_CONCURRENCY, SMS_SEND_RATE)
+
+# Shorter ways of saying what BusBot's wordiest texts say (see
+# SMS_SEGMENT_BUDGET and show_help()), as (long, short) pairs, in the order
+# to try them.
+SHORT_FORMS = [
+    ("***Invalid command.*** ", "Invalid command. "),
+    ("Full help: http://", ""),
+    ("Mark status as: IN, OUT, WAIT, ABSENT; otherwise ", "IN, OUT, WAIT, ABSENT, "),
+    ("Bus counters: ", "Counters: "),
+    ("Superuser: ", "Super: "),
+    ("MARK [user, user...|ALL status] AS [status]", "MARK x,y/ALL z AS s"),
+    ("[user]", "x"),
+    (" AS [status]", " AS s"),
+]
+
+# Our responses to Twilio's requests (see reply_twiml()).
+TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response>%s</Response>'
+TWIML_HEADERS = {'Content-Type': 'text/xml'}
+
+def send_msg(trip_id, to_phone, body, bulk=False, still_wanted=None,
+             on_done=None):
+    """
+    Send message /body/ to phone number /phone/ from the number of trip
+    /trip_id/ (or OUR_NUMBER if /trip_id/ is None), in GSM-7 if it can be
+    (see prepare_msg()). The message is only queued
+    here; see Outbox. Pass /bulk/ for messages that are part of a broadcast,
+    which can wait until more pressing messages have been sent, and
+    /still_wanted/ and /on_done/ to keep track of it (see OutboundMessage).
+
+    Texts replying to the message being handled should go back in the
+    response to Twilio instead; see reply_twiml().
+
+    Return the queued OutboundMessage (or None in DEBUG mode).
+    """
+    body = prepare_msg(to_phone, body)
+    if not DEBUG:
+        trip = get_trip(trip_id) if trip_id is not None else None
+        from_phone = (trip and trip['phone']) or OUR_NUMBER
+        message = OutboundMessage(from_phone, to_phone, body, bulk,
+                                  still_wanted, on_done)
+        outbox.put(message)
+        return message
+
+def prepare_msg(to_phone, body):
+    """
+    Return /body/ in GSM-7 if that only takes swapping a few characters (see
+    sms.optimize()), logging that it's being sent to /to_phone/ and counting
+    it in the request's stats. The wording is left alone, since /body/ may
+    be a WALL or other text someone wrote.
+    """
+    body = sms.optimize(body, SMS_SEGMENT_BUDGET)
+    print("==> %s :: %s" % (to_phone, body))
+    stats = current_stats()
+    if stats is not None:
+        stats.sms_count += 1
+        stats.sms_segments += sms.segments(body)
+    return body
+
+def reply_twiml(to_phone, bodies=()):
+    """
+    Return the TwiML for our response to a message from /to_phone/, which has
+    Twilio reply to them with each of /bodies/ as a separate text. This saves
+    sending the replies through the Outbox, which would mean another request
+    to Twilio for each of them. In DEBUG mode, the TwiML is only logged, and
+    the response doesn't reply at all.
+    """
+    messages = ''.join('<Message>%s</Message>' % escape(prepare_msg(to_phone, body))
+                       for body in bodies)
+    if DEBUG and messages:
+        print("TwiML response: %s" % (TWIML % messages))
+        messages = ''
+    return TWIML % messages
+
+
+### Generic helper functions ###
+
+def send_all(trip_id, body, dry_run=False):
+    """
+    Send /body/ to ALL users on the trip. Use with caution. The number of
+    texts and segments this takes and what they'll cost are logged first,
+    and returned as a dictionary; with /dry_run/, nothing is sent.
+    """
+    body = sms.optimize(body, SMS_SEGMENT_BUDGET)
+    phones = get_roster(trip_id).phones()
+    segments = sms.segments(body)
+    projection = {'trip': trip_id,
+                  'recipients': len(phones),
+                  'encoding': sms.encoding(body),
+                  'segments_each': segments,
+                  'segments': segments * len(phones),
+                  'cost': round(segments * len(phones) * SMS_SEGMENT_COST, 4),
+                  'dry_run': dry_run}
+    print(json.dumps(dict(projection, event='broadcast'), sort_keys=True))
+    if not dry_run:
+        for user_phone in phones:
+            send_msg(trip_id, user_phone, body, bulk=True)
+    return projection
+
+def notify_counters(trip_id, body):
+    "Send /body/ to all bus counters of the trip."
+    for counter_phone in get_roster(trip_id).counter_phones():
+        send_msg(trip_id, counter_phone, body)
+
+class CounterDigest:
+    """
+    Notifications for the bus counters that can wait a little, collected for
+    /window/ seconds after the first one on a trip and then sent as a single
+    text, so that ten people texting WAIT as the bus is about to leave cost
+    each counter one text instead of ten. The collected notifications are
+    sent by a timer thread rather than by whichever request came last, and
+    anyone whose status has changed again by then is left out.
+
+    Urgent notifications (like someone getting off the bus after everyone
+    was on it) should go straight to notify_counters() instead.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}  # trip_id -> OrderedDict of phone -> status
+        self._lock = threading.Lock()
+
+    def add(self, user_info, status):
+        "Tell the counters that the user /user_info/ is now /status/."
+        trip_id = user_info['trip_id']
+        if self.window <= 0:
+            self._send(trip_id, {user_info['phone']: status})
+            return
+        with self._lock:
+            pending = self._pending.get(trip_id)
+            if pending is None:
+                pending = self._pending[trip_id] = collections.OrderedDict()
+                timer = threading.Timer(self.window, self.flush,
+                                        [current_app._get_current_object(),
+                                         trip_id])
+                timer.daemon = True
+                timer.start()
+            pending[user_info['phone']] = status
+
+    def flush(self, flask_app, trip_id):
+        "Send the notifications collected for trip /trip_id/ now."
+        with self._lock:
+            pending = self._pending.pop(trip_id, None)
+        if not pending:
+            return
+        try:
+            with flask_app.app_context():
+                self._send(trip_id, pending)
+        except Exception:
+            print("Couldn't notify the counters of trip %s:" % trip_id)
+            print(traceback.format_exc())
+
+    def _send(self, trip_id, pending):
+        roster = get_roster(trip_id)
+        names = collections.OrderedDict()  # status -> display names
+        for phone, status in pending.items():
+            user_info = roster.get(phone)
+            if user_info is not None and user_info['curstatus'] == status:
+                names.setdefault(status, []).append(
+                    get_displayname_from_userinfo(user_info))
+        if names:
+            notify_counters(trip_id, ' '.join(
+                self._describe(status, status_names)
+                for status, status_names in names.items()))
+
+    @staticmethod
+    def _describe(status, names):
+        if status == 'WAIT':
+            return ("%s %s on their way, please hold the bus!"
+                    % (list_names(names), "is" if len(names) == 1 else "are"))
+        return "%s: %s." % (status, list_names(names))
+
+counter_digest = CounterDigest(COUNTER_DIGEST_WINDOW)
+
+def get_user(trip_id, msg_phone):
+    """
+    Return a dictionary with information about the user with given phone on
+    the given trip.
+    """
+    return get_roster(trip_id).get(msg_phone)
+
+def normalize_phone(text):
+    """
+    Return /text/, a US phone number written any which way ("555-123-4567",
+    "+1 (555) 123 4567"), in the form phones are stored in ("+15551234567"),
+    or None if it doesn't look like one.
+    """
+    text = text.strip()
+    if text.startswith('+1') and len(text) == 12:
+        return text
+    digits = ''.join(i for i in text if i not in string.punctuation + ' ')
+    if digits.startswith('1') and len(digits) == 11:
+        digits = digits[1:]
+    return '+1' + digits if len(digits) == 10 else None
+
+def get_displayname(trip_id, firstname, lastname):
     "Determine if user's last name is necessary for disambiguation."
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM users WHERE firstname = %s", (firstname,))
-    if cursor.fetchone()[0] > 1:
+    if get_roster(trip_id).count_firstname(firstname) > 1:
         displayname = "%s %s" % (firstname, lastname)
     else:
         displayname = firstname
     return displayname
 
+def list_names(names):
+    "Return /names/ written out as a list, like 'Ann, Bob, and Carl'."
+    if len(names) > 2:
+        return "%s, and %s" % (', '.join(names[:-1]), names[-1])
+    return " and ".join(names)
+
 def get_displayname_from_userinfo(userinfo):
-    return get_displayname(userinfo['firstname'], userinfo['lastname'])
+    return get_displayname(userinfo['trip_id'], userinfo['firstname'],
+                           userinfo['lastname'])
 
 def is_buscounter(user_info):
     return user_info['iscounter']
 
+def get_superuser(trip_id):
+    "Return the phone number of the superuser of trip /trip_id/."
+    trip = get_trip(trip_id) if trip_id is not None else None
+    return (trip and trip['superuser']) or SUPERUSER
+
 def is_superuser(user_info):
-    return user_info['phone'] == SUPERUSER
+    return user_info['phone'] == get_superuser(user_info['trip_id'])
 
 # The superuser may want to have bus counter *privileges* without actually
 # receiving all the notifications destined for bus counters.
 def has_buscounter_privileges(user_info):
     return is_buscounter(user_info) or is_superuser(user_info)
 
-def set_status_bit(bit, value):
-    """
-    Set a status bit to a given value.
-
-    Status bits are stored as columns of a single row of the 'status' table.
-    The recreate_database.py script needs to be changed if more bits are added,
-    since the database schema will be changing.
+# The status table also keeps a tally of how many users of each trip have each
+# status, in a column named after the status (n_in, n_out, and so on). Every
+# change to users.curstatus has to adjust the tallies in the same transaction,
+# which set_user_statuses() in schema.py does.
+def status_count_column(status):
+    assert status in Roster.STATUSES, "Whoops! That status doesn't exist!"
+    return 'n_' + status.lower()
 
-    Right now the only status bit is 'all_in', which means that all the users
-    have marked themselves IN or ABSENT at the present moment (this lets BusBot
-    notify the bus counters when someone marks themself OUT in only the case
-    that everyone was previously IN).
+def check_global_status(trip_id):
     """
-    if bit == 'all_in':
-        query = 'UPDATE status SET all_in = %s'
-        params = (value,)
-    else:
-        assert False, "Whoops! That status bit doesn't exist!"
-    cursor = db_conn.cursor()
-    cursor.execute(query, params)
-    db_conn.commit()
-
-def get_status_bit(bit):
-    "Get the value of a status bit (see set_status_bit())."
-    cursor = db_conn.cursor()
-    if bit == 'all_in':
-        query = 'SELECT all_in FROM status LIMIT 1'
-    else:
-        assert False, "Whoops! That status bit doesn't exist!"
-    cursor.execute(query)
-    return cursor.fetchone()[0]
-
-def check_global_status():
-    """
-    Function called every time BusBot receives a message to do housekeeping and
-    check if certain states now obtain.
-    """
-    if not find_missing() and not get_status_bit('all_in'):
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE curstatus = 'ABSENT'")
-        not_riding = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE curstatus = 'IN'")
-        headcount = cursor.fetchone()[0]
-        notify_counters("Everyone is now marked as IN or ABSENT. %s total "
-                        "people, %s NOTRIDING. Head count should be %s."
-                        % (total, not_riding, headcount))
-        set_status_bit('all_in', True)
-
-def parse_user_selector(selector):
-    """
-    Parse string /selector/ as a phone number, first name, or first&last name.
-    Return an error string on failure or a user dictionary on success.
-    """
-    def name_split_possibilities(userstring):
-        """
-        Generator for all the possible ways to split a name on spaces, so we
-        can match names like "Vincent van Gogh" or "Mary Kate Smith" without
-        having to worry if the part in the middle is part of the first or the
-        last name. (If this creates ambiguity, so be it, it would be too
-        confusing to use anything but the phone number for selection anyway.)
-
-        Generator is empty if there are no spaces in userstring.
-        """
-        parts = userstring.split(' ')
-        if len(parts) == 1:
-            return
-        for spliton in range(len(userstring) + 1):
-            yield ' '.join(parts[:spliton]), ' '.join(parts[spliton:])
-
-    cursor = db_conn.cursor()
+    Set the trip's all_in bit if nobody is missing any more but it isn't set
+    yet, and tell the counters if so. Status changes do this by themselves
+    (see mark_users()); this is for after the tallies have been fixed.
+    """
+    cursor = get_db().cursor()
+    cursor.execute("""UPDATE status SET all_in = true
+                      WHERE trip_id = %s AND NOT all_in
+                            AND n_unset + n_out + n_wait = 0
+                      RETURNING n_in, n_absent""", (trip_id,))
+    row = cursor.fetchone()
+    get_db().commit()
+    if row is not None:
+        notify_all_in(trip_id, *row)
+
+def notify_all_in(trip_id, headcount, not_riding):
+    "Tell the counters that everyone is now IN or ABSENT."
+    notify_counters(trip_id,
+                    "Everyone is now marked as IN or ABSENT. %s total "
+                    "people, %s NOTRIDING. Head count should be %s."
+                    % (headcount + not_riding, not_riding, headcount))
+
+def parse_user_selector(trip_id, selector):
+    """
+    Parse string /selector/ as a phone number, first name, or first&last name
+    of someone on trip /trip_id/. Return an error string on failure or a user
+    dictionary on success.
+
+    If nothing matches exactly, we accept a selector that's someone's whole
+    first name and the beginning of their last name (like "ann l" or "mary
+    kate s"), as long as only one person fits. Anything shorter that begins
+    someone's name (like "b") only gets them suggested, since acting on
+    whoever happened to match could MARK or PROMOTE the wrong person.
+    Failing that, we suggest names that look like what was typed.
+    """
+    roster = get_roster(trip_id)
+    selector = ' '.join(selector.split())
 
     ## First attempt: phone number
-    if selector.startswith('+1') and len(selector) == 12:
-        possible_phonenum = selector
-    else:
-        possible_phonenum = '+1' + ''.join(i for i in selector
-                                           if i not in string.punctuation + ' ')
-    if len(possible_phonenum) == 12:
-        cursor.execute("SELECT phone FROM users WHERE phone = %s",
-                       (possible_phonenum,))
-        found = cursor.fetchone()
+    possible_phonenum = normalize_phone(selector)
+    if possible_phonenum is not None:
+        found = roster.get(possible_phonenum)
         if found:
-            return get_user(found[0]) # success
+            return found # success
 
     ## Second attempt: first name
-    cursor.execute("""SELECT firstname, lastname, phone
-                      FROM users WHERE LOWER(firstname) = %s""", (selector,))
-    results = cursor.fetchall()
+    results = roster.find_by_firstname(selector)
     if len(results) == 1:
-        return get_user(results[0][2]) # success
+        return results[0] # success
     elif len(results):
-        possibles = [' '.join(i[0:2]) for i in results]
+        possibles = ["%s %s" % (i['firstname'], i['lastname']) for i in results]
         msg = "Person ambiguous; did you mean one of: " + ", ".join(possibles)
         return msg # failure
 
     ## Third attempt: first and last name
-    for firstname, lastname in name_split_possibilities(selector):
-        cursor.execute("""SELECT firstname, lastname, phone
-                          FROM users
-                          WHERE LOWER(firstname) = %s
-                                AND LOWER(lastname) = %s""",
-                       (firstname, lastname))
-        results = cursor.fetchall()
-        if len(results) == 1:
-            return get_user(results[0][2]) # success
+    # The roster matches the whole name at once, so names like "Vincent van
+    # Gogh" or "Mary Kate Smith" work without our having to worry whether the
+    # part in the middle is part of the first or the last name. (If this
+    # creates ambiguity, so be it, it would be too confusing to use anything
+    # but the phone number for selection anyway.)
+    results = roster.find_by_fullname(selector)
+    if len(results) == 1:
+        return results[0] # success
+    elif len(results):
+        # failure
+        return ("There appear to be two people by that name in the "
+                "database. Please use the person's phone number.")
+
+    ## Fourth attempt: a first name and the beginning of a last name
+    if selector:
+        results = roster.find_by_fullname_prefix(selector)
+        typed = selector.lower()
+        whole = [i for i in results if len(typed)
+                 > len(' '.join(i['firstname'].lower().split())) + 1]
+        possibles = ["%s %s" % (i['firstname'], i['lastname'])
+                     for i in (whole or results)[:5]]
+        if len(whole or results) > 5:
+            possibles.append("...")
+        if len(whole) == 1:
+            return whole[0] # success
+        elif len(whole):
+            msg = "Person ambiguous; did you mean one of: " + ", ".join(possibles)
+            return msg # failure
         elif len(results):
-            # failure
-            return ("There appear to be two people by that name in the "
-                    "database. Please use the person's phone number.")
-
+            # failure: too little to go on
+            return ("Sorry, I couldn't work out who you meant. Did you mean: "
+                    "%s? (Use at least their first name and last initial.)"
+                    % " or ".join(possibles))
+
+    ## Give up, but suggest names in case of a typo
+    names = roster.names()
+    close = difflib.get_close_matches(selector, names, n=3)
+    if close:
+        suggestions = []
+        for name in close:
+            if names[name] not in suggestions:
+                suggestions.append(names[name])
+        return ("Sorry, I couldn't work out who you meant. Did you mean: %s?"
+                % " or ".join(suggestions))
     return ("Sorry, I couldn't work out who you meant. I understand 10-digit "
             "phone numbers, first names, and first&last names.")
 
 
 ### Changing a user's status ###
-def mark_user(user_info, status):
+def mark_user(user_info, status, actor=None):
     """
-    Set a user's status to a value in the database. Don't call this function by
+    Set a user's status to a value in the database. /actor/ is the user making
+    the change, if it's not the user themself. Don't call this function by
     itself -- use the helper functions below, since they sometimes take other
-    actions as well.
+    actions as well. Returns whether everyone was IN or ABSENT before (see
+    mark_users()).
     """
-    cursor = db_conn.cursor()
-    cursor.execute("UPDATE users SET curstatus = %s WHERE phone = %s",
-                   (status, user_info['phone']))
-    db_conn.commit()
-    print("Marked user %s as %s." % (user_info['firstname'], status))
+    return mark_users([user_info], status, actor or user_info)
 
-def mark_user_in(user_info):
-    mark_user(user_info, 'IN')
+def mark_users(users, status, actor):
+    """
+    Set the status of every user in /users/ (who must all be on the same
+    trip) to /status/ in a single statement, on behalf of the user /actor/.
+    If that means everyone is now IN or ABSENT, the counters are told;
+    otherwise, like mark_user(), this does nothing but change the status.
+
+    Return whether everyone was IN or ABSENT before the change.
+    """
+    trip_id = users[0]['trip_id']
+    try:
+        old_statuses, trip_status = set_user_statuses(
+            get_db().cursor(), trip_id,
+            [user_info['phone'] for user_info in users], status)
+        get_db().commit()
+    except psycopg2.Error as e:
+        if not lost_database(e) or not snapshot.enabled:
+            raise
+        return mark_users_offline(users, status, actor)
+    if trip_status is None:
+        return False
+
+    roster = get_roster(trip_id)
+    for user_info in users:
+        if user_info['phone'] in old_statuses:
+            roster.set_status(user_info['phone'], status)
+            event_log.record(user_info, status,
+                             old_statuses[user_info['phone']], actor)
+            print("Marked user %s as %s." % (user_info['firstname'], status))
+    if trip_status['all_in'] and not trip_status['was_all_in']:
+        notify_all_in(trip_id, trip_status['IN'], trip_status['ABSENT'])
+    return trip_status['was_all_in']
+
+def mark_users_offline(users, status, actor):
+    """
+    mark_users() for when the database is unreachable: make the change in the
+    roster (and so the snapshot), and add it to the snapshot's journal to be
+    replayed into the database later (see DatabaseFailover).
+    """
+    trip_id = users[0]['trip_id']
+    roster = get_roster(trip_id)
+    was_all_in = roster.count(*Roster.LISTINGS['missing']) == 0
+    snapshot.journal(trip_id, [user_info['phone'] for user_info in users],
+                     status, time.time(), actor['uid'])
+    for user_info in users:
+        current = roster.get(user_info['phone'])
+        if current is not None:
+            roster.set_status(user_info['phone'], status)
+            event_log.record(user_info, status, current['curstatus'], actor)
+            print("Marked user %s as %s (offline)."
+                  % (user_info['firstname'], status))
+    if not was_all_in and roster.count(*Roster.LISTINGS['missing']) == 0:
+        notify_all_in(trip_id, roster.count('IN'), roster.count('ABSENT'))
+    return was_all_in
+
+def replay_journal(conn):
+    """
+    Make the status changes in the snapshot's journal (see DatabaseFailover)
+    in the database /conn/, and take them out of the journal. As with
+    receive_checkins(), the latest change to each person wins, so a change
+    older than one made in the database since (by a worker that could still
+    reach it, say) is left out; the trip's superuser is told whose were.
+    """
+    entries = snapshot.journaled()
+    if not entries:
+        return
+    latest = {}  # (trip_id, phone) -> (at, seq, status)
+    for seq, trip_id, phone, status, at, actor in entries:
+        if latest.get((trip_id, phone), ()) < (at, seq):
+            latest[trip_id, phone] = (at, seq, status)
+    changes = collections.defaultdict(list)  # (trip_id, status) -> phone, at
+    for (trip_id, phone), (at, seq, status) in latest.items():
+        changes[trip_id, status].append(
+            (phone, datetime.datetime.fromtimestamp(at, datetime.timezone.utc)))
+
+    cursor = conn.cursor()
+    replayed = collections.Counter()  # trip_id -> how many
+    conflicts = collections.defaultdict(list)  # trip_id -> phones
+    for trip_id, status in sorted(changes, key=lambda i: (
+            i[0], CHECKIN_STATUSES.index(i[1]))):
+        phones = [phone for phone, _ in changes[trip_id, status]]
+        changed, _ = set_user_statuses(
+            cursor, trip_id, phones, status,
+            [at for _, at in changes[trip_id, status]])
+        for phone in phones:
+            if phone in changed:
+                replayed[trip_id] += 1
+            else:
+                conflicts[trip_id].append(phone)
+    conn.commit()
+    snapshot.forget(entries[-1][0])
+
+    for trip_id in sorted(set(replayed) | set(conflicts)):
+        print(json.dumps({'event': 'replay', 'trip': trip_id,
+                          'replayed': replayed[trip_id],
+                          'conflicts': conflicts[trip_id]}, sort_keys=True))
+        metrics.inc('busbot_journal_replayed_total', {'result': 'replayed'},
+                    replayed[trip_id])
+        metrics.inc('busbot_journal_replayed_total', {'result': 'conflict'},
+                    len(conflicts[trip_id]))
+        if conflicts[trip_id]:
+            # We and the snapshot still have the statuses that lost.
+            roster = get_trips().roster(trip_id)
+            cursor.execute("""SELECT phone, curstatus FROM users
+                              WHERE trip_id = %s AND phone = ANY(%s)""",
+                           (trip_id, conflicts[trip_id]))
+            for phone, status in cursor.fetchall():
+                roster.set_status(phone, status)
+            conn.commit()
+            names = []
+            for phone in conflicts[trip_id]:
+                user_info = roster.get(phone)
+                names.append(get_displayname_from_userinfo(user_info)
+                             if user_info is not None else phone)
+            send_msg(trip_id, get_superuser(trip_id),
+                     "While BusBot couldn't reach its database, %s changed "
+                     "status here, but the database has a newer status for "
+                     "them, which was kept." % list_names(names))
+
+def set_user_statuses(cursor, trip_id, phones, status, times=None):
+    """
+    Set the status of the users of trip /trip_id/ with the phone numbers
+    /phones/ to /status/, without committing (see set_user_statuses() in
+    schema.py). /times/, if given, are when each of them changed status;
+    anyone whose status has changed since is left alone.
+
+    Return a dictionary mapping the phone number of each user changed to
+    their old status, and a dictionary of the trip's tally of each status
+    afterwards plus 'all_in' and 'was_all_in' (or None if nobody changed).
+    """
+    cursor.execute("SELECT * FROM set_user_statuses(%s, %s, %s, %s)",
+                   (trip_id, phones, status, times))
+    rows = cursor.fetchall()
+    if not rows:
+        return {}, None
+    trip_status = dict(zip(('was_all_in', 'all_in', 'UNSET', 'IN', 'OUT',
+                            'WAIT', 'ABSENT'), rows[0][2:]))
+    return dict((row[0], row[1]) for row in rows), trip_status
+
+def mark_user_in(user_info, actor=None):
+    mark_user(user_info, 'IN', actor)
     return None
 
-def mark_user_out(user_info):
-    mark_user(user_info, 'OUT')
+def mark_user_out(user_info, actor=None):
     # If everyone *was* on the bus, but this person just got off,
     # a warning is in order.
-    if get_status_bit('all_in'):
-        notify_counters("WARNING: %s marked themselves OUT. Don't leave yet!"
+    if mark_user(user_info, 'OUT', actor):
+        notify_counters(user_info['trip_id'],
+                        "WARNING: %s marked themselves OUT. Don't leave yet!"
                         % get_displayname_from_userinfo(user_info))
-    set_status_bit('all_in', False)
     return "You have been marked as OUT and may safely step off the bus."
 
-def mark_user_absent(user_info):
-    mark_user(user_info, 'ABSENT')
+def mark_user_absent(user_info, actor=None):
+    mark_user(user_info, 'ABSENT', actor)
     return None
 
-def mark_user_wait(user_info):
-    mark_user(user_info, 'WAIT')
-    notify_counters("%s is on their way, please hold the bus!"
-                    % get_displayname_from_userinfo(user_info))
-    set_status_bit('all_in', False)
+def mark_user_wait(user_info, actor=None):
+    mark_user(user_info, 'WAIT', actor)
+    counter_digest.add(user_info, 'WAIT')
     return None
 
 def get_user_status(user_info):
@@ -275,16 +1752,17 @@ def get_user_status(user_info):
         return "You are currently marked as %s. Reply IN, OUT, WAIT, or ABSENT to change." % user_info['curstatus']
 
 def markas(user_info, msg_command):
-    "Set another user as checked in."
+    """
+    Set the status of another user, or (for bus counters) of several at once:
+    either a list of users separated by commas, or ALL to mean everyone, or
+    ALL and a status to mean everyone who has that status.
+    """
 
     def set_other(setter, settee, status):
-        status = status.upper()
-        if status not in ('IN', 'OUT', 'ABSENT', 'WAIT'):
-            return "You may only mark someone as IN, OUT, ABSENT, or WAIT."
         {'IN': mark_user_in, 'OUT': mark_user_out,
          'ABSENT': mark_user_absent, 'WAIT': mark_user_wait
-        }[status](settee)
-        send_msg(settee['phone'], "Notice: %s marked you as %s."
+        }[status](settee, setter)
+        send_msg(settee['trip_id'], settee['phone'], "Notice: %s marked you as %s."
                  % (get_displayname_from_userinfo(setter), status))
 
         if status == 'OUT':
@@ -295,33 +1773,134 @@ def markas(user_info, msg_command):
     try:
         body = msg_command.lower().split('mark ', 1)[1].strip()
         user, status = (i.strip() for i in body.split(' as '))
-    except ValueError:
+    except (ValueError, IndexError):
         return ("Sorry, I'm not sure what you meant. Use MARK user AS status, "
                 "where user is a phone, first name, or first&last name.")
+    status = status.upper()
+    if status not in ('IN', 'OUT', 'ABSENT', 'WAIT'):
+        return "You may only mark someone as IN, OUT, ABSENT, or WAIT."
+
+    trip_id = user_info['trip_id']
+    selectors = [i.strip() for i in user.split(',') if i.strip()]
+    everyone = user.upper().split()
+    if everyone and everyone[0] == 'ALL' and (
+            len(everyone) == 1
+            or (len(everyone) == 2 and everyone[1] in Roster.STATUSES)):
+        if not has_buscounter_privileges(user_info):
+            return "Only bus counters can mark more than one person at a time."
+        settees = get_roster(trip_id).with_status(*(everyone[1:]
+                                                    or Roster.STATUSES))
+        if not settees:
+            return ("Nobody is marked as %s." % everyone[1] if everyone[1:]
+                    else "There's nobody on the roster to mark.")
+    elif len(selectors) > 1:
+        if not has_buscounter_privileges(user_info):
+            return "Only bus counters can mark more than one person at a time."
+        settees = []
+        errors = []
+        for selector in selectors:
+            user_or_error = parse_user_selector(trip_id, selector)
+            if isinstance(user_or_error, dict): # user
+                settees.append(user_or_error)
+            else: # error
+                errors.append("%s: %s" % (selector, user_or_error))
+        if errors:
+            return "Nobody was marked. " + " ".join(errors)
+    else:
+        user_or_error = parse_user_selector(trip_id, user)
+        if isinstance(user_or_error, dict): # user
+            return set_other(user_info, user_or_error, status)
+        else: # error
+            return user_or_error
+
+    return mark_many(user_info, settees, status)
 
-    user_or_error = parse_user_selector(user)
-    if isinstance(user_or_error, dict): # user
-        return set_other(user_info, user_or_error, status)
-    else: # error
-        return user_or_error
+# How many names to list when confirming that many people were marked.
+MAX_MARKED_NAMES_SHOWN = 15
+
+def mark_many(setter, settees, status):
+    """
+    Mark all the users in /settees/ as /status/ on behalf of the bus counter
+    /setter/, in a single transaction, and tell each of them so. Return the
+    confirmation for the counter.
+    """
+    trip_id = setter['trip_id']
+    unique = collections.OrderedDict((settee['phone'], settee)
+                                     for settee in settees)
+    settees = [settee for settee in unique.values()
+               if settee['curstatus'] != status]
+    already = len(unique) - len(settees)
+    if not settees:
+        return ("%s already marked as %s."
+                % ("They're all" if already > 1 else "They're", status))
+
+    was_all_in = mark_users(settees, status, setter)
+    names = [get_displayname_from_userinfo(settee) for settee in settees]
+    if status == 'OUT' and was_all_in:
+        warn_marked_out(setter, names)
+    if status == 'WAIT':
+        for settee in settees:
+            counter_digest.add(settee, 'WAIT')
+
+    notice = ("Notice: %s marked you as %s."
+              % (get_displayname_from_userinfo(setter), status))
+    for settee in settees:
+        send_msg(trip_id, settee['phone'], notice, bulk=True)
+
+    if len(names) <= MAX_MARKED_NAMES_SHOWN:
+        reply = "Marked %s as %s." % (list_names(names), status)
+    else:
+        reply = "Marked %i people as %s." % (len(names), status)
+    if already:
+        reply += " (%i %s already %s.)" % (already,
+                                          "was" if already == 1 else "were",
+                                          status)
+    if status == 'OUT':
+        reply += " They may safely step off the bus."
+    return reply
+
+def warn_marked_out(setter, names):
+    """
+    Warn the counters that the bus counter /setter/ marked the people called
+    /names/ OUT after everyone was on the bus.
+    """
+    notify_counters(setter['trip_id'],
+                    "WARNING: %s marked %s OUT. Don't leave yet!"
+                    % (get_displayname_from_userinfo(setter),
+                       list_names(names)
+                       if len(names) <= MAX_MARKED_NAMES_SHOWN
+                       else "%i people" % len(names)))
 
 ### Bus counter commands ###
-def reset_status_generic(user_info):
+def reset_status_generic(trip_id, actor=None):
     """
-    The part of resetting that happens regardless of whether it's a hard or
-    soft reset.
+    The part of resetting a trip that happens regardless of whether it's a
+    hard or soft reset. /actor/ is the user who asked for the reset, if any.
     """
-    cursor = db_conn.cursor()
-    cursor.execute("UPDATE users SET curstatus = 'UNSET'")
-    db_conn.commit()
-    set_status_bit('all_in', False)
+    changed = get_roster(trip_id).with_status('IN', 'OUT', 'WAIT', 'ABSENT')
+    cursor = get_db().cursor()
+    # Lock the tallies before the users, like set_user_statuses() does, so
+    # that a reset and a status change at the same time can't deadlock.
+    cursor.execute("SELECT 1 FROM status WHERE trip_id = %s FOR UPDATE",
+                   (trip_id,))
+    cursor.execute("""UPDATE users SET curstatus = 'UNSET', status_at = now()
+                      WHERE trip_id = %s""", (trip_id,))
+    cursor.execute("UPDATE status SET all_in = False, %s, n_unset = %%s "
+                   "WHERE trip_id = %%s"
+                   % ', '.join("%s = 0" % status_count_column(i)
+                               for i in Roster.STATUSES if i != 'UNSET'),
+                   (cursor.rowcount, trip_id))
+    get_db().commit()
+    get_roster(trip_id).set_all_statuses('UNSET')
+    for changed_user in changed:
+        event_log.record(changed_user, 'UNSET', changed_user['curstatus'], actor)
 
 def soft_reset(user_info):
     "Reset all users' statuses to UNSET and notify bus counters."
     if not has_buscounter_privileges(user_info):
         return "Only bus counters can reset the count."
-    reset_status_generic(user_info)
-    notify_counters("Bus counts have been reset.")
+    reset_status_generic(user_info['trip_id'], user_info)
+    notify_counters(user_info['trip_id'], "Bus counts have been reset.")
 
 def hard_reset(user_info):
     """
@@ -330,52 +1909,168 @@ def hard_reset(user_info):
     """
     if not has_buscounter_privileges(user_info):
         return "Only bus counters can reset the count."
-    reset_status_generic(user_info)
-    send_all("Sorry, we got mixed up! If you checked in already, please do so again.")
-    notify_counters("Bus counts have been hard-reset. Be more careful next time!")
-
-def find_missing():
-    "Return a list of people who are not marked as ABSENT or IN."
-    # NOTE: Make sure user is a counter before calling this function!
-    cursor = db_conn.cursor()
-    cursor.execute("""SELECT firstname, lastname, phone, curstatus
-                      FROM users WHERE curstatus NOT IN ('ABSENT', 'IN')""")
-    people = []
-    for i in cursor.fetchall():
-        firstname, lastname, phone, curstatus = i
-        displayname = get_displayname(firstname, lastname)
-        people.append((displayname, phone, curstatus))
-    return people
+    reset_status_generic(user_info['trip_id'], user_info)
+    send_all(user_info['trip_id'],
+             "Sorry, we got mixed up! If you checked in already, please do so again.")
+    notify_counters(user_info['trip_id'],
+                    "Bus counts have been hard-reset. Be more careful next time!")
 
 def list_missing(user_info):
     """
-    Format the find_missing() list and send it to the bus counter requesting
-    it.
+    Send the bus counter requesting it the list of people who are missing,
+    in as few texts as they fit in.
     """
     if not has_buscounter_privileges(user_info):
         return "Only bus counters can see who's missing."
-    missing = find_missing()
+    missing = get_roster(user_info['trip_id']).listing('missing')
     if not missing:
         return "Everyone is marked as on the bus or not riding."
-    if len(missing) > 15:
-        return "%i people are still missing. (When 15 or fewer are missing, they will be listed by name.)" % len(missing)
-    else:
-        return '; '.join("%s - %s" % (i[0], i[2]) for i in missing)
+    return sms.pack_texts(missing, '; ', max_texts=LIST_MAX_TEXTS)
 
 def ping_missing(user_info):
     """
-    Send a text to everyone in the find_missing() list asking them to set their
-    status.
+    Text everyone who's missing asking them to set their status, apart from
+    anyone another PING has reached in the last PING_REPEAT_AFTER seconds.
+    The texts are sent as a PingRound, which tells the counter how it went.
     """
     if not has_buscounter_privileges(user_info):
         return "Only bus counters can ping missing people."
-    missing = find_missing()
+    trip_id = user_info['trip_id']
+    missing = get_roster(trip_id).with_status(*Roster.LISTINGS['missing'])
     if not missing:
-        send_msg(user_info['phone'], "Everybody is marked as on the bus or not riding!")
-        return
-    notify_counters("Ping sent to all %i missing people." % len(missing))
-    for displayname, phone, curstatus in missing:
-        send_msg(phone, "Hey, the bus counters are looking for you! Please reply IN (I'm on the bus and forgot to check in), WAIT (I'm on my way), or ABSENT (I'm not riding the bus).")
+        return "Everybody is marked as on the bus or not riding!"
+
+    cursor = get_db().cursor()
+    # Lock the trip's status row so that two counters PINGing at once can't
+    # both text the same people.
+    cursor.execute("SELECT 1 FROM status WHERE trip_id = %s FOR UPDATE",
+                   (trip_id,))
+    cursor.execute("""SELECT DISTINCT r.uid
+                      FROM ping_rounds p JOIN ping_recipients r USING (round_id)
+                      WHERE p.trip_id = %s AND r.status IN ('queued', 'sent')
+                            AND p.started_at > now() - %s * interval '1 second'""",
+                   (trip_id, PING_REPEAT_AFTER))
+    reached = set(uid for uid, in cursor.fetchall())
+    targets = [i for i in missing if i['uid'] not in reached]
+    if not targets:
+        get_db().commit()
+        return ("Everyone missing has been PINGed in the last %i minutes. "
+                "Give them a little longer to answer!" % (PING_REPEAT_AFTER // 60))
+    cursor.execute("""INSERT INTO ping_rounds (trip_id, started_by)
+                      VALUES (%s, %s) RETURNING round_id""",
+                   (trip_id, user_info['uid']))
+    round_id = cursor.fetchone()[0]
+    psycopg2.extras.execute_values(
+        cursor, "INSERT INTO ping_recipients (round_id, uid) VALUES %s",
+        [(round_id, i['uid']) for i in targets])
+    get_db().commit()
+
+    if len(targets) == len(missing):
+        notify_counters(trip_id, "Ping sent to all %i missing people." % len(targets))
+    else:
+        notify_counters(trip_id, "Ping sent to %i missing people; %i more were "
+                                 "PINGed in the last %i minutes."
+                        % (len(targets), len(missing) - len(targets),
+                           PING_REPEAT_AFTER // 60))
+    PingRound(current_app._get_current_object(), round_id, user_info,
+              targets).send()
+
+PING_TEXT = ("Hey, the bus counters are looking for you! Please reply IN (I'm "
+             "on the bus and forgot to check in), WAIT (I'm on my way), or "
+             "ABSENT (I'm not riding the bus).")
+
+class PingRound:
+    """
+    The texts sent by one PING (/round_id/ in the ping_rounds table) from the
+    counter /counter/ to the users /targets/. They go out through the Outbox
+    with the other bulk texts, except to people who are no longer missing
+    when their turn comes. Once every text has been sent, failed, or been
+    skipped, what happened to each is saved in ping_recipients and the
+    counter is sent a summary.
+    """
+    def __init__(self, flask_app, round_id, counter, targets):
+        self.flask_app = flask_app
+        self.round_id = round_id
+        self.counter = counter
+        self.trip_id = counter['trip_id']
+        self.targets = collections.OrderedDict(
+            (user_info['phone'], user_info) for user_info in targets)
+        self.results = {}  # phone -> status of the text to them
+        self._lock = threading.Lock()
+
+    def send(self):
+        for phone in list(self.targets):
+            message = send_msg(self.trip_id, phone, PING_TEXT, bulk=True,
+                               still_wanted=self._still_missing,
+                               on_done=self._done)
+            if message is None:  # DEBUG mode, nothing is really sent
+                self._record(phone, 'sent')
+
+    def _still_missing(self, message):
+        with self.flask_app.app_context():
+            user_info = get_roster(self.trip_id).get(message.to_phone)
+        return (user_info is not None
+                and user_info['curstatus'] in Roster.LISTINGS['missing'])
+
+    def _done(self, message):
+        self._record(message.to_phone, message.status)
+
+    def _record(self, phone, status):
+        user_info = self.targets[phone]
+        if status == 'sent':
+            event_log.record(user_info, 'PINGED', user_info['curstatus'],
+                             self.counter)
+        with self._lock:
+            self.results[phone] = status
+            finished = len(self.results) == len(self.targets)
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        try:
+            if has_request_context():
+                # In DEBUG mode, every text is "sent" during the PING's own
+                # request, which already has a connection; waiting on the
+                # pool for a second one could deadlock a busy worker.
+                self._save(get_db())
+                self._report()
+                return
+            with self.flask_app.app_context():
+                conn = get_db_pool().checkout()
+                try:
+                    self._save(conn)
+                finally:
+                    get_db_pool().checkin(conn)
+                self._report()
+        except Exception:
+            print("Couldn't finish ping round %s:" % self.round_id)
+            print(traceback.format_exc())
+
+    def _save(self, conn):
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(
+            cursor, """UPDATE ping_recipients r SET status = v.status
+                       FROM (VALUES %s) AS v (round_id, uid, status)
+                       WHERE r.round_id = v.round_id AND r.uid = v.uid""",
+            [(self.round_id, self.targets[phone]['uid'], status)
+             for phone, status in self.results.items()])
+        cursor.execute("""UPDATE ping_rounds SET finished_at = now()
+                          WHERE round_id = %s""", (self.round_id,))
+        conn.commit()
+
+    def _report(self):
+        by_status = collections.defaultdict(list)
+        for phone, user_info in self.targets.items():
+            by_status[self.results[phone]].append(
+                get_displayname_from_userinfo(user_info))
+        parts = ["PING done: texted %i of %i."
+                 % (len(by_status['sent']), len(self.targets))]
+        if by_status['skipped']:
+            parts.append("%i answered before their text went out."
+                         % len(by_status['skipped']))
+        if by_status['failed']:
+            parts.append("Couldn't text %s." % list_names(by_status['failed']))
+        send_msg(self.trip_id, self.counter['phone'], ' '.join(parts))
 
 def show_absent(user_info):
     """
@@ -384,25 +2079,54 @@ def show_absent(user_info):
     """
     if not has_buscounter_privileges(user_info):
         return "Only bus counters can list absent people."
-    cursor = db_conn.cursor()
-    cursor.execute("""SELECT firstname, lastname
-                      FROM users WHERE curstatus = 'ABSENT'""")
-    people = []
-    for i in cursor.fetchall():
-        firstname, lastname = i
-        displayname = get_displayname(firstname, lastname)
-        people.append(displayname)
+    people = get_roster(user_info['trip_id']).listing('absent')
     if people:
-        return 'Absent: ' + ', '.join(people)
+        return sms.pack_texts(people, ', ', 'Absent: ', LIST_MAX_TEXTS)
     else:
         return 'Nobody is currently marked as absent.'
 
+def recount(user_info):
+    """
+    Recompute the status tallies kept in the status table (see
+    mark_users()) from the users table, fixing and reporting any
+    that were wrong. BusBot keeps them right by itself, but changing someone's
+    status by hand in the database will throw them off.
+    """
+    if not has_buscounter_privileges(user_info):
+        return "Only bus counters can recount."
+    trip_id = user_info['trip_id']
+    cursor = get_db().cursor()
+    # Lock the tallies first so nobody can change them while we count.
+    cursor.execute("SELECT %s FROM status WHERE trip_id = %%s FOR UPDATE"
+                   % ', '.join(status_count_column(i) for i in Roster.STATUSES),
+                   (trip_id,))
+    stored = dict(zip(Roster.STATUSES, cursor.fetchone()))
+    cursor.execute("""SELECT curstatus, COUNT(*) FROM users WHERE trip_id = %s
+                      GROUP BY curstatus""", (trip_id,))
+    actual = dict.fromkeys(Roster.STATUSES, 0)
+    actual.update(cursor.fetchall())
+    cursor.execute("UPDATE status SET %s WHERE trip_id = %%s"
+                   % ', '.join("%s = %i" % (status_count_column(i), actual[i])
+                               for i in Roster.STATUSES),
+                   (trip_id,))
+    get_db().commit()
+    check_global_status(trip_id)
+
+    drifted = ["%s %i (was %i)" % (i, actual[i], stored[i])
+               for i in Roster.STATUSES if actual[i] != stored[i]]
+    if drifted:
+        return "Fixed counts: " + ', '.join(drifted) + "."
+    else:
+        return "Counts are correct: " + ', '.join(
+            "%s %i" % (i, actual[i]) for i in Roster.STATUSES) + "."
+
 
 ### Miscellaneous ###
 def show_help(user_info, was_failure=False):
     """
     Send a help message to the user who requested it or typed an invalid
-    command, showing all commands the user has permissions to use.
+    command, showing all commands the user has permissions to use, in as
+    few segments as SHORT_FORMS can get it down to.
     """
     if was_failure:
         send_body = "***Invalid command.*** "
@@ -410,11 +2134,11 @@ def show_help(user_info, was_failure=False):
         send_body = ""
     send_body += "Mark status as: IN, OUT, WAIT, ABSENT; otherwise STATUS, WHOIS [user], WHOAMI, MARK [user] AS [status]. "
     if has_buscounter_privileges(user_info):
-        send_body += "Bus counters: LIST, PING, NOTRIDING, RESET, HARDRESET. "
+        send_body += "Bus counters: LIST, PING, NOTRIDING, RESET, HARDRESET, RECOUNT, MARK [user, user...|ALL status] AS [status]. "
     if is_superuser(user_info):
-        send_body += "Superuser: WALL, PROMOTE, DEMOTE. "
+        send_body += "Superuser: WALL, WALLCOST, PROMOTE, DEMOTE. "
     send_body += "Full help: http://goo.gl/CsTLwM"
-    return send_body
+    return sms.optimize(send_body, SMS_SEGMENT_BUDGET, SHORT_FORMS)
 
 def whoami(user_info):
     """
@@ -435,7 +2159,7 @@ def whois(user_info, msg_command):
         selector = msg_command.lower().split('whois ', 1)[1].strip()
     except IndexError:
         return "Usage: WHOIS [user], where user is a phone number, first name, or first&last name."
-    user_to_find = parse_user_selector(selector)
+    user_to_find = parse_user_selector(user_info['trip_id'], selector)
     if isinstance(user_to_find, dict): # returned success
         return whoami(user_to_find)
     else: # not found, error message
@@ -447,43 +2171,58 @@ def wall(user_info, msg_command):
         return "Only the superuser may use WALL (send message to all users)."
 
     body = msg_command[5:]
-    send_all(body)
+    send_all(user_info['trip_id'], body)
 
-def mod_bus_counter_privileges(user_selector, will_be_counter):
+def wall_cost(user_info, msg_command):
     """
-    Promote or demote a user to/from bus counter privileges. Call this function
-    through promote_user() or demote_user().
+    Say what sending a message to everyone with WALL would cost, without
+    sending it; only usable by superuser.
+    """
+    if not is_superuser(user_info):
+        return "Only the superuser may use WALLCOST."
+    projection = send_all(user_info['trip_id'], msg_command[9:], dry_run=True)
+    return ("That WALL would be %(recipients)i texts of %(segments_each)i "
+            "segment(s) each (%(encoding)s), costing about $%(cost).2f."
+            % projection)
+
+def mod_bus_counter_privileges(trip_id, user_selector, will_be_counter):
+    """
+    Promote or demote a user of a trip to/from bus counter privileges. Call
+    this function through promote_user() or demote_user().
     """
     try:
         selector = user_selector.lower().split('mote ', 1)[1].strip()
     except IndexError:
         return "Usage: PROMOTE/DEMOTE [user], where user is a phone number, first name, or first&last name."
-    user_to_promote = parse_user_selector(selector)
+    user_to_promote = parse_user_selector(trip_id, selector)
     if isinstance(user_to_promote, dict): # returned success
-        cursor = db_conn.cursor()
+        cursor = get_db().cursor()
         assert type(will_be_counter) == bool
-        cursor.execute("UPDATE users SET iscounter = %s WHERE phone = %s",
-                       (will_be_counter, user_to_promote['phone']))
-        db_conn.commit()
+        cursor.execute("""UPDATE users SET iscounter = %s
+                          WHERE trip_id = %s AND phone = %s""",
+                       (will_be_counter, trip_id, user_to_promote['phone']))
+        get_db().commit()
+        get_roster(trip_id).set_counter(user_to_promote['phone'], will_be_counter)
         if will_be_counter:
-            send_msg(user_to_promote['phone'], "You are now a bus counter.")
+            send_msg(trip_id, user_to_promote['phone'], "You are now a bus counter.")
         else:
-            send_msg(user_to_promote['phone'], "You are no longer a bus counter.")
+            send_msg(trip_id, user_to_promote['phone'], "You are no longer a bus counter.")
     else: # not found, error message
         return user_to_promote
 
 def promote_user(user_info, msg_command):
     if not is_superuser(user_info):
         return "Only the superuser may use PROMOTE."
-    return mod_bus_counter_privileges(msg_command, True)
+    return mod_bus_counter_privileges(user_info['trip_id'], msg_command, True)
 
 def demote_user(user_info, msg_command):
     if not is_superuser(user_info):
         return "Only the superuser may use DEMOTE."
-    return mod_bus_counter_privileges(msg_command, False)
+    return mod_bus_counter_privileges(user_info['trip_id'], msg_command, False)
 
 # Dispatch table. Functions receive one argument, the user info dictionary, and
-# may return either None or a string they'd like to reply with.
+# may return either None or a string they'd like to reply with (or a list of
+# strings, to reply with several texts).
 dispatch_onearg = {'COMMANDS': show_help,
                    'IN': mark_user_in,
                    'OUT': mark_user_out,
@@ -497,69 +2236,783 @@ dispatch_onearg = {'COMMANDS': show_help,
                    'LIST': list_missing,
                    'PING': ping_missing,
                    'NOTRIDING': show_absent,
+                   'RECOUNT': recount,
                    }
 
 # These are the same but they take the user info dictionary and the full text
 # of the message body (so they can parse arguments from it).
 dispatch_twoarg = {'WALL': wall,
+                   'WALLCOST': wall_cost,
                    'MARK': markas,
                    'WHOIS': whois,
                    'PROMOTE': promote_user,
                    'DEMOTE': demote_user,
                    }
 
-@app.route('/receivemsg', methods=['POST'])
+### Scheduling commands ###
+# Commands that are handled ahead of everything else when they come from a
+# bus counter or the superuser.
+COUNTER_COMMANDS = ('RESET', 'HARDRESET', 'LIST', 'PING', 'NOTRIDING',
+                    'RECOUNT', 'MARK', 'WALL', 'WALLCOST', 'PROMOTE', 'DEMOTE')
+STATUS_COMMANDS = ('IN', 'OUT', 'ABSENT', 'WAIT', 'MARK')
+
+def command_label(function):
+    "Return what to call the command /function/ in the request stats."
+    if function in dispatch_onearg or function in dispatch_twoarg:
+        return function
+    return 'INVALID'
+
+def command_priority(user_info, function):
+    """
+    Return how urgent the command /function/ from /user_info/ is: 0 for bus
+    counters' commands (including the superuser's), 1 for everyone else's
+    status changes, and 2 for anything else.
+    """
+    if function in COUNTER_COMMANDS and has_buscounter_privileges(user_info):
+        return 0
+    if function in STATUS_COMMANDS:
+        return 1
+    return 2
+
+class CommandScheduler:
+    """
+    Lets at most /concurrency/ commands at a time go on to use the database
+    (one for each database connection, which is what they'd otherwise fight
+    over), from recording that we've got the message (see ProcessedMessages)
+    through handling it, and makes the rest wait in a queue for their
+    priority (see command_priority()). Whenever a command finishes, the one
+    that has been waiting longest at the most urgent priority goes next, so a
+    counter's LIST right before departure doesn't wait behind everybody's IN.
+
+    At most /queue_limits/[priority] commands may wait at each priority;
+    admit() turns away any more than that.
+    """
+    def __init__(self, concurrency, queue_limits):
+        self.concurrency = concurrency
+        self.queue_limits = queue_limits
+        self._running = 0
+        self._queues = [collections.deque() for _ in queue_limits]
+        self._lock = threading.Lock()
+
+    def admit(self, priority):
+        """
+        Wait until a command of /priority/ may run and return True, or return
+        False at once if too many are waiting already. Every admitted command
+        must call done() when it's finished.
+        """
+        labels = {'priority': priority}
+        with self._lock:
+            if self._running < self.concurrency:
+                self._running += 1
+                return True
+            waiting = self._queues[priority]
+            if len(waiting) >= self.queue_limits[priority]:
+                metrics.inc('busbot_commands_shed_total', labels)
+                return False
+            turn = threading.Event()
+            waiting.append(turn)
+            metrics.set('busbot_command_queue_depth', len(waiting), labels)
+
+        start = time.time()
+        turn.wait()
+        metrics.observe('busbot_command_wait_seconds', time.time() - start,
+                        labels)
+        return True
+
+    def done(self):
+        with self._lock:
+            for priority, waiting in enumerate(self._queues):
+                if waiting:
+                    # The finished command's place goes straight to this one.
+                    waiting.popleft().set()
+                    metrics.set('busbot_command_queue_depth', len(waiting),
+                                {'priority': priority})
+                    break
+            else:
+                self._running -= 1
+
+scheduler = CommandScheduler(DB_POOL_SIZE, COMMAND_QUEUE_LIMITS)
+
+# Commands that never get a reply, which aren't limited by SenderLimits.
+UNLIMITED_COMMANDS = ('IN', 'ABSENT', 'WAIT')
+# Commands that change the sender's own status. These are carried out even
+# when the sender is being throttled; only the reply is left off.
+OWN_STATUS_COMMANDS = ('IN', 'OUT', 'ABSENT', 'WAIT')
+
+class SenderLimits:
+    """
+    A token bucket for each phone number that sends us messages: each holds
+    up to /burst/ tokens and gains /rate/ more per second, and every command
+    that gets a reply (anything but UNLIMITED_COMMANDS) takes one, so nobody
+    can run up our bill by texting HELP over and over. (Bus counters and the
+    superuser aren't limited; see throttle_sender().) Only the /size/
+    numbers heard from most recently are remembered; a number that's been
+    forgotten starts again with a full bucket.
+    """
+    def __init__(self, burst, rate, size):
+        self.burst = burst
+        self.rate = rate
+        self.size = size
+        self._buckets = collections.OrderedDict()  # phone -> (tokens, time)
+        self._lock = threading.Lock()
+
+    def allow(self, phone, function):
+        "Take a token for the command /function/ from /phone/ if there is one."
+        if function in UNLIMITED_COMMANDS:
+            return True
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(phone, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[phone] = (tokens, now)
+            if len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return allowed
+
+sender_limits = SenderLimits(SENDER_BURST, SENDER_RATE, SENDER_LIMITS_SIZE)
+
+def admit_message(stats):
+    """
+    Decide whether to handle the message in the current request at all,
+    before anything touches the database: return the user who sent it, or
+    None if it's for a number no trip uses or from a phone that isn't on the
+    trip's roster (both looked up in memory; see Trips and Roster). Ignored
+    messages get no reply.
+    """
+    msg_was_from = request.form["From"]
+    print("<~~ %s :: %s" % (msg_was_from, request.form["Body"]))
+    trip = get_trips().for_number(request.form.get("To"))
+    if trip is None:
+        print("No trip uses the number %s, message rejected."
+              % request.form.get("To"))
+        reason = 'unknown_number'
+    else:
+        stats.trip_id = trip['trip_id']
+        user_info = get_user(trip['trip_id'], msg_was_from)
+        if user_info is not None:
+            return user_info
+        # Consider if we should send an explanatory message; the downside
+        # of that is that random people sending spam to our number will
+        # cost us extra money.
+        print("Phone number %s was not in database, message rejected."
+              % msg_was_from)
+        reason = 'unknown_sender'
+    stats.command = 'REJECTED'
+    metrics.inc('busbot_messages_refused_total', {'reason': reason})
+    return None
+
+def throttle_sender(stats, user_info):
+    """
+    Return True if the message in the current request shouldn't get a reply
+    because /user_info/, who isn't a bus counter, has used up their
+    SenderLimits. (Unless it's one of the OWN_STATUS_COMMANDS, it shouldn't
+    be carried out either.) This is only asked once we know the message isn't
+    one Twilio is sending again (see ProcessedMessages), so retries don't
+    cost the sender anything.
+    """
+    function = request.form["Body"].upper().strip().split(' ')[0]
+    if (has_buscounter_privileges(user_info)
+            or sender_limits.allow(user_info['phone'], function)):
+        return False
+    if function in OWN_STATUS_COMMANDS:
+        print("%s is sending too many messages, no reply sent."
+              % user_info['phone'])
+    else:
+        print("%s is sending too many messages, message ignored."
+              % user_info['phone'])
+    stats.command = command_label(function)
+    stats.outcome = 'throttled'
+    metrics.inc('busbot_messages_refused_total', {'reason': 'throttled'})
+    return True
+
+### Handling each message only once ###
+class ProcessedMessages:
+    """
+    Record of the incoming messages we've handled (by Twilio's MessageSid)
+    and what we responded, so that when Twilio retries a message -- which it
+    does if we take too long to respond -- we can respond the same way again
+    instead of running the command twice.
+
+    The processed_messages table is shared by all the workers; each worker
+    also keeps the most recent responses in memory so that most retries don't
+    need the database at all. Entries are forgotten after /ttl/ seconds.
+    """
+    # Delete expired rows from the table once every this many messages.
+    PRUNE_EVERY = 100
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._recent = collections.OrderedDict()  # sid -> (time, response)
+        self._lock = threading.Lock()
+        self._until_prune = self.PRUNE_EVERY
+
+    def claim(self, sid):
+        """
+        Claim the message /sid/ for this request. Return None if it's ours to
+        handle, or else the response to give: the one given the first time,
+        or an empty string if another request is still working on it.
+        """
+        with self._lock:
+            if sid in self._recent:
+                finished_at, response = self._recent[sid]
+                if time.time() - finished_at < self.ttl:
+                    self._recent.move_to_end(sid)
+                    return response
+                del self._recent[sid]
+
+        cursor = get_db().cursor()
+        cursor.execute("""INSERT INTO processed_messages (sid) VALUES (%s)
+                          ON CONFLICT (sid) DO UPDATE
+                              SET received_at = now(), response = NULL
+                              WHERE processed_messages.received_at
+                                    < now() - %s * INTERVAL '1 second'
+                          RETURNING sid""", (sid, self.ttl))
+        claimed = cursor.fetchone() is not None
+        if not claimed:
+            cursor.execute("SELECT response FROM processed_messages WHERE sid = %s",
+                           (sid,))
+            response = cursor.fetchone()[0]
+        get_db().commit()
+        if claimed:
+            return None
+        return response if response is not None else ''
+
+    def finish(self, sid, response):
+        "Remember that we gave /response/ to the message /sid/."
+        cursor = get_db().cursor()
+        cursor.execute("UPDATE processed_messages SET response = %s WHERE sid = %s",
+                       (response, sid))
+        with self._lock:
+            self._recent[sid] = (time.time(), response)
+            while len(self._recent) > self.size:
+                self._recent.popitem(last=False)
+            self._until_prune -= 1
+            prune = self._until_prune <= 0
+            if prune:
+                self._until_prune = self.PRUNE_EVERY
+        if prune:
+            cursor.execute("""DELETE FROM processed_messages
+                              WHERE received_at < now() - %s * INTERVAL '1 second'""",
+                           (self.ttl,))
+        get_db().commit()
+
+processed_messages = ProcessedMessages(DEDUPE_CACHE_SIZE, DEDUPE_TTL)
+
+
+### Instrumentation ###
+metrics = Metrics()
+metrics.describe('busbot_requests_total', 'counter',
+                 "Incoming messages handled, by command and outcome.")
+metrics.describe('busbot_request_seconds', 'histogram',
+                 "Time taken to handle an incoming message, by command.")
+metrics.describe('busbot_handler_seconds_total', 'counter',
+                 "Time spent in dispatch-table handlers, by command.")
+metrics.describe('busbot_sql_statements_total', 'counter',
+                 "SQL statements run while handling messages, by command.")
+metrics.describe('busbot_sql_seconds_total', 'counter',
+                 "Time spent running SQL while handling messages, by command.")
+metrics.describe('busbot_sms_queued_total', 'counter',
+                 "Texts queued while handling messages, by command.")
+metrics.describe('busbot_sms_segments_total', 'counter',
+                 "SMS segments in the texts queued while handling messages, "
+                 "by command.")
+metrics.describe('busbot_sms_outbox_total', 'counter',
+                 "Texts the outbox has finished with, by final status.")
+metrics.describe('busbot_command_queue_depth', 'gauge',
+                 "Commands waiting for their turn, by priority.")
+metrics.describe('busbot_command_wait_seconds', 'histogram',
+                 "Time commands waited for their turn, by priority.")
+metrics.describe('busbot_messages_refused_total', 'counter',
+                 "Incoming messages ignored, by reason: for an unknown number, "
+                 "from an unknown sender, or throttled (see SenderLimits).")
+metrics.describe('busbot_checkins_total', 'counter',
+                 "Status changes received in batches, by result (see "
+                 "receive_checkins()).")
+metrics.describe('busbot_commands_shed_total', 'counter',
+                 "Commands turned away because too many were waiting, by "
+                 "priority.")
+metrics.describe('busbot_database_degraded', 'gauge',
+                 "1 while the database is unreachable and status changes are "
+                 "kept in the snapshot (see DatabaseFailover).")
+metrics.describe('busbot_journal_replayed_total', 'counter',
+                 "Status changes made without the database and replayed into "
+                 "it, by result: replayed, or conflict if it had a newer one.")
+
+def record_request(stats):
+    """
+    Add the RequestStats for a finished request to the metrics and log them
+    as a line of JSON.
+    """
+    wall_time = time.time() - stats.start
+    labels = {'command': stats.command}
+    metrics.inc('busbot_requests_total', dict(labels, outcome=stats.outcome))
+    metrics.observe('busbot_request_seconds', wall_time, labels)
+    metrics.inc('busbot_handler_seconds_total', labels, stats.handler_time)
+    metrics.inc('busbot_sql_statements_total', labels, stats.sql_count)
+    metrics.inc('busbot_sql_seconds_total', labels, stats.sql_time)
+    metrics.inc('busbot_sms_queued_total', labels, stats.sms_count)
+    metrics.inc('busbot_sms_segments_total', labels, stats.sms_segments)
+    print(json.dumps({'event': 'request',
+                      'trip': stats.trip_id,
+                      'command': stats.command,
+                      'outcome': stats.outcome,
+                      'wall_ms': round(wall_time * 1000, 1),
+                      'handler_ms': round(stats.handler_time * 1000, 1),
+                      'sql_count': stats.sql_count,
+                      'sql_ms': round(stats.sql_time * 1000, 1),
+                      'sms_count': stats.sms_count,
+                      'sms_segments': stats.sms_segments}, sort_keys=True))
+
+@busbot.route('/metrics')
+def show_metrics():
+    "Serve this worker's metrics for Prometheus to scrape."
+    for status, count in outbox.counts.items():
+        metrics.set('busbot_sms_outbox_total', count, {'status': status})
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@busbot.route('/healthz')
+def liveness():
+    "Liveness check: answers as long as this worker is running at all."
+    return 'ok', 200
+
+@busbot.route('/readyz')
+def readiness():
+    """
+    Readiness check: answers once this worker can reach the database and has
+    loaded the list of trips, or while it can't reach the database, has the
+    trips in the snapshot (see DatabaseFailover), and with a 503 otherwise.
+    """
+    try:
+        get_db().cursor().execute("SELECT 1")
+        get_trips()
+    except psycopg2.Error as e:
+        if lost_database(e) and (len(trips) or trips.load_snapshot()):
+            return 'ready, without the database', 200
+        return 'not ready: %s' % str(e).strip(), 503
+    return 'ready', 200
+
+
+@busbot.route('/receivemsg', methods=['POST'])
 def receive_msg():
     """
     This function runs every time Twilio forwards an incoming SMS message to
-    our app. It searches for an appropriate function in the dispatch tables
-    above and returns an "invalid command" message if not.
-
-    If a function returns something other than None, the return value is sent
-    as a reply to the user who originally sent the message.
+    our app. Unless it's turned away (see admit_message()), it waits its turn
+    (see CommandScheduler), and then unless we've seen it before (see
+    ProcessedMessages) or the sender is throttled (see throttle_sender()), it
+    is handled by handle_msg(); anything that goes wrong along the way is
+    reported by message_failed().
     """
+    stats = g.stats = RequestStats()
+    try:
+        try:
+            user_info = admit_message(stats)
+            if user_info is None:
+                return TWIML % '', 200, TWIML_HEADERS
+            function = request.form["Body"].upper().strip().split(' ')[0]
+            priority = command_priority(user_info, function)
+        except Exception as e:
+            return message_failed(stats, e), 200, TWIML_HEADERS
+
+        # Wait our turn before anything else touches the database, giving
+        # back the connection looking the sender up may have taken, so the
+        # messages ahead of us can use it.
+        return_db(None)
+        if not scheduler.admit(priority):
+            print("Too busy, message from %s turned away." % user_info['phone'])
+            stats.command = command_label(function)
+            stats.outcome = 'busy'
+            return (reply_twiml(user_info['phone'], [BUSY_REPLY]), 200,
+                    TWIML_HEADERS)
+        try:
+            return handle_admitted_msg(stats, user_info), 200, TWIML_HEADERS
+        finally:
+            scheduler.done()
+
+    finally:
+        record_request(stats)
+
+def handle_admitted_msg(stats, user_info):
+    """
+    Return the response to the message in the current request from
+    /user_info/, once the CommandScheduler has let it in: the one we gave
+    before if Twilio is sending it again (see ProcessedMessages), nothing if
+    the sender is being throttled (see throttle_sender()), or else whatever
+    handle_msg() says. A throttled sender's own status changes are still
+    made.
+    """
+    # While the database is down, there's nowhere to remember messages.
+    sid = None if database.degraded else request.form.get("MessageSid")
+    if sid:
+        try:
+            previous_response = processed_messages.claim(sid)
+        except psycopg2.Error as e:
+            # Better to risk handling a message twice than not at all.
+            print(traceback.format_exc())
+            if not lost_database(e):
+                get_db().rollback()
+            sid = previous_response = None
+        if previous_response is not None:
+            print("Message %s was already handled, not handling it again."
+                  % sid)
+            stats.command = 'REPLAY'
+            return previous_response or TWIML % ''
+
+    function = request.form["Body"].upper().strip().split(' ')[0]
+    if not throttle_sender(stats, user_info):
+        response = handle_msg(stats, user_info)
+    elif function in OWN_STATUS_COMMANDS:
+        response = handle_msg(stats, user_info, reply=False)
+    else:
+        response = TWIML % ''
+    if sid and not database.degraded:
+        try:
+            processed_messages.finish(sid, response)
+        except psycopg2.Error as e:
+            print(traceback.format_exc())
+            if not lost_database(e):
+                get_db().rollback()
+    return response
+
+def handle_msg(stats, user_info, reply=True):
+    """
+    Handle an incoming message from /user_info/. We search for an appropriate
+    function in the dispatch tables above and send an "invalid command"
+    message if there is none.
+
+    If a function returns something other than None, the return value (a
+    string, or a list of strings to send as separate texts) is sent as a
+    reply to the user who originally sent the message, unless /reply/ is
+    False. We return the body of our response to Twilio, which is TwiML that
+    sends the reply (see reply_twiml()).
+    """
+    msg_was_from = user_info['phone']
     try:
         if request.method == "POST":
             # Parse incoming message.
-            msg_was_from = request.form["From"]
             msg_body = request.form["Body"]
             msg_command = msg_body.upper().strip()
-            print("<~~ %s :: %s" % (msg_was_from, msg_body))
 
             # Do something with it.
-            user_info = get_user(msg_was_from)
-            if user_info is None:
-                print("Phone number %s was not in database, message rejected."
-                      % msg_was_from)
-                # We return 200 so twilio doesn't freak out. Consider if we
-                # should send an explanatory message; the downside of that is
-                # that random people sending spam to our number will cost us
-                # extra money.
-                return 'phone not in our database', 200
-
             function = msg_command.split(' ')[0]
+            handler_start = time.time()
             if ((function not in dispatch_onearg) and (function not in dispatch_twoarg)):
+                stats.command = 'INVALID'
                 retval = show_help(user_info, True)
             elif function in dispatch_onearg:
+                stats.command = function
                 retval = dispatch_onearg[function](user_info)
             elif function in dispatch_twoarg:
+                stats.command = function
                 retval = dispatch_twoarg[function](user_info, msg_body.strip())
             else:
                 print(function)
+            stats.handler_time = time.time() - handler_start
 
-            if retval is not None:
-                send_msg(msg_was_from, retval)
+            if isinstance(retval, str):
+                retval = [retval]
+            if not reply:
+                return TWIML % ''
+            return reply_twiml(msg_was_from, retval or ())
 
-            check_global_status()
-            return 'success', 200
+    except Exception as e:
+        return message_failed(stats, e)
 
-    except Exception:
+def message_failed(stats, error):
+    """
+    Return the response to the message in the current request, which we
+    couldn't handle because of /error/: tell the sender (if we know who they
+    are) and the trip's superuser, unless it's just that we've lost the
+    database (see DatabaseFailover), in which case only the sender is told.
+    """
+    msg_was_from = request.form.get("From")
+    if lost_database(error):
+        print("Can't handle that without the database: %s"
+              % str(error).strip())
+        stats.outcome = 'offline'
+        replies = [OFFLINE_REPLY]
+    else:
         print(traceback.format_exc())
-        send_msg(SUPERUSER, "Error thrown in request from %s." % msg_was_from)
-        send_msg(msg_was_from, "Sorry, I goofed! Your request was not "
-                 "completed. This error has been logged.")
-        return 'error', 200
+        stats.outcome = 'error'
+        # The command may have left its transaction aborted, and the reply
+        # still has to be recorded (see ProcessedMessages) on the same
+        # connection.
+        conn = g.get('db_conn')
+        if conn is not None and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                print(traceback.format_exc())
+        send_msg(stats.trip_id, get_superuser(stats.trip_id),
+                 "Error thrown in request from %s." % msg_was_from)
+        replies = ["Sorry, I goofed! Your request was not completed. This "
+                   "error has been logged."]
+    return reply_twiml(msg_was_from, replies) if msg_was_from else TWIML % ''
+
+
+### Bulk check-ins ###
+# The order status changes in a batch are made in: anyone getting off the bus
+# first, so the counters are only told everyone is on if they still are.
+CHECKIN_STATUSES = ('OUT', 'WAIT', 'IN', 'ABSENT')
+# The forms of ISO 8601 time a check-in's time may take, before any time zone
+# (see parse_checkin_time()).
+CHECKIN_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S.%f',
+                        '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M')
+CHECKIN_TIME_ZONE = re.compile(r'(Z|([+-])(\d\d):?(\d\d))$')
+
+@busbot.route('/checkins', methods=['POST'])
+def receive_checkins():
+    """
+    Make a batch of status changes sent by a door scanner or a bus counter's
+    app, rather than by text. The request must have the header
+    'Authorization: Bearer CHECKIN_API_TOKEN' and say which trip it's for
+    (by name; the default trip if left out) and which bus counter is making
+    the changes (by phone number). It's either JSON, like
+
+        {"trip": "choir", "counter": "+15551234567",
+         "checkins": [{"who": "ann lee", "status": "IN",
+                       "at": "2017-06-01T14:05:00-05:00"}, ...]}
+
+    or CSV (Content-Type text/csv), with the trip and counter in the query
+    string and a line 'who,status,at' for each change. /who/ is anything
+    MARK understands (see parse_user_selector()), /status/ is IN, OUT, WAIT,
+    or ABSENT, and /at/ is when the change happened, as an ISO 8601 time (UTC
+    if it has no time zone) or seconds since the epoch; it's now if left
+    out.
+
+    The changes are all made in one transaction, and the latest change to
+    each person wins: a change older than their last change (in the batch or
+    not) is ignored. We respond with JSON giving the result of each change,
+    in order: 'applied'; 'unchanged' if they already had the status; 'stale'
+    if they've changed status since; 'superseded' if a later change in the
+    batch won; or 'error', with a message saying what was wrong.
+    """
+    stats = g.stats = RequestStats()
+    stats.command = 'CHECKINS'
+    try:
+        if not CHECKIN_API_TOKEN or not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer ' + CHECKIN_API_TOKEN):
+            stats.outcome = 'rejected'
+            return json_response({'error': "Not authorized."}, 401)
+        try:
+            trip_name, counter_phone, checkins = parse_checkins()
+        except ValueError as e:
+            stats.outcome = 'rejected'
+            return json_response({'error': str(e)}, 400)
+        if len(checkins) > CHECKIN_BATCH_MAX:
+            stats.outcome = 'rejected'
+            return json_response({'error': "At most %i changes can be sent at "
+                                           "a time." % CHECKIN_BATCH_MAX}, 413)
+
+        if trip_name:
+            trip = get_trips().named(trip_name)
+        else:
+            trip = get_trips().for_number(None)
+        # A '+' in the query string of a CSV batch comes to us as a space.
+        counter_phone = (normalize_phone(counter_phone)
+                         if isinstance(counter_phone, str) else None)
+        counter = (get_user(trip['trip_id'], counter_phone)
+                   if trip is not None and counter_phone else None)
+        if counter is None or not has_buscounter_privileges(counter):
+            stats.outcome = 'rejected'
+            return json_response({'error': "There's no bus counter with that "
+                                           "phone number on that trip."}, 403)
+        stats.trip_id = trip['trip_id']
+
+        return_db(None)
+        if not scheduler.admit(0):
+            stats.outcome = 'busy'
+            return json_response({'error': BUSY_REPLY}, 503)
+        try:
+            handler_start = time.time()
+            results = apply_checkins(counter, checkins)
+            stats.handler_time = time.time() - handler_start
+        finally:
+            scheduler.done()
+        for result in results:
+            metrics.inc('busbot_checkins_total', {'result': result['result']})
+        return json_response({'results': results})
+
+    except Exception as e:
+        if lost_database(e):
+            # The batch has its own times, so it can just be sent again later.
+            print("Can't make check-ins without the database: %s"
+                  % str(e).strip())
+            stats.outcome = 'offline'
+            return json_response({'error': OFFLINE_REPLY}, 503)
+        print(traceback.format_exc())
+        stats.outcome = 'error'
+        return json_response({'error': "Sorry, I goofed! None of the changes "
+                                       "were made."}, 500)
+    finally:
+        record_request(stats)
+
+def json_response(body, status=200):
+    return json.dumps(body), status, {'Content-Type': 'application/json'}
 
+def parse_checkins():
+    """
+    Return the trip name, the counter's phone number, and a list of the
+    changes, as (who, status, at) tuples, in the request to /checkins (see
+    receive_checkins()). Raise ValueError if we can't make sense of it.
+    """
+    if request.mimetype == 'text/csv':
+        checkins = []
+        lines = csv.reader(io.StringIO(request.get_data(as_text=True)))
+        for line_number, line in enumerate(lines, 1):
+            if not line or line == ['who', 'status', 'at']:
+                continue
+            if len(line) not in (2, 3):
+                raise ValueError("Line %i should be who,status,at."
+                                 % line_number)
+            checkins.append((line + [None])[:3])
+        return request.args.get('trip'), request.args.get('counter'), checkins
+
+    body = request.get_json(silent=True)
+    if (not isinstance(body, dict)
+            or not isinstance(body.get('checkins'), list)
+            or not all(isinstance(i, dict) for i in body['checkins'])):
+        raise ValueError("Send JSON with a list of checkins, or CSV.")
+    return (body.get('trip'), body.get('counter'),
+            [(i.get('who'), i.get('status'), i.get('at'))
+             for i in body['checkins']])
+
+def parse_checkin_time(value, now):
+    """
+    Return the time /value/ (see receive_checkins()) as an aware datetime,
+    or /now/ if it's empty or in the future, since a door scanner with its
+    clock set wrong could otherwise stop anyone's status from changing.
+    """
+    if value is None or value == '':
+        return now
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        at = datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    elif isinstance(value, str):
+        try:
+            at = datetime.datetime.fromtimestamp(float(value),
+                                                 datetime.timezone.utc)
+        except ValueError:
+            at = parse_iso_time(value.strip())
+    else:
+        raise ValueError(value)
+    return min(at, now)
+
+def parse_iso_time(value):
+    """
+    Return the ISO 8601 time /value/ (in one of CHECKIN_TIME_FORMATS,
+    followed by 'Z', a time zone like '-05:00', or nothing for UTC) as an
+    aware datetime, or raise ValueError. (Python 3.4's strptime() can't read
+    a time zone with a colon in it, so we read it ourselves.)
+    """
+    offset = datetime.timedelta(0)
+    zone = CHECKIN_TIME_ZONE.search(value)
+    if zone is not None:
+        value = value[:zone.start()]
+        if zone.group(2):
+            offset = datetime.timedelta(hours=int(zone.group(3)),
+                                        minutes=int(zone.group(4)))
+            if zone.group(2) == '-':
+                offset = -offset
+    for time_format in CHECKIN_TIME_FORMATS:
+        try:
+            at = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return at.replace(tzinfo=datetime.timezone(offset))
+    raise ValueError("Couldn't read the time %r." % value)
+
+def apply_checkins(counter, checkins):
+    """
+    Make the status changes /checkins/, as (who, status, at) tuples, on
+    behalf of the bus counter /counter/ (see receive_checkins()), and return
+    the result of each.
+    """
+    trip_id = counter['trip_id']
+    now = datetime.datetime.now(datetime.timezone.utc)
+    results = []
+    latest = {}  # phone -> (at, index, user_info, status) of the latest change
+    for index, (who, status, at) in enumerate(checkins):
+        result = {'who': who, 'status': status}
+        results.append(result)
+        status = status.upper().strip() if isinstance(status, str) else ''
+        user_info = (parse_user_selector(trip_id, who)
+                     if isinstance(who, str) and who.strip()
+                     else "Say who to change.")
+        try:
+            at = parse_checkin_time(at, now)
+        except (TypeError, ValueError, OverflowError, OSError):
+            at = None
+        if status not in CHECKIN_STATUSES:
+            result.update(result='error', message="The status must be IN, "
+                                                  "OUT, WAIT, or ABSENT.")
+        elif isinstance(user_info, str):
+            result.update(result='error', message=user_info)
+        elif at is None:
+            result.update(result='error', message="Couldn't read the time.")
+        else:
+            result['status'] = status
+            change = (at, index, user_info, status)
+            previous = latest.get(user_info['phone'])
+            if previous is None or previous[:2] < change[:2]:
+                if previous is not None:
+                    results[previous[1]]['result'] = 'superseded'
+                latest[user_info['phone']] = change
+            else:
+                result['result'] = 'superseded'
+
+    cursor = get_db().cursor()
+    old_statuses = {}
+    was_all_in = trip_status = None
+    for status in CHECKIN_STATUSES:
+        changes = [i for i in latest.values() if i[3] == status]
+        if not changes:
+            continue
+        changed, status_after = set_user_statuses(
+            cursor, trip_id, [user_info['phone'] for _, _, user_info, _ in changes],
+            status, [at for at, _, _, _ in changes])
+        old_statuses.update(changed)
+        if status_after is not None:
+            if was_all_in is None:
+                was_all_in = status_after['was_all_in']
+            trip_status = status_after
+    get_db().commit()
+
+    roster = get_roster(trip_id)
+    applied = collections.defaultdict(list)  # status -> user dictionaries
+    for at, index, user_info, status in sorted(latest.values(),
+                                               key=lambda i: i[1]):
+        phone = user_info['phone']
+        if phone not in old_statuses:
+            results[index]['result'] = 'stale'
+        elif old_statuses[phone] == status:
+            results[index]['result'] = 'unchanged'
+        else:
+            results[index]['result'] = 'applied'
+            roster.set_status(phone, status)
+            event_log.record(user_info, status, old_statuses[phone], counter)
+            applied[status].append(user_info)
+    print("Applied %i of %i check-ins from %s."
+          % (sum(len(i) for i in applied.values()), len(checkins),
+             counter['phone']))
+
+    if applied['OUT'] and was_all_in:
+        warn_marked_out(counter, [get_displayname_from_userinfo(user_info)
+                                  for user_info in applied['OUT']])
+    for user_info in applied['WAIT']:
+        counter_digest.add(user_info, 'WAIT')
+    if (trip_status is not None and trip_status['all_in']
+            and not was_all_in):
+        notify_all_in(trip_id, trip_status['IN'], trip_status['ABSENT'])
+    return results
+
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Benchmark that replays busy moments of a trip against BusBot -- a whole group
+checking in at once, bus counters PINGing over and over, counters MARKing
+people in one after another -- and reports how BusBot held up.
+
+BusBot runs inside this process, talking to a real Postgres database, and
+fake Twilio requests (like the ones testclient.py sends) are fed to it from
+many threads at once. Texts BusBot tries to send are counted rather than sent.
+For each scenario and group size, the benchmark reports throughput, p50/p95/
+p99 latency, and the average and maximum number of database queries and
+outgoing texts per request.
+
+The startup scenario instead starts BusBot in a fresh Python process a few
+times, like a new worker on a freshly booted dyno, and reports how long
+importing it and answering the first message take.
+
+*** This replaces the users table of the database it's pointed at with a
+made-up group! Only use it on a scratch database. ***
+
+Run it like
+
+    DATABASE_URL=postgresql://localhost/busbot_bench python benchmark.py
+
+Options:
+    --scenario NAME   in_burst, ping_storm, mark_chain, startup, or all
+                      (default)
+    --group-size N    number of people in the group (default 90); may be
+                      given more than once to try several sizes
+    --concurrency N   number of requests in flight at once (default 90)
+    --counters N      number of bus counters in the group (default 5)
+    --json FILE       also append the results to FILE, one JSON object per
+                      line, so runs can be compared over time
+
+To compare two versions of BusBot, run the benchmark against each in turn.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TO_PHONE = "+10005551234"
+PING_ROUNDS = 5
+STARTUP_RUNS = 5
+
+# Run in a new process by the startup scenario; prints the timings as JSON.
+STARTUP_SCRIPT = """
+import json, time
+start = time.time()
+import app
+imported = time.time()
+app.DEBUG = True
+app.app.test_client().post('/receivemsg', data={
+    'From': %(phone)r, 'To': %(to)r, 'Body': 'STATUS'})
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'first_request_ms': (time.time() - imported) * 1000}))
+"""
+
+FIRSTNAMES = ["Ann", "Bob", "Carl", "Dee", "Eve", "Fred", "Gus", "Hal", "Ida",
+              "Jo", "Kim", "Lou", "Mae", "Ned", "Otto", "Pat", "Quinn", "Ray",
+              "Sue", "Tom", "Uma", "Val", "Walt", "Xena", "Yves", "Zoe"]
+
+# BusBot's RequestStats for the last request made by the current thread.
+current = threading.local()
+
+
+class DiscardingOutbox:
+    "Stands in for BusBot's outbox, throwing texts away instead of sending them."
+    def put(self, message):
+        pass
+
+
+def make_group(size):
+    "Return a list of (firstname, lastname, 10-digit phone) for a fake group."
+    return [(FIRSTNAMES[i % len(FIRSTNAMES)], "Person%05i" % i,
+             "555%07i" % i) for i in range(size)]
+
+def load_group(app, group, num_counters):
+    """
+    Replace the roster with /group/, make the first /num_counters/ people bus
+    counters (and the first one the superuser too), and reset everyone's
+    status. Return the phone numbers of the counters.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+        for person in group:
+            f.write(','.join(person) + '\n')
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        subprocess.check_call(
+            [sys.executable, os.path.join(here, 'import_roster.py'), f.name],
+            stdout=subprocess.DEVNULL)
+    finally:
+        os.unlink(f.name)
+
+    counters = ["+1" + phone for _, _, phone in group[:num_counters]]
+    app.SUPERUSER = counters[0]
+    with app.app.app_context():
+        trip_id = app.get_trips().for_number(TO_PHONE)['trip_id']
+        cursor = app.get_db().cursor()
+        cursor.execute("""UPDATE users SET iscounter = (phone = ANY(%s))
+                          WHERE trip_id = %s""", (counters, trip_id))
+        app.get_db().commit()
+        app.reset_status_generic(trip_id)
+        app.get_roster(trip_id).load(app.get_db())
+    return counters
+
+def post(client, phone, body):
+    """
+    Send a fake Twilio request to BusBot, like testclient.py does, and return
+    how long BusBot took to answer and BusBot's RequestStats for it.
+    """
+    start = time.time()
+    r = client.post('/receivemsg', data={
+        'NumSegments': '1',
+        'MessageSid': 'SM' + ''.join(random.choice(string.hexdigits)
+                                     for _ in range(32)),
+        'NumMedia': '0',
+        'Body': body,
+        'To': TO_PHONE,
+        'ApiVersion': '2010-04-01',
+        'From': phone,
+        'SmsStatus': 'received',
+        })
+    latency = time.time() - start
+    if r.status_code != 200:
+        print("Request %r from %s failed: %s" % (body, phone, r.status))
+    return latency, current.stats
+
+
+## Scenarios: each returns a list of (phone, message body) to send at once.
+def in_burst(group, counters):
+    "Everyone texts IN at the same moment."
+    requests = [("+1" + phone, "IN") for _, _, phone in group]
+    random.shuffle(requests)
+    return requests
+
+def ping_storm(group, counters):
+    "Nobody has checked in, and every counter keeps PINGing and LISTing."
+    return [(counter, command) for _ in range(PING_ROUNDS)
+            for counter in counters for command in ("PING", "LIST")]
+
+def mark_chain(group, counters):
+    "The counters take turns marking everyone IN by name."
+    return [(counters[i % len(counters)],
+             "MARK %s %s AS IN" % (firstname, lastname))
+            for i, (firstname, lastname, _) in enumerate(group)]
+
+SCENARIOS = {'in_burst': in_burst,
+             'ping_storm': ping_storm,
+             'mark_chain': mark_chain}
+
+
+def percentile(values, pct):
+    "Return the /pct/th percentile of a sorted list."
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def run(app, scenario, group_size, concurrency, num_counters):
+    group = make_group(group_size)
+    counters = load_group(app, group, num_counters)
+    requests = SCENARIOS[scenario](group, counters)
+
+    clients = threading.local()
+    def send(request):
+        if not hasattr(clients, 'client'):
+            clients.client = app.app.test_client()
+        return post(clients.client, *request)
+
+    # BusBot logs every message it gets and sends; that's too much to read.
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(send, requests))
+            wall_time = time.time() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    queries = [stats.sql_count for _, stats in results]
+    messages = [stats.sms_count for _, stats in results]
+    return {
+        'scenario': scenario,
+        'group_size': group_size,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'time': time.time(),
+        'wall_time_s': round(wall_time, 3),
+        'throughput_rps': round(len(results) / wall_time, 1),
+        'latency_ms': {'p%i' % pct: round(percentile(latencies, pct) * 1000, 1)
+                       for pct in (50, 95, 99)},
+        'queries_per_request': {'mean': round(sum(queries) / len(queries), 2),
+                                'max': max(queries)},
+        'messages_per_request': {'mean': round(sum(messages) / len(messages), 2),
+                                 'max': max(messages)},
+    }
+
+def run_startup(app, group_size, num_counters):
+    group = make_group(group_size)
+    counters = load_group(app, group, num_counters)
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT % {'phone': counters[0], 'to': TO_PHONE}
+
+    timings = {'import_ms': [], 'first_request_ms': [], 'process_ms': []}
+    for _ in range(STARTUP_RUNS):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=here, universal_newlines=True)
+        timings['process_ms'].append((time.time() - start) * 1000)
+        for key, value in json.loads(output.splitlines()[-1]).items():
+            timings[key].append(value)
+    return dict({'scenario': 'startup',
+                 'group_size': group_size,
+                 'runs': STARTUP_RUNS,
+                 'time': time.time()},
+                **{key: {'p50': round(percentile(sorted(values), 50), 1),
+                         'max': round(max(values), 1)}
+                   for key, values in timings.items()})
+
+def show(result):
+    if result['scenario'] == 'startup':
+        print("startup, %(group_size)i people: %(runs)i fresh processes"
+              % result)
+        for key, description in (('import_ms', "import"),
+                                 ('first_request_ms', "first request"),
+                                 ('process_ms', "whole process")):
+            print("    %s: p50 %.0f ms, max %.0f ms"
+                  % (description, result[key]['p50'], result[key]['max']))
+        return
+    print("%(scenario)s, %(group_size)i people: %(requests)i requests in "
+          "%(wall_time_s).2f s (%(throughput_rps).1f/s)" % result)
+    print("    latency p50 %(p50).0f ms, p95 %(p95).0f ms, p99 %(p99).0f ms"
+          % result['latency_ms'])
+    print("    queries/request: mean %(mean).2f, max %(max)i"
+          % result['queries_per_request'])
+    print("    texts/request: mean %(mean).2f, max %(max)i"
+          % result['messages_per_request'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark BusBot against a scratch database.")
+    parser.add_argument('--scenario', default='all',
+                        choices=sorted(SCENARIOS) + ['startup', 'all'])
+    parser.add_argument('--group-size', type=int, action='append')
+    parser.add_argument('--concurrency', type=int, default=90)
+    parser.add_argument('--counters', type=int, default=5)
+    parser.add_argument('--json')
+    args = parser.parse_args()
+
+    import app
+    app.outbox = DiscardingOutbox()
+    app.DEBUG = False
+    record_request = app.record_request
+    def keep_stats(stats):
+        current.stats = stats
+        record_request(stats)
+    app.record_request = keep_stats
+
+    if args.scenario == 'all':
+        scenarios = sorted(SCENARIOS) + ['startup']
+    else:
+        scenarios = [args.scenario]
+    for group_size in args.group_size or [90]:
+        for scenario in scenarios:
+            if scenario == 'startup':
+                result = run_startup(app, group_size, args.counters)
+            else:
+                result = run(app, scenario, group_size, args.concurrency,
+                             args.counters)
+            show(result)
+            if args.json:
+                with open(args.json, 'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
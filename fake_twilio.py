@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the part of Twilio's REST API that BusBot uses to send texts,
+so you can watch what BusBot sends (and see how it copes when sending fails)
+without paying for real messages.
+
+1. Run this tool like 'python fake_twilio.py [PORT [FAIL_RATE [LATENCY]]]'.
+   FAIL_RATE is the fraction of requests that should fail with a 503 error
+   (default 0), and LATENCY is how many seconds to take over each request
+   (default 0).
+2. Set the environment variable TWILIO_API_BASE to 'http://localhost:PORT'
+   and make sure BUSBOT_DEBUG isn't, then run BusBot locally.
+
+Each message BusBot sends is printed as it arrives. GET /messages returns
+everything received so far as JSON.
+"""
+
+import itertools
+import random
+import sys
+import time
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+received = []
+sid_numbers = itertools.count(1)
+
+fail_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+
+@app.route('/2010-04-01/Accounts/<account_sid>/Messages.json',
+           methods=['POST'])
+def create_message(account_sid):
+    time.sleep(latency)
+    if random.random() < fail_rate:
+        return jsonify(code=20500, message="Fake internal error"), 503
+
+    message = {'sid': 'SM%032i' % next(sid_numbers),
+               'account_sid': account_sid,
+               'to': request.form['To'],
+               'from': request.form['From'],
+               'body': request.form['Body'],
+               'status': 'queued'}
+    received.append(message)
+    print("%s -> %s :: %s" % (message['from'], message['to'], message['body']))
+    return jsonify(message), 201
+
+@app.route('/messages')
+def list_messages():
+    return jsonify(messages=received)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    app.run(port=port, threaded=True)
@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+"""
+Run BusBot entirely on this machine -- no Twilio, no Heroku, no network -- to
+check that every command still does what it should, or to profile scripted
+scenarios.
+
+BusBot runs inside this process, as in benchmark.py. The texts it sends are
+recorded instead of being handed to Twilio, and it talks to a throwaway
+Postgres server that is created in a temporary directory for the run (with
+initdb and pg_ctl, which must be on the PATH or in the directory PG_BIN
+names; Postgres won't run as root) and deleted afterwards. To use a server
+you already have instead, give --database-url; *** the users and status of
+that database are replaced, so only point it at a scratch database! ***
+
+Run it like
+
+    python harness.py check
+        Send BusBot scripted conversations exercising every command and
+        check that it texts the right people the right things, and that its
+        tallies, the database, and its in-memory roster all still agree
+        afterwards. Prints each check and whether it passed, and exits with
+        status 1 if any failed.
+
+    python harness.py profile [--scenario NAME] [--group-size N]
+                              [--out FILE] [--flamegraph SVG]
+        Run a scenario under cProfile and print the functions that took the
+        most time. The scenario is 'checks' (all of the above) or 'boarding'
+        (the default: a group of --group-size people, 90 by default, all
+        checking in while counters LIST, PING, and MARK people). --out saves
+        the profile for pstats or snakeviz; --flamegraph instead runs the
+        scenario under py-spy (which must be installed) and saves a flame
+        graph.
+
+Before either command:
+    --database-url URL   use this database rather than a throwaway one
+"""
+
+import argparse
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from xml.etree import ElementTree
+
+import psycopg2
+
+from benchmark import make_group
+from schema import RECOUNT, SCHEMA
+
+ANN = '+15550000001'      # the superuser
+BOB = '+15550000002'      # a bus counter
+ANN_LEE = '+15550000003'
+CARL = '+15550000004'
+STRANGER = '+15559999999'
+BOARDING_COUNTERS = 5
+# How many commands that get a reply each person may send in a check.
+CHECK_SENDER_BURST = 5
+# The CHECKIN_API_TOKEN and CHECKIN_BATCH_MAX BusBot gets in the checks.
+CHECK_TOKEN = 'harness-token'
+CHECK_BATCH_MAX = 4
+ROSTER = [('Ann', 'Smith', ANN), ('Bob', 'Jones', BOB),
+          ('Ann', 'Lee', ANN_LEE), ('Carl', 'van Gogh', CARL)]
+EVERYONE = [phone for _, _, phone in ROSTER]
+
+# A step of a check can also POST a batch to /checkins instead of sending a
+# message: the phone is CHECKINS, and the message is the (body, content type,
+# query string, token) of the request. The response counts as a text to
+# RESPONSE saying its status code and then the result of each change, or the
+# error (like "200 applied stale" or "401 Not authorized.").
+CHECKINS = 'checkins'
+RESPONSE = 'response'
+# With DATABASE as the phone, a step instead does something to the database:
+# ('down',) makes BusBot lose it (see DatabaseFailover in app.py), ('up',)
+# has BusBot find it again and replay its journal, ('set', phone, status)
+# changes someone's status in it, as another worker would, and ('break',)
+# makes every change to a user fail with an error until ('mend',).
+DATABASE = 'database'
+BREAK_USERS = """
+    CREATE OR REPLACE FUNCTION harness_break_users() RETURNS TRIGGER AS $$
+    BEGIN
+        RAISE EXCEPTION 'The harness broke the users table.';
+    END;
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS harness_break_users ON users;
+    CREATE TRIGGER harness_break_users BEFORE UPDATE ON users
+        FOR EACH ROW EXECUTE PROCEDURE harness_break_users();"""
+MEND_USERS = "DROP TRIGGER IF EXISTS harness_break_users ON users"
+# With RETRY as the phone, Twilio sends the last message again, with the same
+# MessageSid, to a worker that hasn't seen it (see ProcessedMessages in
+# app.py); the step's message is ignored.
+RETRY = 'retry'
+# With DIGEST as the phone, ('window', seconds) has the counters' WAIT
+# notifications collected for that long (see CounterDigest in app.py) rather
+# than sent at once, and ('wait',) waits for the collected ones to be sent.
+DIGEST = 'digest'
+# How long the CounterDigest window is when a check opens one.
+CHECK_DIGEST_WINDOW = 0.3
+
+def checkins(changes, token=CHECK_TOKEN):
+    "A /checkins request from Bob making /changes/, as (who, status, at)."
+    return (json.dumps({'counter': BOB, 'checkins': [
+                {'who': who, 'status': status, 'at': at}
+                for who, status, at in changes]}),
+            'application/json', '', token)
+
+def checkins_csv(lines, counter=BOB):
+    "A /checkins request in CSV, with /counter/ put in the URL as is."
+    return '\n'.join(['who,status,at'] + lines), 'text/csv', \
+           'counter=' + counter, CHECK_TOKEN
+
+# Each check is a description and a list of steps: a message someone sends
+# BusBot, and the texts BusBot should send in response, as (phone, something
+# the text says) pairs. A step fails if any of those texts isn't sent or if
+# BusBot sends any other text. Every check starts with everyone UNSET and Bob
+# the only bus counter.
+CHECKS = [
+    ("COMMANDS shows each person the commands they may use", [
+        (CARL, "COMMANDS", [(CARL, "MARK [user] AS [status]. Full help")]),
+        (BOB, "COMMANDS", [(BOB, "Counters: LIST")]),
+        (ANN, "COMMANDS", [(ANN, "Superuser: WALL")])]),
+    ("An unknown command gets the help text, shortened if that saves a text", [
+        (CARL, "FLY", [(CARL, "Invalid command. Mark status as")]),
+        (BOB, "FLY", [(BOB, "***Invalid command.*** Mark status as")])]),
+    ("Messages from strangers are ignored", [
+        (STRANGER, "IN", [])]),
+    ("Texting too much gets you ignored", [
+        (CARL, "STATUS", [(CARL, "You have not yet checked in.")])]
+     * CHECK_SENDER_BURST
+     + [(CARL, "STATUS", []), (CARL, "FLY", []), (CARL, "IN", []),
+        (ANN_LEE, "STATUS", [(ANN_LEE, "You have not yet checked in.")])]
+     + [(BOB, "STATUS", [(BOB, "You have not yet checked in.")])]
+     * (CHECK_SENDER_BURST + 1)),
+    ("Texting too much never stops an OUT", [
+        (ANN, "IN", []), (BOB, "IN", []), (CARL, "IN", []),
+        (ANN_LEE, "IN", [(BOB, "Everyone is now marked as IN")])]
+     + [(ANN_LEE, "STATUS", [(ANN_LEE, "You are currently marked as IN.")])]
+     * CHECK_SENDER_BURST
+     + [(ANN_LEE, "OUT", [(BOB, "WARNING: Ann Lee marked themselves OUT.")]),
+        (BOB, "LIST", [(BOB, "Ann Lee - OUT")])]),
+    ("A command that fails gives the same reply when Twilio retries it", [
+        (DATABASE, ('break',), []),
+        (CARL, "IN", [(ANN, "Error thrown in request from " + CARL),
+                      (CARL, "Sorry, I goofed!")]),
+        (DATABASE, ('mend',), []),
+        (RETRY, None, [(CARL, "Sorry, I goofed!")]),
+        (CARL, "STATUS", [(CARL, "You have not yet checked in.")])]),
+    ("IN and STATUS", [
+        (CARL, "STATUS", [(CARL, "You have not yet checked in.")]),
+        (CARL, "IN", []),
+        (CARL, "STATUS", [(CARL, "You are currently marked as IN.")])]),
+    ("OUT warns the counters once everyone was in", [
+        (ANN_LEE, "OUT", [(ANN_LEE, "may safely step off the bus")]),
+        (ANN, "IN", []), (BOB, "IN", []), (CARL, "ABSENT", []),
+        (ANN_LEE, "IN", [(BOB, "Everyone is now marked as IN or ABSENT. "
+                               "4 total people, 1 NOTRIDING.")]),
+        (ANN_LEE, "OUT", [(ANN_LEE, "may safely step off the bus"),
+                          (BOB, "WARNING: Ann Lee marked themselves OUT.")])]),
+    ("WAIT tells the counters", [
+        (CARL, "WAIT", [(BOB, "Carl is on their way")])]),
+    ("ABSENT and NOTRIDING", [
+        (CARL, "NOTRIDING", [(CARL, "Only bus counters")]),
+        (BOB, "NOTRIDING", [(BOB, "Nobody is currently marked as absent.")]),
+        (CARL, "ABSENT", []),
+        (ANN_LEE, "ABSENT", []),
+        (BOB, "NOTRIDING", [(BOB, "Absent: Ann Lee, Carl")])]),
+    ("LIST", [
+        (CARL, "LIST", [(CARL, "Only bus counters")]),
+        (CARL, "IN", []),
+        (BOB, "LIST", [(BOB, "Ann Lee - UNSET; Ann Smith - UNSET; "
+                             "Bob - UNSET")])]),
+    ("PING texts everyone missing", [
+        (CARL, "PING", [(CARL, "Only bus counters")]),
+        (CARL, "IN", []),
+        (BOB, "PING", [(BOB, "Ping sent to all 3 missing people."),
+                       (ANN, "looking for you"), (BOB, "looking for you"),
+                       (ANN_LEE, "looking for you"),
+                       (BOB, "PING done: texted 3 of 3.")]),
+        (BOB, "PING", [(BOB, "Everyone missing has been PINGed")]),
+        (BOB, "IN", []),
+        (BOB, "PING", [(BOB, "Everyone missing has been PINGed")])]),
+    ("RESET and HARDRESET", [
+        (CARL, "IN", []),
+        (CARL, "RESET", [(CARL, "Only bus counters")]),
+        (BOB, "RESET", [(BOB, "Bus counts have been reset.")]),
+        (CARL, "STATUS", [(CARL, "You have not yet checked in.")]),
+        (BOB, "HARDRESET", [(phone, "Sorry, we got mixed up!")
+                            for phone in EVERYONE]
+                           + [(BOB, "Bus counts have been hard-reset.")])]),
+    ("RECOUNT", [
+        (CARL, "IN", []),
+        (BOB, "RECOUNT", [(BOB, "Counts are correct: IN 1, OUT 0, WAIT 0, "
+                                "ABSENT 0, UNSET 3.")])]),
+    ("MARK", [
+        (CARL, "MARK ann lee AS in", [(ANN_LEE, "Notice: Carl marked you as IN.")]),
+        (CARL, "MARK ann AS in", [(CARL, "Person ambiguous")]),
+        (CARL, "MARK b AS out", [(CARL, "Did you mean: Bob Jones?")]),
+        (CARL, "MARK carl, bob AS in", [(CARL, "Only bus counters")]),
+        (BOB, "MARK carl, +15550000001 AS absent",
+         [(BOB, "Marked Carl and Ann Smith as ABSENT."),
+          (CARL, "Notice: Bob marked you as ABSENT."),
+          (ANN, "Notice: Bob marked you as ABSENT.")]),
+        (BOB, "MARK ALL UNSET AS in",
+         [(BOB, "Marked Bob as IN."), (BOB, "Notice: Bob marked you as IN."),
+          (BOB, "Everyone is now marked as IN or ABSENT.")])]),
+    ("WHOIS and WHOAMI", [
+        (CARL, "WHOIS ann lee", [(CARL, "FN Ann - LN Lee - PHONE +15550000003 "
+                                        "- STATUS UNSET")]),
+        (CARL, "WHOIS zed", [(CARL, "couldn't work out who you meant")]),
+        (CARL, "WHOIS bob j", [(CARL, "FN Bob - LN Jones")]),
+        (ANN, "WHOAMI", [(ANN, "FN Ann - LN Smith - PHONE +15550000001 - "
+                               "STATUS UNSET - SUPERUSER")])]),
+    ("WALL", [
+        (CARL, "WALL hi", [(CARL, "Only the superuser")]),
+        (ANN, "WALLCOST Bus leaves at 5", [(ANN, "4 texts of 1 segment(s) "
+                                                 "each (GSM-7)")]),
+        (ANN, "WALL Bus leaves at 5", [(phone, "Bus leaves at 5")
+                                       for phone in EVERYONE]),
+        (ANN, "WALL Don\u2019t be late", [(phone, "Don't be late")
+                                         for phone in EVERYONE]),
+        # Long as it is, nobody's WALL is reworded to save a segment.
+        (ANN, "WALL Bus counters: " + "meet the [user] list at the door. " * 5,
+         [(phone, "Bus counters: meet the [user] list") for phone in EVERYONE])]),
+    ("PROMOTE and DEMOTE", [
+        (BOB, "PROMOTE carl", [(BOB, "Only the superuser")]),
+        (ANN, "PROMOTE carl", [(CARL, "You are now a bus counter.")]),
+        (ANN_LEE, "WAIT", [(BOB, "Ann Lee is on their way"),
+                           (CARL, "Ann Lee is on their way")]),
+        (ANN, "DEMOTE carl", [(CARL, "You are no longer a bus counter.")]),
+        (ANN_LEE, "WAIT", [(BOB, "Ann Lee is on their way")])]),
+    ("WAITs close together reach the counters in one text", [
+        (DIGEST, ('window', CHECK_DIGEST_WINDOW), []),
+        (ANN_LEE, "WAIT", []),
+        (CARL, "WAIT", []),
+        (ANN, "WAIT", []),
+        (ANN, "IN", []),
+        (DIGEST, ('wait',), [(BOB, "Ann Lee and Carl are on their way")]),
+        (ANN_LEE, "WAIT", []),
+        (DIGEST, ('wait',), [(BOB, "Ann Lee is on their way")])]),
+    ("Check-ins need the token and a bus counter", [
+        (CHECKINS, checkins([("carl", "IN", None)], token='wrong'),
+         [(RESPONSE, "401 Not authorized.")]),
+        (CHECKINS, checkins_csv(["carl,IN,"], counter=CARL),
+         [(RESPONSE, "403 There's no bus counter")]),
+        (CARL, "STATUS", [(CARL, "You have not yet checked in.")])]),
+    ("Check-ins: the latest change to each person wins", [
+        (ANN_LEE, "IN", []),
+        (CARL, "IN", []),
+        (CHECKINS, checkins([("ann lee", "IN", None),
+                             ("carl", "OUT", "2017-06-01T14:05:00-05:00"),
+                             ("ann smith", "WAIT", "2017-06-01T14:05:00Z"),
+                             ("ann smith", "ABSENT", "2017-06-01T14:06:00Z")]),
+         [(RESPONSE, "200 unchanged stale superseded applied")]),
+        (CARL, "STATUS", [(CARL, "You are currently marked as IN.")]),
+        (ANN, "STATUS", [(ANN, "You are currently marked as ABSENT.")])]),
+    ("Check-ins in CSV, and too many at once", [
+        # The + in the counter's number arrives as a space.
+        (CHECKINS, checkins_csv(["bob,IN,", "carl,absent,1496343900",
+                                 "+1 555 000 0003,in,", "ann smith,IN,",
+                                 "zed,IN,"]),
+         [(RESPONSE, "413 At most 4 changes")]),
+        (CHECKINS, checkins_csv(["bob,IN,", "carl,absent,1496343900",
+                                 "zed,IN,"]),
+         [(RESPONSE, "200 applied applied error")]),
+        (BOB, "NOTRIDING", [(BOB, "Absent: Carl")])]),
+    ("Without the database, people can still check in and out", [
+        (DATABASE, ('down',), []),
+        (ANN_LEE, "IN", []),
+        (CARL, "OUT", [(CARL, "may safely step off the bus")]),
+        (BOB, "MARK ann smith AS absent",
+         [(ANN, "Notice: Bob marked you as ABSENT.")]),
+        (BOB, "PING", [(BOB, "can't reach its database")]),
+        (BOB, "LIST", [(BOB, "Bob - UNSET; Carl - OUT")]),
+        (DATABASE, ('up',), []),
+        (BOB, "LIST", [(BOB, "Bob - UNSET; Carl - OUT")])]),
+    ("Newer changes win over ones made without the database", [
+        (DATABASE, ('down',), []),
+        (ANN_LEE, "IN", []),
+        (CARL, "WAIT", [(BOB, "Carl is on their way")]),
+        (DATABASE, ('set', CARL, 'ABSENT'), []),
+        (DATABASE, ('up',), [(ANN, "Carl changed status here, but the "
+                                   "database has a newer status")]),
+        (BOB, "LIST", [(BOB, "Ann Smith - UNSET; Bob - UNSET")]),
+        (BOB, "NOTRIDING", [(BOB, "Absent: Carl")])]),
+]
+
+
+class RecordingOutbox:
+    """
+    Stands in for BusBot's outbox, keeping the texts instead of sending them
+    (straight away, so anything waiting for a text to go out happens before
+    the request that sent it is finished).
+    """
+    def __init__(self):
+        self.sent = []
+
+    def put(self, message):
+        if message.still_wanted is None or message.still_wanted(message):
+            message.status = 'sent'
+            self.sent.append((message.to_phone, message.body))
+        else:
+            message.status = 'skipped'
+        if message.on_done is not None:
+            message.on_done(message)
+
+    def take(self):
+        sent, self.sent = self.sent, []
+        return sent
+
+
+class ScratchPostgres:
+    """
+    A Postgres server in a temporary directory, listening on a free port on
+    localhost, for the duration of a with block.
+    """
+    def __init__(self):
+        bin_dir = os.environ.get('PG_BIN', '')
+        self.initdb = os.path.join(bin_dir, 'initdb')
+        self.pg_ctl = os.path.join(bin_dir, 'pg_ctl')
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='busbot-harness-')
+        data = os.path.join(self.dir, 'data')
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            port = s.getsockname()[1]
+        try:
+            subprocess.check_call([self.initdb, '-D', data, '-U', 'postgres',
+                                   '-A', 'trust', '-E', 'UTF8', '-N'],
+                                  stdout=subprocess.DEVNULL)
+            subprocess.check_call(
+                [self.pg_ctl, '-D', data, '-w', '-l',
+                 os.path.join(self.dir, 'postgres.log'), '-o',
+                 "-h localhost -p %i -k %s -F" % (port, self.dir), 'start'],
+                stdout=subprocess.DEVNULL)
+        except Exception:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            raise
+        return "postgresql://postgres@localhost:%i/postgres" % port
+
+    def __exit__(self, *exc_info):
+        subprocess.call([self.pg_ctl, '-D', os.path.join(self.dir, 'data'),
+                         '-m', 'immediate', 'stop'],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Harness:
+    "BusBot, running in this process against the database at /database_url/."
+    def __init__(self, database_url):
+        os.environ['DATABASE_URL'] = database_url
+        # A snapshot of its own, so nothing left in the journal by a real
+        # BusBot (or an earlier run) is replayed into this database.
+        snapshot_dir = tempfile.mkdtemp(prefix='busbot-harness-snapshot-')
+        atexit.register(shutil.rmtree, snapshot_dir, ignore_errors=True)
+        os.environ['BUSBOT_SNAPSHOT'] = os.path.join(snapshot_dir,
+                                                     'snapshot.sqlite3')
+        self.conn = psycopg2.connect(database_url)
+        cursor = self.conn.cursor()
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cursor.execute("SELECT trip_id FROM trips WHERE phone IS NULL")
+        self.trip_id = cursor.fetchone()[0]
+        self.conn.commit()
+
+        import app
+        self.app = app
+        self.outbox = app.outbox = RecordingOutbox()
+        app.DEBUG = False
+        app.SUPERUSER = ANN
+        app.CHECKIN_API_TOKEN = CHECK_TOKEN
+        app.CHECKIN_BATCH_MAX = CHECK_BATCH_MAX
+        # The checks find the database again themselves (see DATABASE).
+        app.database.retry_interval = 24 * 60 * 60
+        self.client = app.app.test_client()
+
+    def load_roster(self, people, counters):
+        """
+        Replace the roster with /people/, a list of (firstname, lastname,
+        phone), everyone UNSET, and with the phones in /counters/ as bus
+        counters. Everyone but them may send CHECK_SENDER_BURST commands that
+        get a reply (see SenderLimits in app.py), and no more. BusBot has
+        the database again, if a check took it away or broke it, with
+        nothing journaled, and sends the counters' notifications straight
+        away (see DIGEST).
+        """
+        app = self.app
+        app.counter_digest.window = 0
+        app.database.degraded = False
+        journaled = app.snapshot.journaled()
+        if journaled:
+            app.snapshot.forget(journaled[-1][0])
+        cursor = self.conn.cursor()
+        cursor.execute(MEND_USERS)
+        cursor.execute("SET LOCAL busbot.quiet = 'on'")
+        cursor.execute("DELETE FROM users WHERE trip_id = %s", (self.trip_id,))
+        cursor.execute("DELETE FROM ping_rounds WHERE trip_id = %s",
+                       (self.trip_id,))
+        for firstname, lastname, phone in people:
+            cursor.execute("""INSERT INTO users (trip_id, firstname, lastname,
+                                                 phone, iscounter)
+                              VALUES (%s, %s, %s, %s, %s)""",
+                           (self.trip_id, firstname, lastname, phone,
+                            phone in counters))
+        cursor.execute("UPDATE status SET all_in = false WHERE trip_id = %s",
+                       (self.trip_id,))
+        cursor.execute(RECOUNT % "t.trip_id = %s", (self.trip_id,))
+        self.conn.commit()
+        with self.app.app.app_context():
+            self.app.get_trips().load(self.app.get_db())
+            self.app.get_roster(self.trip_id).load(self.app.get_db())
+        self.outbox.take()
+        self.app.sender_limits = self.app.SenderLimits(CHECK_SENDER_BURST, 0,
+                                                       len(people))
+
+    def say(self, phone, body):
+        """
+        Send BusBot a message from /phone/; return the texts it sent, the
+        other texts first and then the replies in its response.
+        """
+        self.last_message = {'MessageSid': 'SM' + uuid.uuid4().hex,
+                             'From': phone,
+                             'To': self.app.OUR_NUMBER,
+                             'Body': body}
+        return self.send(self.last_message)
+
+    def retry(self):
+        "Send the last message again, as in RETRY; return the texts sent."
+        self.app.processed_messages._recent.clear()
+        return self.send(self.last_message)
+
+    def send(self, form):
+        response = self.client.post('/receivemsg', data=form)
+        replies = ElementTree.fromstring(response.data).findall('Message')
+        return self.outbox.take() + [(form['From'], i.text)
+                                     for i in replies]
+
+    def post_checkins(self, request):
+        """
+        POST /request/, a (body, content type, query string, token) tuple,
+        to /checkins; return the texts BusBot sent, and then the response
+        as a text to RESPONSE (see CHECKINS).
+        """
+        body, content_type, query, token = request
+        response = self.client.post(
+            '/checkins?' + query, data=body, content_type=content_type,
+            headers={'Authorization': 'Bearer ' + token})
+        answer = json.loads(response.get_data(as_text=True))
+        if 'results' in answer:
+            summary = ' '.join(i['result'] for i in answer['results'])
+        else:
+            summary = answer['error']
+        return self.outbox.take() + [
+            (RESPONSE, "%i %s" % (response.status_code, summary))]
+
+    def change_database(self, step):
+        "Do the DATABASE /step/; return the texts BusBot sent."
+        if step[0] == 'down':
+            self.app.database.lost()
+        elif step[0] == 'up':
+            self.app.database.reconnect(self.app.app)
+        elif step[0] == 'break':
+            cursor = self.conn.cursor()
+            cursor.execute(BREAK_USERS)
+            self.conn.commit()
+        elif step[0] == 'mend':
+            cursor = self.conn.cursor()
+            cursor.execute(MEND_USERS)
+            self.conn.commit()
+        else:
+            _, phone, status = step
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT set_user_statuses(%s, ARRAY[%s]::VARCHAR[],
+                                                       %s, ARRAY[now()])""",
+                           (self.trip_id, phone, status))
+            self.conn.commit()
+        return self.outbox.take()
+
+    def digest(self, step):
+        "Do the DIGEST /step/; return the texts BusBot sent."
+        if step[0] == 'window':
+            self.app.counter_digest.window = step[1]
+        else:
+            time.sleep(self.app.counter_digest.window + 0.2)
+        return self.outbox.take()
+
+    def inconsistencies(self):
+        """
+        Return a list of the ways the status tallies, the users table, and
+        the in-memory roster disagree with each other.
+        """
+        app = self.app
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT phone, curstatus, iscounter FROM users
+                          WHERE trip_id = %s""", (self.trip_id,))
+        stored = {phone: (status, iscounter)
+                  for phone, status, iscounter in cursor.fetchall()}
+        cursor.execute("SELECT %s FROM status WHERE trip_id = %%s"
+                       % ', '.join(app.status_count_column(i)
+                                   for i in app.Roster.STATUSES),
+                       (self.trip_id,))
+        tallies = dict(zip(app.Roster.STATUSES, cursor.fetchone()))
+        self.conn.commit()
+
+        problems = []
+        roster = app.get_roster(self.trip_id)
+        for status in app.Roster.STATUSES:
+            actual = sum(1 for i, _ in stored.values() if i == status)
+            if tallies[status] != actual:
+                problems.append("tally of %s is %i, but %i people have it"
+                                % (status, tallies[status], actual))
+            if roster.count(status) != actual:
+                problems.append("roster has %i people %s, database has %i"
+                                % (roster.count(status), status, actual))
+        for phone, (status, iscounter) in stored.items():
+            user_info = roster.get(phone)
+            if (user_info is None or user_info['curstatus'] != status
+                    or user_info['iscounter'] != iscounter):
+                problems.append("roster has %s as %r, database as %r"
+                                % (phone, user_info, (status, iscounter)))
+        return problems
+
+
+def quiet():
+    "BusBot logs every message it gets and sends; that's too much to read."
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+def run_check(harness, description, steps):
+    "Run one of the CHECKS; return a list of what went wrong."
+    harness.load_roster(ROSTER, [BOB])
+    problems = []
+    with quiet(), harness.app.app.app_context():
+        for phone, body, expected in steps:
+            if phone == CHECKINS:
+                sent = harness.post_checkins(body)
+            elif phone == DATABASE:
+                sent = harness.change_database(body)
+            elif phone == DIGEST:
+                sent = harness.digest(body)
+            elif phone == RETRY:
+                sent = harness.retry()
+            else:
+                sent = harness.say(phone, body)
+            unmatched = list(sent)
+            for to_phone, text in expected:
+                for i, (sent_to, sent_body) in enumerate(unmatched):
+                    if sent_to == to_phone and text in sent_body:
+                        del unmatched[i]
+                        break
+                else:
+                    problems.append("%s %r: %s wasn't sent %r"
+                                    % (phone, body, to_phone, text))
+            for sent_to, sent_body in unmatched:
+                problems.append("%s %r: %s was unexpectedly sent %r"
+                                % (phone, body, sent_to, sent_body))
+    return problems + harness.inconsistencies()
+
+def check(harness):
+    failed = 0
+    for description, steps in CHECKS:
+        problems = run_check(harness, description, steps)
+        print("%s %s" % ("ok  " if not problems else "FAIL", description))
+        for problem in problems:
+            print("         " + problem)
+        failed += bool(problems)
+    print("%i of %i checks passed." % (len(CHECKS) - failed, len(CHECKS)))
+    return failed
+
+
+## Scenarios for profiling.
+def checks_scenario(harness, group_size):
+    "All the CHECKS."
+    for description, steps in CHECKS:
+        run_check(harness, description, steps)
+
+def boarding_scenario(harness, group_size):
+    """
+    A group checking in: the counters LIST and PING every so often while
+    people text IN or WAIT, and then MARK the stragglers IN.
+    """
+    group = [(firstname, lastname, "+1" + phone)
+             for firstname, lastname, phone in make_group(group_size)]
+    counters = [phone for _, _, phone in group[:BOARDING_COUNTERS]]
+    harness.load_roster(group, counters)
+    with harness.app.app.app_context():
+        for i, (firstname, lastname, phone) in enumerate(group):
+            if i % 10 == 0:
+                harness.say(counters[i % len(counters)], "LIST")
+                harness.say(counters[i % len(counters)], "PING")
+            harness.say(phone, "WAIT" if i % 7 == 0 else "IN")
+        for i, (firstname, lastname, phone) in enumerate(group):
+            if i % 7 == 0:
+                harness.say(counters[i % len(counters)],
+                            "MARK %s %s AS IN" % (firstname, lastname))
+        harness.say(counters[0], "RESET")
+
+SCENARIOS = {'checks': checks_scenario, 'boarding': boarding_scenario}
+
+
+def profile(harness, args):
+    scenario = SCENARIOS[args.scenario]
+    profiler = cProfile.Profile()
+    with quiet():
+        start = time.time()
+        profiler.runcall(scenario, harness, args.group_size)
+        wall_time = time.time() - start
+    print("%s: %.2f s" % (args.scenario, wall_time))
+    if args.out:
+        profiler.dump_stats(args.out)
+        print("Profile saved to %s." % args.out)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+def flamegraph(args):
+    "Run this script's profile command again under py-spy."
+    command = [sys.executable, os.path.abspath(__file__)]
+    if args.database_url:
+        command += ['--database-url', args.database_url]
+    command += ['profile', '--scenario', args.scenario,
+                '--group-size', str(args.group_size)]
+    try:
+        return subprocess.call(['py-spy', 'record', '--output', args.flamegraph,
+                                '--format', 'flamegraph', '--subprocesses',
+                                '--'] + command)
+    except FileNotFoundError:
+        print("py-spy isn't installed; try 'pip install py-spy'.")
+        return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Check or profile BusBot without any network.")
+    parser.add_argument('--database-url')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('check')
+    profile_parser = subparsers.add_parser('profile')
+    profile_parser.add_argument('--scenario', default='boarding',
+                                choices=sorted(SCENARIOS))
+    profile_parser.add_argument('--group-size', type=int, default=90)
+    profile_parser.add_argument('--out')
+    profile_parser.add_argument('--flamegraph')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    if args.command == 'profile' and args.flamegraph:
+        sys.exit(flamegraph(args))
+
+    def run(database_url):
+        harness = Harness(database_url)
+        if args.command == 'check':
+            return 1 if check(harness) else 0
+        profile(harness, args)
+        return 0
+
+    if args.database_url:
+        status = run(args.database_url)
+    else:
+        with ScratchPostgres() as database_url:
+            status = run(database_url)
+            # Keep BusBot from complaining as the server goes away under it.
+            sys.stdout.flush()
+            sys.stdout = open(os.devnull, 'w')
+    # BusBot's background threads would otherwise keep us running.
+    sys.stdout.flush()
+    os._exit(status)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Load the users listed in a CSV file into BusBot's database, in the same format
+recreate_database.py uses (first name, last name, 10-digit phone number).
+Unlike recreate_database.py, this can be used on a group that's already using
+BusBot: new people are added, people who aren't in the file anymore are
+removed, and people whose names have changed are updated, but everyone else
+keeps their current status and bus counter privileges.
+
+Run it like 'python import_roster.py ROSTER_FILENAME [--dry-run]' with
+DATABASE_URL set to the database's URL; on Heroku, that's
+
+    DATABASE_URL=$(heroku config:get DATABASE_URL) python import_roster.py FILE
+
+It reports who was added, removed, and renamed. With --dry-run, it reports
+what it would have done and leaves the database alone. If the database hasn't
+been set up yet, it is set up first.
+
+To run several trips (each with its own roster and Twilio number) from one
+BusBot, give the name of the trip with --trip. The trip is created if it
+doesn't exist yet, in which case --number, the Twilio number for the trip, is
+required; --number and --superuser (the phone number of the trip's
+superuser, if it isn't SUPERUSER in app.py) can also be used to change an
+existing trip. Without --trip, the roster is loaded into the trip that uses
+OUR_NUMBER from app.py, as when BusBot only ran one trip. Other trips are not
+touched.
+
+The CSV file is streamed straight into the database with COPY and merged
+there, so even very large rosters only take a few seconds.
+"""
+
+import argparse
+import os
+import sys
+
+import psycopg2
+
+from schema import ADD_STATUS_ROWS, RECOUNT, SCHEMA
+
+# How many names to list when reporting each kind of change.
+MAX_NAMES_SHOWN = 10
+
+
+def show_changes(description, rows):
+    print("%s: %i" % (description, len(rows)))
+    for firstname, lastname, phone in rows[:MAX_NAMES_SHOWN]:
+        print("    %s %s (%s)" % (firstname, lastname, phone))
+    if len(rows) > MAX_NAMES_SHOWN:
+        print("    ...and %i more" % (len(rows) - MAX_NAMES_SHOWN))
+
+
+parser = argparse.ArgumentParser(
+    description="Load a roster into a BusBot database.")
+parser.add_argument('roster')
+parser.add_argument('--trip')
+parser.add_argument('--number')
+parser.add_argument('--superuser')
+parser.add_argument('--dry-run', action='store_true')
+args = parser.parse_args()
+dry_run = args.dry_run
+
+conn = psycopg2.connect(os.environ["DATABASE_URL"])
+cursor = conn.cursor()
+for statement in SCHEMA:
+    cursor.execute(statement)
+if not dry_run:
+    # Don't hold on to the locks setting up the schema takes, which would
+    # keep BusBot from changing any trip while we work.
+    conn.commit()
+
+if args.trip is None:
+    if args.number is not None:
+        print("--number can only be used with --trip.")
+        sys.exit(1)
+    cursor.execute("SELECT trip_id FROM trips WHERE phone IS NULL")
+else:
+    cursor.execute("SELECT trip_id FROM trips WHERE name = %s", (args.trip,))
+row = cursor.fetchone()
+if row is not None:
+    trip_id = row[0]
+    if args.number is not None:
+        cursor.execute("UPDATE trips SET phone = %s WHERE trip_id = %s",
+                       (args.number, trip_id))
+elif args.trip is not None and args.number is None:
+    print("Trip %s doesn't exist yet; give its Twilio number with --number "
+          "to create it." % args.trip)
+    sys.exit(1)
+else:
+    cursor.execute("INSERT INTO trips (name, phone) VALUES (%s, %s) RETURNING trip_id",
+                   (args.trip or 'default', args.number))
+    trip_id = cursor.fetchone()[0]
+    cursor.execute(ADD_STATUS_ROWS)
+    print("Created trip %s." % (args.trip or 'default'))
+if args.superuser is not None:
+    cursor.execute("UPDATE trips SET superuser = %s WHERE trip_id = %s",
+                   (args.superuser, trip_id))
+
+# Load the file as-is into a staging table, then clean it up.
+cursor.execute("""CREATE TEMPORARY TABLE staging (
+                      firstname VARCHAR, lastname VARCHAR, rawphone VARCHAR)
+                  ON COMMIT DROP""")
+with open(args.roster, 'r') as f:
+    cursor.copy_expert("""COPY staging (firstname, lastname, rawphone)
+                          FROM STDIN WITH (FORMAT csv)""", f)
+cursor.execute("""ALTER TABLE staging ADD COLUMN phone VARCHAR;
+                  UPDATE staging SET
+                      firstname = TRIM(firstname),
+                      lastname = COALESCE(TRIM(lastname), ''),
+                      phone = '+1' || REGEXP_REPLACE(rawphone, '[[:punct:][:space:]]', '', 'g')""")
+
+cursor.execute("""SELECT firstname, lastname, rawphone FROM staging
+                  WHERE phone IS NULL OR phone !~ '^\\+1[0-9]{10}$'
+                        OR firstname IS NULL OR firstname = ''""")
+invalid = cursor.fetchall()
+if invalid:
+    show_changes("Invalid lines (nothing was imported)", invalid)
+    sys.exit(1)
+
+cursor.execute("""SELECT firstname, lastname, phone FROM staging
+                  WHERE phone IN (SELECT phone FROM staging
+                                  GROUP BY phone HAVING COUNT(*) > 1)
+                  ORDER BY phone""")
+duplicates = cursor.fetchall()
+if duplicates:
+    show_changes("Phone numbers listed more than once (nothing was imported)",
+                 duplicates)
+    sys.exit(1)
+cursor.execute("CREATE UNIQUE INDEX ON staging (phone)")
+
+# Merging would notify the running app once per changed row (see schema.py);
+# we turn that off and tell it to reload the whole trip at the end instead.
+cursor.execute("SET LOCAL busbot.quiet = 'on'")
+
+cursor.execute("""SELECT firstname, lastname, phone FROM staging s
+                  WHERE NOT EXISTS (SELECT * FROM users u
+                                    WHERE u.trip_id = %s AND u.phone = s.phone)
+                  ORDER BY lastname, firstname""", (trip_id,))
+added = cursor.fetchall()
+cursor.execute("""SELECT firstname, lastname, phone FROM users u
+                  WHERE u.trip_id = %s
+                        AND NOT EXISTS (SELECT * FROM staging s
+                                        WHERE s.phone = u.phone)
+                  ORDER BY lastname, firstname""", (trip_id,))
+removed = cursor.fetchall()
+cursor.execute("""SELECT s.firstname, s.lastname, s.phone
+                  FROM staging s JOIN users u
+                      ON u.trip_id = %s AND u.phone = s.phone
+                  WHERE (u.firstname, u.lastname)
+                        <> (s.firstname, s.lastname)
+                  ORDER BY s.lastname, s.firstname""", (trip_id,))
+renamed = cursor.fetchall()
+
+cursor.execute("""INSERT INTO users (trip_id, firstname, lastname, phone)
+                  SELECT %s, firstname, lastname, phone FROM staging
+                  ON CONFLICT (trip_id, phone) DO UPDATE
+                      SET firstname = EXCLUDED.firstname,
+                          lastname = EXCLUDED.lastname
+                      WHERE (users.firstname, users.lastname)
+                            <> (EXCLUDED.firstname, EXCLUDED.lastname)""",
+               (trip_id,))
+cursor.execute("""DELETE FROM users u
+                  WHERE u.trip_id = %s
+                        AND NOT EXISTS (SELECT * FROM staging s
+                                        WHERE s.phone = u.phone)""", (trip_id,))
+cursor.execute(RECOUNT % "t.trip_id = %s", (trip_id,))
+cursor.execute("SELECT pg_notify('roster_changed', %s)", ("%i *" % trip_id,))
+
+show_changes("Added", added)
+show_changes("Removed", removed)
+show_changes("Renamed", renamed)
+if dry_run:
+    conn.rollback()
+    print("Dry run; no changes were made.")
+else:
+    conn.commit()
@@ -0,0 +1,111 @@
+"""
+metrics.py -- a small registry of counters, gauges, and histograms that
+BusBot keeps about itself, rendered in the Prometheus text format for the
+/metrics endpoint.
+
+Each worker process has its own registry, so the numbers served by /metrics
+are for whichever worker answered the request; every series is labeled with
+the worker's process ID so they can be told apart (and summed) when scraped.
+
+Copyright (c) 2017 Soren Bjornstad <contact@sorenbjornstad.com>.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+
+# Upper bounds (in seconds) of the histogram buckets for timings.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """
+    A set of named metrics. Call describe() once for each metric, then inc(),
+    set(), or observe() it (according to its type) with a dictionary of
+    labels, and render() the whole set for Prometheus.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._values = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text):
+        "Declare a metric of /kind/ 'counter', 'gauge', or 'histogram'."
+        self._descriptions[name] = (kind, help_text)
+
+    def inc(self, name, labels=None, amount=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = [0] * len(TIME_BUCKETS) + [0, 0]
+            histogram = self._histograms[key]
+            for i, bound in enumerate(TIME_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        "Return all the metrics in the Prometheus text exposition format."
+        pid = str(os.getpid())
+        lines = []
+        with self._lock:
+            for name in sorted(self._descriptions):
+                kind, help_text = self._descriptions[name]
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for (key_name, labels), value in sorted(self._values.items()):
+                    if key_name == name:
+                        lines.append(self._line(name, labels, pid, value))
+                for (key_name, labels), histogram in sorted(
+                        self._histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, count in zip(TIME_BUCKETS, histogram):
+                        lines.append(self._line(name + '_bucket', labels, pid,
+                                                count, ('le', repr(bound))))
+                    lines.append(self._line(name + '_bucket', labels, pid,
+                                            histogram[-1], ('le', '+Inf')))
+                    lines.append(self._line(name + '_sum', labels, pid,
+                                            histogram[-2]))
+                    lines.append(self._line(name + '_count', labels, pid,
+                                            histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    @staticmethod
+    def _line(name, labels, pid, value, extra_label=None):
+        labels = labels + (('worker', pid),)
+        if extra_label is not None:
+            labels += (extra_label,)
+        label_text = ','.join('%s="%s"' % (label, str(label_value)
+                                           .replace('\\', '\\\\')
+                                           .replace('"', '\\"'))
+                              for label, label_value in labels)
+        return "%s{%s} %s" % (name, label_text, repr(float(value)))
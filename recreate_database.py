@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """
 Output SQL code to add the users listed in a CSV file to BusBot's database.
-See the setup instructions in the README for more information.
+See the setup instructions in the README for more information. This wipes out
+everyone's status and bus counter privileges, the log of past status
+changes, and any trips other than the one using OUR_NUMBER; to update the
+roster of a group that's already using BusBot, or to add more trips, use
+import_roster.py instead.
 
 NOTE: This script is SQL injection vulnerable. Never run it on unverified CSV
 input, and check the output before piping it into the database!
@@ -10,6 +14,8 @@ input, and check the output before piping it into the database!
 import string
 import sys
 
+from schema import RECOUNT, SCHEMA
+
 if len(sys.argv) < 2:
     print("Usage: python recreate_database.py ROSTER_FILENAME")
     sys.exit(1)
@@ -22,13 +28,17 @@ with open(roster, 'r') as f:
         firstname, lastname, phone = (i.strip() for i in user.split(','))
         phone = "+1" + "".join(i for i in phone if i not in string.punctuation)
         assert len(phone) == 12, "Phone number %s invalid" % phone
-        insert_statements.append("INSERT INTO users (iscounter, firstname, lastname, phone, curstatus) VALUES (false, '%s', '%s', '%s', 'UNSET');" % (firstname, lastname, phone))
+        insert_statements.append("INSERT INTO users (trip_id, iscounter, firstname, lastname, phone, curstatus) SELECT trip_id, false, '%s', '%s', '%s', 'UNSET' FROM trips;" % (firstname, lastname, phone))
 
 print("BEGIN TRANSACTION;")
-print("DROP TABLE users;")
-print("DROP TABLE status;")
-print("CREATE TABLE users (uid serial PRIMARY KEY, iscounter BOOLEAN, firstname VARCHAR, lastname VARCHAR, phone VARCHAR, curstatus VARCHAR);")
-print("CREATE TABLE status (uid serial PRIMARY KEY, all_in BOOLEAN);")
-print("INSERT INTO status (all_in) VALUES (false);")
+print("DROP TABLE IF EXISTS users;")
+print("DROP TABLE IF EXISTS status;")
+print("DROP TABLE IF EXISTS ping_recipients;")
+print("DROP TABLE IF EXISTS ping_rounds;")
+print("DROP TABLE IF EXISTS trips;")
+print("DROP TABLE IF EXISTS status_events;")
+for statement in SCHEMA:
+    print(statement + ";")
 print("\n".join(insert_statements))
+print(RECOUNT % "true" + ";")
 print("COMMIT;")
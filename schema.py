@@ -0,0 +1,307 @@
+"""
+schema.py -- the SQL that sets up BusBot's database tables. Both
+recreate_database.py and import_roster.py run these statements; they're safe
+to run against a database that's already set up, so change them here (in a
+way that still is) when BusBot needs new columns, tables, or indexes.
+
+Copyright (c) 2017 Soren Bjornstad <contact@sorenbjornstad.com>.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+# Give every trip that doesn't have one a row in the status table.
+ADD_STATUS_ROWS = """
+    INSERT INTO status (trip_id)
+    SELECT trip_id FROM trips t
+    WHERE NOT EXISTS (SELECT * FROM status s WHERE s.trip_id = t.trip_id)"""
+
+SCHEMA = [
+    # Each trip (a group being counted onto a bus) has its own roster, tallies,
+    # and Twilio number. At most one trip may have no number of its own; it
+    # uses OUR_NUMBER in app.py and gets messages to any unknown number. A
+    # database set up before there were trips has its users moved into this
+    # default trip.
+    """CREATE TABLE IF NOT EXISTS trips (
+           trip_id serial PRIMARY KEY,
+           name VARCHAR NOT NULL UNIQUE,
+           phone VARCHAR UNIQUE,
+           superuser VARCHAR)""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS trips_default
+           ON trips ((phone IS NULL)) WHERE phone IS NULL""",
+    "INSERT INTO trips (name) SELECT 'default' WHERE NOT EXISTS (SELECT * FROM trips)",
+
+    """CREATE TABLE IF NOT EXISTS users (
+           uid serial PRIMARY KEY,
+           trip_id INTEGER NOT NULL REFERENCES trips,
+           iscounter BOOLEAN NOT NULL DEFAULT false,
+           firstname VARCHAR NOT NULL,
+           lastname VARCHAR NOT NULL,
+           phone VARCHAR NOT NULL,
+           curstatus VARCHAR NOT NULL DEFAULT 'UNSET')""",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS trip_id INTEGER REFERENCES trips",
+    """UPDATE users SET trip_id = (SELECT trip_id FROM trips WHERE phone IS NULL)
+           WHERE trip_id IS NULL""",
+    "ALTER TABLE users ALTER COLUMN trip_id SET NOT NULL",
+    # Users tables from before this file left these columns without defaults.
+    "ALTER TABLE users ALTER COLUMN curstatus SET DEFAULT 'UNSET'",
+    "UPDATE users SET curstatus = 'UNSET' WHERE curstatus IS NULL",
+    "ALTER TABLE users ALTER COLUMN curstatus SET NOT NULL",
+    "ALTER TABLE users ALTER COLUMN iscounter SET DEFAULT false",
+    "UPDATE users SET iscounter = false WHERE iscounter IS NULL",
+    "ALTER TABLE users ALTER COLUMN iscounter SET NOT NULL",
+    # When the user's status last changed, so a late-arriving batch of
+    # check-ins (see receive_checkins() in app.py) can't undo a newer change.
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS status_at TIMESTAMP WITH TIME ZONE",
+    # Every lookup and update of a single user goes by trip and phone number,
+    # and import_roster.py relies on this index to merge rosters (ON
+    # CONFLICT). Everything else BusBot does to users is for one whole trip,
+    # which this index also finds without looking at other trips' rows.
+    "DROP INDEX IF EXISTS users_phone",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_trip_phone ON users (trip_id, phone)",
+    "DROP INDEX IF EXISTS users_names",
+    """CREATE INDEX IF NOT EXISTS users_trip_names
+           ON users (trip_id, LOWER(firstname), LOWER(lastname))""",
+
+    # Each trip's row of the status table holds its status bits and a tally
+    # of its users with each status. The only status bit is all_in, which is
+    # set while everyone is IN or ABSENT, so that BusBot can tell the bus
+    # counters when that happens and warn them if someone gets off the bus
+    # after it has.
+    """CREATE TABLE IF NOT EXISTS status (
+           uid serial PRIMARY KEY,
+           trip_id INTEGER NOT NULL REFERENCES trips,
+           all_in BOOLEAN NOT NULL DEFAULT false,
+           n_unset INTEGER NOT NULL DEFAULT 0,
+           n_in INTEGER NOT NULL DEFAULT 0,
+           n_out INTEGER NOT NULL DEFAULT 0,
+           n_wait INTEGER NOT NULL DEFAULT 0,
+           n_absent INTEGER NOT NULL DEFAULT 0)""",
+    "ALTER TABLE status ADD COLUMN IF NOT EXISTS trip_id INTEGER REFERENCES trips",
+    """UPDATE status SET trip_id = (SELECT trip_id FROM trips WHERE phone IS NULL)
+           WHERE trip_id IS NULL""",
+    "ALTER TABLE status ALTER COLUMN trip_id SET NOT NULL",
+    "ALTER TABLE status ALTER COLUMN all_in SET DEFAULT false",
+    "UPDATE status SET all_in = false WHERE all_in IS NULL",
+    "ALTER TABLE status ALTER COLUMN all_in SET NOT NULL",
+    # A status table from before the tallies gets them, counted from the
+    # users table. (Only then: counting again while BusBot is running could
+    # miss a change made in the meantime.)
+    """DO $$
+       BEGIN
+           IF NOT EXISTS (SELECT * FROM information_schema.columns
+                          WHERE table_name = 'status'
+                                AND column_name = 'n_unset') THEN
+               ALTER TABLE status
+                   ADD COLUMN IF NOT EXISTS n_unset INTEGER NOT NULL DEFAULT 0,
+                   ADD COLUMN IF NOT EXISTS n_in INTEGER NOT NULL DEFAULT 0,
+                   ADD COLUMN IF NOT EXISTS n_out INTEGER NOT NULL DEFAULT 0,
+                   ADD COLUMN IF NOT EXISTS n_wait INTEGER NOT NULL DEFAULT 0,
+                   ADD COLUMN IF NOT EXISTS n_absent INTEGER NOT NULL DEFAULT 0;
+               UPDATE status s SET
+                   n_unset = c.n_unset, n_in = c.n_in, n_out = c.n_out,
+                   n_wait = c.n_wait, n_absent = c.n_absent
+               FROM (SELECT u.trip_id,
+                            COUNT(*) FILTER (WHERE u.curstatus = 'UNSET') AS n_unset,
+                            COUNT(*) FILTER (WHERE u.curstatus = 'IN') AS n_in,
+                            COUNT(*) FILTER (WHERE u.curstatus = 'OUT') AS n_out,
+                            COUNT(*) FILTER (WHERE u.curstatus = 'WAIT') AS n_wait,
+                            COUNT(*) FILTER (WHERE u.curstatus = 'ABSENT') AS n_absent
+                     FROM users u GROUP BY u.trip_id) c
+               WHERE s.trip_id = c.trip_id;
+           END IF;
+       END $$""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS status_trip ON status (trip_id)",
+    ADD_STATUS_ROWS,
+
+    # Set the status of the users of trip /p_trip_id/ with the phone numbers
+    # /p_phones/ to /p_status/, keeping the trip's tallies right and setting
+    # its all_in bit to whether nobody is missing any more. /p_ats/, if not
+    # NULL, holds when each of them changed status (otherwise it's now);
+    # users whose status changed after that are left alone. The trip's status
+    # row is locked first, so status changes on a trip happen one at a time
+    # and each sees the bit as the last one left it. Returns a row for each
+    # user changed, with their old status, whether the bit was set before,
+    # and the trip's status row afterwards.
+    "DROP FUNCTION IF EXISTS set_user_statuses(INTEGER, VARCHAR[], VARCHAR)",
+    """CREATE OR REPLACE FUNCTION set_user_statuses(
+           p_trip_id INTEGER, p_phones VARCHAR[], p_status VARCHAR,
+           p_ats TIMESTAMP WITH TIME ZONE[])
+       RETURNS TABLE (phone VARCHAR, old_status VARCHAR, was_all_in BOOLEAN,
+                      all_in BOOLEAN, n_unset INTEGER, n_in INTEGER,
+                      n_out INTEGER, n_wait INTEGER, n_absent INTEGER) AS $$
+       #variable_conflict use_column
+       DECLARE
+           prev_all_in BOOLEAN;
+           changed_phones VARCHAR[];
+           old_statuses VARCHAR[];
+           moved RECORD;
+       BEGIN
+           SELECT s.all_in INTO prev_all_in FROM status s
+               WHERE s.trip_id = p_trip_id FOR UPDATE;
+           WITH wanted AS (
+               SELECT w.phone, COALESCE(w.at, now()) AS at
+               FROM unnest(p_phones, p_ats) AS w (phone, at)),
+           old AS (
+               SELECT u.uid, u.phone, u.curstatus, wanted.at
+               FROM users u JOIN wanted ON wanted.phone = u.phone
+               WHERE u.trip_id = p_trip_id
+                     AND (u.status_at IS NULL OR u.status_at <= wanted.at)
+               ORDER BY u.phone FOR UPDATE OF u),
+           changed AS (
+               UPDATE users u SET curstatus = p_status, status_at = old.at
+               FROM old WHERE u.uid = old.uid
+               RETURNING old.phone, old.curstatus)
+           SELECT array_agg(changed.phone), array_agg(changed.curstatus)
+               INTO changed_phones, old_statuses FROM changed;
+           FOR moved IN SELECT o.status, COUNT(*) AS n
+                        FROM unnest(old_statuses) AS o (status)
+                        WHERE o.status <> p_status GROUP BY o.status LOOP
+               EXECUTE format('UPDATE status SET %1$I = %1$I - $1, %2$I = %2$I + $1
+                               WHERE trip_id = $2',
+                              'n_' || lower(moved.status),
+                              'n_' || lower(p_status))
+                   USING moved.n, p_trip_id;
+           END LOOP;
+           UPDATE status s SET all_in = (s.n_unset + s.n_out + s.n_wait = 0)
+               WHERE s.trip_id = p_trip_id;
+           RETURN QUERY
+               SELECT c.phone, c.old_status, prev_all_in, s.all_in, s.n_unset,
+                      s.n_in, s.n_out, s.n_wait, s.n_absent
+               FROM unnest(changed_phones, old_statuses) AS c (phone, old_status),
+                    status s
+               WHERE s.trip_id = p_trip_id;
+       END;
+       $$ LANGUAGE plpgsql""",
+
+    # Each BusBot worker keeps a copy of the trips table and of the users of
+    # each trip it serves in memory; these triggers tell them what to reread
+    # when something changes. The payload is 'trips' if the list of trips
+    # changed, or else the trip_id and phone number of the user who changed,
+    # separated by a space. (Bulk changes can instead set busbot.quiet to
+    # 'on' and send a single notification with the phone number '*', which
+    # makes them reload the whole trip.)
+    """CREATE OR REPLACE FUNCTION notify_roster_changed() RETURNS trigger AS $$
+       BEGIN
+           IF current_setting('busbot.quiet', true) = 'on' THEN
+               RETURN NULL;
+           END IF;
+           IF TG_OP <> 'INSERT' THEN
+               PERFORM pg_notify('roster_changed', OLD.trip_id || ' ' || OLD.phone);
+           END IF;
+           IF TG_OP <> 'DELETE' THEN
+               PERFORM pg_notify('roster_changed', NEW.trip_id || ' ' || NEW.phone);
+           END IF;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS users_changed ON users",
+    """CREATE TRIGGER users_changed AFTER INSERT OR UPDATE OR DELETE ON users
+           FOR EACH ROW EXECUTE PROCEDURE notify_roster_changed()""",
+    """CREATE OR REPLACE FUNCTION notify_trips_changed() RETURNS trigger AS $$
+       BEGIN
+           PERFORM pg_notify('roster_changed', 'trips');
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS trips_changed ON trips",
+    """CREATE TRIGGER trips_changed AFTER INSERT OR UPDATE OR DELETE ON trips
+           FOR EACH STATEMENT EXECUTE PROCEDURE notify_trips_changed()""",
+
+    # The MessageSid of each incoming message we've handled recently, and the
+    # response we gave, so retries from Twilio aren't handled twice (see
+    # ProcessedMessages in app.py).
+    """CREATE TABLE IF NOT EXISTS processed_messages (
+           sid VARCHAR PRIMARY KEY,
+           received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+           response TEXT)""",
+    """CREATE INDEX IF NOT EXISTS processed_messages_received
+           ON processed_messages (received_at)""",
+
+    # Each PING a bus counter sends (started_by is their uid), and each person
+    # it texted, with /status/ 'queued' until the text is 'sent', 'failed',
+    # or 'skipped' because they checked in before it went out (see PingRound
+    # in app.py). A PING doesn't text people another one has just reached.
+    """CREATE TABLE IF NOT EXISTS ping_rounds (
+           round_id serial PRIMARY KEY,
+           trip_id INTEGER NOT NULL REFERENCES trips,
+           started_by INTEGER,
+           started_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+           finished_at TIMESTAMP WITH TIME ZONE)""",
+    """CREATE INDEX IF NOT EXISTS ping_rounds_trip
+           ON ping_rounds (trip_id, started_at)""",
+    """CREATE TABLE IF NOT EXISTS ping_recipients (
+           round_id INTEGER NOT NULL REFERENCES ping_rounds ON DELETE CASCADE,
+           uid INTEGER NOT NULL,
+           status VARCHAR NOT NULL DEFAULT 'queued',
+           PRIMARY KEY (round_id, uid))""",
+
+    # An append-only log of everyone's status changes, and of when they were
+    # PINGed, for working out after the fact who checked in when (see
+    # EventLog in app.py and status_report.py). /event/ is the new status or
+    # PINGED and /old_status/ the status before, both as EVENT_CODES; /actor/
+    # is the uid of the user who made the change (which is /uid/ unless
+    # someone used MARK), or NULL if nobody did. The table is partitioned by
+    # month (see event_partition()), so old months can be dropped, or kept
+    # without slowing down queries about recent ones.
+    """CREATE TABLE IF NOT EXISTS status_events (
+           at TIMESTAMP WITH TIME ZONE NOT NULL,
+           trip_id INTEGER NOT NULL,
+           uid INTEGER NOT NULL,
+           actor INTEGER,
+           event SMALLINT NOT NULL,
+           old_status SMALLINT)
+       PARTITION BY RANGE (at)""",
+]
+
+# How statuses (and being PINGed) are stored in status_events. Don't
+# renumber these, or the log will stop making sense!
+EVENT_CODES = {'UNSET': 0, 'IN': 1, 'OUT': 2, 'WAIT': 3, 'ABSENT': 4,
+               'PINGED': 5}
+
+def event_partition(month):
+    """
+    Return the statements that create the partition of status_events for the
+    month (in UTC) starting on the date /month/, if it doesn't exist yet.
+    """
+    next_month = (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    name = "status_events_%s" % month.strftime('%Y_%m')
+    return [
+        """CREATE TABLE IF NOT EXISTS %s PARTITION OF status_events
+               FOR VALUES FROM ('%s 00:00+00') TO ('%s 00:00+00')"""
+        % (name, month.isoformat(), next_month.isoformat()),
+        # Finds the events of one user, or one trip, in order.
+        "CREATE INDEX IF NOT EXISTS %s_trip_uid ON %s (trip_id, uid, at)"
+        % (name, name),
+    ]
+
+# Recompute the tallies in the status table from scratch, after changing many
+# users at once. Format this with a condition on t.trip_id choosing the trips
+# to recount.
+RECOUNT = """
+    UPDATE status SET
+        n_unset = c.n_unset, n_in = c.n_in, n_out = c.n_out,
+        n_wait = c.n_wait, n_absent = c.n_absent,
+        all_in = all_in AND c.n_unset + c.n_out + c.n_wait = 0
+    FROM (SELECT t.trip_id,
+                 COUNT(u.uid) FILTER (WHERE u.curstatus = 'UNSET') AS n_unset,
+                 COUNT(u.uid) FILTER (WHERE u.curstatus = 'IN') AS n_in,
+                 COUNT(u.uid) FILTER (WHERE u.curstatus = 'OUT') AS n_out,
+                 COUNT(u.uid) FILTER (WHERE u.curstatus = 'WAIT') AS n_wait,
+                 COUNT(u.uid) FILTER (WHERE u.curstatus = 'ABSENT') AS n_absent
+          FROM trips t LEFT JOIN users u ON u.trip_id = t.trip_id
+          WHERE %s
+          GROUP BY t.trip_id) c
+    WHERE status.trip_id = c.trip_id"""
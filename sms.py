@@ -0,0 +1,142 @@
+"""
+sms.py -- working out how many SMS segments a text takes up, and fitting
+lists of things into as few texts as possible.
+
+A single SMS holds 160 characters of the GSM 7-bit alphabet, where a few
+characters (like [ and €) take up two; a text with any character outside the
+alphabet is sent as UCS-2 instead, and then only 70 fit. Longer texts are
+split into several segments of 153 (or 67) characters, each of which Twilio
+charges for -- so a single curly quote pasted into a WALL can double the cost
+of sending it to everyone. optimize() swaps such characters for their GSM
+equivalents and shortens wordy texts.
+
+Copyright (c) 2017 Soren Bjornstad <contact@sorenbjornstad.com>.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+GSM_CHARS = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# These take an escape character and the character itself.
+GSM_EXTENDED_CHARS = set("\f^{}\\[~]|€")
+
+SEGMENT_LENGTH = 160
+UNICODE_SEGMENT_LENGTH = 70
+# Each segment of a longer text loses a few characters to the header saying
+# how to put the text back together.
+MULTIPART_SEGMENT_LENGTH = 153
+UNICODE_MULTIPART_SEGMENT_LENGTH = 67
+
+# Characters outside the GSM alphabet that phones like to type for you, and
+# what to send instead. Nothing else is changed, since anything else (like
+# accents) could change what a name says.
+GSM_REPLACEMENTS = str.maketrans({
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u201b': "'", '\u2032': "'",
+    '\u00b4': "'", '\u201c': '"', '\u201d': '"', '\u201e': '"', '\u201f': '"',
+    '\u2033': '"', '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-',
+    '\u2014': '-', '\u2015': '-', '\u2026': '...', '\u00a0': ' ', '\u2009': ' ',
+    '\u202f': ' ', '\u200b': '',
+})
+
+# Added to the last text by pack_texts() when not everything fit.
+MORE = "...and %i more."
+
+
+def is_gsm(text):
+    "Return True if /text/ can be sent in the GSM 7-bit alphabet."
+    return all(c in GSM_CHARS or c in GSM_EXTENDED_CHARS for c in text)
+
+def encoding(text):
+    "Return the encoding /text/ will be sent in, 'GSM-7' or 'UCS-2'."
+    return 'GSM-7' if is_gsm(text) else 'UCS-2'
+
+def segments(text):
+    "Return how many SMS segments /text/ takes up."
+    if is_gsm(text):
+        length = len(text) + sum(1 for c in text if c in GSM_EXTENDED_CHARS)
+        single, multipart = SEGMENT_LENGTH, MULTIPART_SEGMENT_LENGTH
+    else:
+        # Characters outside the Basic Multilingual Plane (like emoji) take
+        # two UCS-2 characters each.
+        length = len(text.encode('utf-16-le')) // 2
+        single, multipart = UNICODE_SEGMENT_LENGTH, UNICODE_MULTIPART_SEGMENT_LENGTH
+    if length <= single:
+        return 1
+    return -(-length // multipart)
+
+def fits_in_segment(text):
+    "Return True if /text/ can be sent as a single SMS segment."
+    return segments(text) == 1
+
+def optimize(text, budget, short_forms=()):
+    """
+    Return /text/ made as cheap to send as it safely can be: with characters
+    that have a GSM equivalent replaced by it, if that makes the whole text
+    GSM (see GSM_REPLACEMENTS), and then, while it still takes more than
+    /budget/ segments, with each of the (long, short) pairs in /short_forms/
+    in turn replacing the long phrase by the short one. The short forms are
+    only kept if they save a segment, since they're harder to read.
+    """
+    normalized = text.translate(GSM_REPLACEMENTS)
+    if normalized != text and is_gsm(normalized):
+        text = normalized
+    shortened = text
+    for long_form, short_form in short_forms:
+        if segments(shortened) <= budget:
+            break
+        shortened = shortened.replace(long_form, short_form)
+    return shortened if segments(shortened) < segments(text) else text
+
+def pack_texts(items, separator, header='', max_texts=None):
+    """
+    Join the strings in /items/ with /separator/ into as few texts as
+    possible that each fit in a single SMS segment, the first starting with
+    /header/, and return the list of texts. Items are never split between
+    texts (one too long to fit gets a text to itself).
+
+    If that takes more than /max_texts/ texts, only the first /max_texts/ are
+    returned, with the last one ending by saying how many items were left
+    out. That one always fits in a single segment, even if it has to be left
+    with nothing but the count.
+    """
+    texts = []  # the items in each text
+    for item in items:
+        if texts and fits_in_segment(_render(texts, len(texts) - 1, header,
+                                             separator, item)):
+            texts[-1].append(item)
+        else:
+            texts.append([item])
+
+    left_out = 0
+    if max_texts is not None and len(texts) > max_texts:
+        left_out = sum(len(text_items) for text_items in texts[max_texts:])
+        texts = texts[:max_texts]
+        while texts[-1] and not fits_in_segment(
+                _render(texts, len(texts) - 1, header, separator,
+                        more=left_out)):
+            texts[-1].pop()
+            left_out += 1
+
+    return [_render(texts, i, header, separator,
+                    more=left_out if i == len(texts) - 1 else 0)
+            for i in range(len(texts))]
+
+def _render(texts, index, header, separator, extra_item=None, more=0):
+    "Render the /index/th of the texts being packed by pack_texts()."
+    items = texts[index] + ([extra_item] if extra_item is not None else [])
+    text = (header if index == 0 else '') + separator.join(items)
+    if more:
+        text += (' ' if items else '') + MORE % more
+    return text
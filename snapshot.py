@@ -0,0 +1,239 @@
+"""
+snapshot.py -- a copy of BusBot's trips and rosters in a local SQLite file,
+so that BusBot can keep checking people in while it can't reach Postgres.
+
+Each worker saves the changes it makes to its rosters here (see Roster in
+app.py), and a worker that needs a roster while the database is down reads
+it from here. Changes are saved by a background thread every so often, a
+batch at a time, so that requests never wait on the file. Status changes
+made while the database is down go in the journal, to be replayed into the
+database once it's back (see replay_journal() in app.py). All of a server's
+workers share the file.
+
+Saving to the snapshot is best-effort: if it fails, the error is logged and
+BusBot carries on, since the database is still the real record.
+
+Copyright (c) 2017 Soren Bjornstad <contact@sorenbjornstad.com>.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sqlite3
+import threading
+import time
+import traceback
+
+SCHEMA = [
+    # Which database the snapshot is a copy of.
+    "CREATE TABLE IF NOT EXISTS source (url TEXT NOT NULL)",
+    """CREATE TABLE IF NOT EXISTS trips (
+           trip_id INTEGER PRIMARY KEY,
+           name TEXT NOT NULL,
+           phone TEXT,
+           superuser TEXT)""",
+    """CREATE TABLE IF NOT EXISTS users (
+           trip_id INTEGER NOT NULL,
+           phone TEXT NOT NULL,
+           uid INTEGER NOT NULL,
+           firstname TEXT NOT NULL,
+           lastname TEXT NOT NULL,
+           curstatus TEXT NOT NULL,
+           iscounter INTEGER NOT NULL,
+           PRIMARY KEY (trip_id, phone))""",
+    # Status changes waiting to be replayed into the database: /at/ is when
+    # they were made (seconds since the epoch) and /actor/ the uid of the
+    # user who made them.
+    """CREATE TABLE IF NOT EXISTS journal (
+           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+           trip_id INTEGER NOT NULL,
+           phone TEXT NOT NULL,
+           status TEXT NOT NULL,
+           at REAL NOT NULL,
+           actor INTEGER)""",
+]
+
+
+class Snapshot:
+    """
+    The snapshot in the SQLite file at /path/, of the database at /source/
+    (a snapshot of some other database is thrown away), with changes saved
+    every /interval/ seconds. With an empty /path/, there is no snapshot:
+    nothing is saved, and there's nothing to read.
+    """
+    def __init__(self, path, source, interval):
+        self.path = path
+        self.source = source
+        self.interval = interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending = []  # (sql, parameters) pairs waiting to be saved
+        self._pending_lock = threading.Lock()
+        self._writer = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            # Durable enough to survive BusBot crashing, if not the server.
+            conn.execute("PRAGMA synchronous = NORMAL")
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                row = conn.execute("SELECT url FROM source").fetchone()
+                if row is None or row[0] != self.source:
+                    if row is not None:
+                        print("Snapshot %s was of another database, starting "
+                              "it over." % self.path)
+                    for table in ('source', 'trips', 'users', 'journal'):
+                        conn.execute("DELETE FROM %s" % table)
+                    conn.execute("INSERT INTO source (url) VALUES (?)",
+                                 (self.source,))
+            self._conn = conn
+        return self._conn
+
+    def _write(self, statements):
+        """
+        Queue the (sql, parameters) pairs /statements/ to be run by the
+        writer thread, starting it if it isn't running yet.
+        """
+        if not self.enabled:
+            return
+        with self._pending_lock:
+            self._pending.extend(statements)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_forever,
+                                                daemon=True)
+                self._writer.start()
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        "Save all the waiting changes now, in one transaction."
+        # Taking the batch under _lock keeps a later batch from being saved
+        # before an earlier one.
+        with self._lock:
+            with self._pending_lock:
+                statements, self._pending = self._pending, []
+            if not statements:
+                return
+            try:
+                conn = self._connect()
+                with conn:
+                    for sql, parameters in statements:
+                        if isinstance(parameters, list):
+                            conn.executemany(sql, parameters)
+                        else:
+                            conn.execute(sql, parameters)
+            except sqlite3.Error:
+                print("Couldn't update the snapshot:")
+                print(traceback.format_exc())
+
+    def _read(self, sql, parameters=()):
+        if not self.enabled:
+            return []
+        self.flush()
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    ## Keeping the snapshot up to date.
+    def save_trips(self, rows):
+        "Replace the trips with /rows/, as (trip_id, name, phone, superuser)."
+        self._write([("DELETE FROM trips", ()),
+                     ("INSERT INTO trips VALUES (?, ?, ?, ?)", list(rows))])
+
+    def save_roster(self, trip_id, rows):
+        """
+        Replace the users of trip /trip_id/ with /rows/, as (uid, firstname,
+        lastname, phone, curstatus, iscounter).
+        """
+        self._write([("DELETE FROM users WHERE trip_id = ?", (trip_id,)),
+                     ("""INSERT INTO users (trip_id, uid, firstname, lastname,
+                                            phone, curstatus, iscounter)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      [(trip_id,) + tuple(row) for row in rows])])
+
+    def save_user(self, trip_id, phone, row):
+        "Replace the user /phone/ of trip /trip_id/ with /row/, or None."
+        statements = [("DELETE FROM users WHERE trip_id = ? AND phone = ?",
+                       (trip_id, phone))]
+        if row is not None:
+            statements.append(("""INSERT INTO users (trip_id, uid, firstname,
+                                      lastname, phone, curstatus, iscounter)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                               (trip_id,) + tuple(row)))
+        self._write(statements)
+
+    def set_status(self, trip_id, phone, status):
+        self._write([("""UPDATE users SET curstatus = ?
+                         WHERE trip_id = ? AND phone = ?""",
+                      (status, trip_id, phone))])
+
+    def set_all_statuses(self, trip_id, status):
+        self._write([("UPDATE users SET curstatus = ? WHERE trip_id = ?",
+                      (status, trip_id))])
+
+    def set_counter(self, trip_id, phone, iscounter):
+        self._write([("""UPDATE users SET iscounter = ?
+                         WHERE trip_id = ? AND phone = ?""",
+                      (iscounter, trip_id, phone))])
+
+    ## Reading it back.
+    def trips(self):
+        "Return the trips as (trip_id, name, phone, superuser) rows."
+        return self._read("SELECT trip_id, name, phone, superuser FROM trips")
+
+    def roster(self, trip_id):
+        "Return the users of trip /trip_id/ in the format of save_roster()."
+        return [(uid, firstname, lastname, phone, curstatus, bool(iscounter))
+                for uid, firstname, lastname, phone, curstatus, iscounter
+                in self._read("""SELECT uid, firstname, lastname, phone,
+                                        curstatus, iscounter
+                                 FROM users WHERE trip_id = ?""", (trip_id,))]
+
+    ## The journal.
+    def journal(self, trip_id, phones, status, at, actor):
+        """
+        Add to the journal that the users /phones/ of trip /trip_id/ were set
+        to /status/ by the user with uid /actor/ at /at/. Unlike the rest of
+        the snapshot, this is saved straight away, and raises sqlite3.Error
+        if it fails, since nothing else would remember the change.
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("""INSERT INTO journal
+                                        (trip_id, phone, status, at, actor)
+                                    VALUES (?, ?, ?, ?, ?)""",
+                                 [(trip_id, phone, status, at, actor)
+                                  for phone in phones])
+
+    def journaled(self):
+        """
+        Return the changes in the journal, oldest first, as (seq, trip_id,
+        phone, status, at, actor) rows.
+        """
+        return self._read("""SELECT seq, trip_id, phone, status, at, actor
+                             FROM journal ORDER BY seq""")
+
+    def forget(self, last_seq):
+        "Take the changes up to /last_seq/ out of the journal."
+        self._write([("DELETE FROM journal WHERE seq <= ?", (last_seq,))])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Answer questions about how boarding went from BusBot's log of status changes
+(the status_events table; see schema.py).
+
+Run it with DATABASE_URL set to the database's URL (see import_roster.py),
+like
+
+    python status_report.py at TIME [--trip NAME]
+        Show where everyone stood at TIME: how many people had each status,
+        and who was still missing. TIME is either a time today, like 14:05,
+        or a date and time, like '2017-06-01 14:05'; both are in the
+        database's time zone unless you add one ('2017-06-01 14:05 CDT').
+
+    python status_report.py ping-to-in [--since TIME] [--trip NAME]
+        Show how long people took to check in after being PINGed.
+
+Without --trip, the report is about the trip that uses OUR_NUMBER from app.py.
+Both reports look up events by trip and user in the index on status_events,
+so they stay quick however long the log gets.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+import psycopg2
+
+from schema import EVENT_CODES
+
+STATUS_NAMES = {code: status for status, code in EVENT_CODES.items()}
+
+
+def parse_time(value):
+    "Turn /value/ into something Postgres will read as a timestamp."
+    try:
+        time_today = datetime.datetime.strptime(value, '%H:%M').time()
+    except ValueError:
+        return value
+    return datetime.datetime.combine(datetime.date.today(),
+                                     time_today).isoformat(' ')
+
+def state_at(cursor, trip_id, at):
+    cursor.execute("""SELECT u.firstname, u.lastname, last.event
+                      FROM users u
+                      LEFT JOIN LATERAL (
+                          SELECT e.event FROM status_events e
+                          WHERE e.trip_id = u.trip_id AND e.uid = u.uid
+                                AND e.at <= %s::timestamptz AND e.event <> %s
+                          ORDER BY e.at DESC LIMIT 1) last ON true
+                      WHERE u.trip_id = %s
+                      ORDER BY u.lastname, u.firstname""",
+                   (at, EVENT_CODES['PINGED'], trip_id))
+    people = cursor.fetchall()
+
+    counts = {}
+    missing = []
+    for firstname, lastname, event in people:
+        status = STATUS_NAMES[event] if event is not None else 'UNSET'
+        counts[status] = counts.get(status, 0) + 1
+        if status in ('UNSET', 'OUT', 'WAIT'):
+            missing.append("%s %s - %s" % (firstname, lastname, status))
+    print("At %s:" % at)
+    print("    " + ', '.join("%s %i" % (status, counts.get(status, 0))
+                             for status in ('IN', 'OUT', 'WAIT', 'ABSENT',
+                                            'UNSET')))
+    if missing:
+        print("Missing:")
+        for person in missing:
+            print("    " + person)
+    print("(People who have left the roster since then aren't shown.)")
+
+def ping_to_in(cursor, trip_id, since):
+    cursor.execute("""SELECT COUNT(*), COUNT(checkin.at),
+                             AVG(EXTRACT(EPOCH FROM checkin.at - ping.at)),
+                             MAX(EXTRACT(EPOCH FROM checkin.at - ping.at))
+                      FROM status_events ping
+                      LEFT JOIN LATERAL (
+                          SELECT e.at FROM status_events e
+                          WHERE e.trip_id = ping.trip_id AND e.uid = ping.uid
+                                AND e.at > ping.at AND e.event = %s
+                          ORDER BY e.at LIMIT 1) checkin ON true
+                      WHERE ping.trip_id = %s AND ping.event = %s
+                            AND ping.at >= %s::timestamptz""",
+                   (EVENT_CODES['IN'], trip_id, EVENT_CODES['PINGED'],
+                    since or '-infinity'))
+    pings, answered, average, longest = cursor.fetchone()
+    print("People PINGed: %i" % pings)
+    print("Checked in afterwards: %i" % answered)
+    if answered:
+        print("Time from PING to IN: average %.0f s, longest %.0f s"
+              % (average, longest))
+
+
+parser = argparse.ArgumentParser(
+    description="Report on boarding from BusBot's status change log.")
+parser.add_argument('--trip')
+subparsers = parser.add_subparsers(dest='report')
+at_parser = subparsers.add_parser('at')
+at_parser.add_argument('time')
+ping_parser = subparsers.add_parser('ping-to-in')
+ping_parser.add_argument('--since')
+args = parser.parse_args()
+if args.report is None:
+    parser.print_help()
+    sys.exit(1)
+
+conn = psycopg2.connect(os.environ["DATABASE_URL"])
+cursor = conn.cursor()
+if args.trip is None:
+    cursor.execute("SELECT trip_id FROM trips WHERE phone IS NULL")
+else:
+    cursor.execute("SELECT trip_id FROM trips WHERE name = %s", (args.trip,))
+row = cursor.fetchone()
+if row is None:
+    print("There is no such trip.")
+    sys.exit(1)
+
+if args.report == 'at':
+    state_at(cursor, row[0], parse_time(args.time))
+else:
+    ping_to_in(cursor, row[0], args.since and parse_time(args.since))
@@ -5,9 +5,10 @@ changes to BusBot without being charged for messages, as follows:
 
 1. Change TO_URL to the URL of your app and TO_PHONE to your Twilio phone
    number.
-2. Put BusBot into debug mode by setting DEBUG to True at the top of app.py,
-   then deploying that version. This prevents it from actually sending out
-   responses over SMS; it will just log what it would have sent.
+2. Put BusBot into debug mode by setting BUSBOT_DEBUG to 1 in its
+   environment ('heroku config:set BUSBOT_DEBUG=1'). This prevents it from
+   actually sending out responses over SMS; it will just log what it would
+   have sent.
 3. Open 'heroku logs --tail' so you can see the messages that BusBot sends
    in response to your requests.
 4. Call this tool like 'python testclient.py "my message" "my phone number".
@@ -21,6 +22,7 @@ and the message currently, however.
 
 import requests
 import sys
+import uuid
 
 TO_URL = "https://MYAPPNAME.herokuapp.com/receivemsg"
 TO_PHONE = "+10005551234"
@@ -32,19 +34,22 @@ if len(sys.argv) < 2:
 
 message = sys.argv[1]
 phone = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_FROM_PHONE
+# BusBot ignores a message with a sid it has already seen, taking it for
+# Twilio sending it again, so each one needs a new sid.
+sid = 'SM' + uuid.uuid4().hex
 
 p = requests.post(TO_URL, data={
     'NumSegments': '1',
     'AccountSid': 'AC5d5d9a1e8d058c03484ea61ee11657c8',
-    'MessageSid': 'SMa8ee1a60746a9814bb1e6ecaa4a81cc0',
+    'MessageSid': sid,
     'FromZip': '46368',
     'MessagingServiceSid': 'MGd2d7909cbf1038f50158c18e735bce25',
     'FromState': 'IN',
     'NumMedia': '0',
     'ToState': 'MN',
-    'SmsSid': 'SMa8ee1a60746a9814bb1e6ecaa4a81cc0',
+    'SmsSid': sid,
     'FromCountry': 'US',
-    'SmsMessageSid': 'SMa8ee1a60746a9814bb1e6ecaa4a81cc0',
+    'SmsMessageSid': sid,
     'ToCity': 'SPRING VALLEY',
     'FromCity': 'PORTAGE',
     'ToCountry': 'US',